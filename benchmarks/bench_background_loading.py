@@ -0,0 +1,67 @@
+"""
+Holding down the arrow key over frames that are not in the cache: time during which each key press blocks the GUI
+thread when the frames and masks are read in it (as Controller.update used to do), versus when they are read by
+FrameLoader (the GUI only posts a request, and displays the latest frame read once it is delivered).
+The key is pressed every 1/fps s (the time it waits is not counted); rendering is not included.
+Usage (from the targettrack folder): python3 -m benchmarks.bench_background_loading [W H D T fps]
+"""
+import os
+import sys
+import tempfile
+import threading
+import time
+import numpy as np
+
+from benchmarks.synthetic import write_movie
+from src.datasets_code.h5Data import h5Data
+from src.datasets_code.frame_cache import FrameLoader
+
+
+def read(data, t):
+    data.get_frame(t), data.get_frame(t, col="green"), data.get_mask(t)
+
+
+def hold_key(fn, T, fps, background):
+    """:return: the median time blocked per key press (ms), and the number of frames displayed"""
+    data = h5Data(fn)
+    data.configure_cache(max_mb=512)
+    displayed = []
+    loader = None
+    if background:
+        # the GUI reads from the cache what the loader delivers, as in Controller._frame_loaded_in_background
+        loader = FrameLoader(data, lambda t: (read(data, t), displayed.append(t)))
+        loader.start()
+    blocked = []
+    for t in range(T):
+        st = time.perf_counter()
+        if background:
+            if not data.is_cached(t):
+                loader.request(t)
+        else:
+            read(data, t)
+            displayed.append(t)
+        elapsed = time.perf_counter() - st
+        blocked.append(elapsed)
+        time.sleep(max(0., 1 / fps - elapsed))
+    if background:
+        done = threading.Event()
+        loader.on_loaded = lambda t: done.set()   # the last frame is displayed once read
+        loader.request(T - 1)
+        done.wait()
+        loader.stop()
+    data.close()
+    return 1000 * np.median(blocked), len(displayed)
+
+
+def main(W=256, H=160, D=16, T=60, fps=20):
+    with tempfile.TemporaryDirectory() as tmpdir:
+        fn = write_movie(os.path.join(tmpdir, "movie.h5"), W=W, H=H, D=D, T=T)
+        print("Movie: W={} H={} D={} T={}, key pressed at {} frames/s".format(W, H, D, T, fps))
+        sync, _ = hold_key(fn, T, fps, background=False)
+        bg, bg_shown = hold_key(fn, T, fps, background=True)
+        print("GUI thread blocked per key press: {:7.2f} ms (read in the GUI thread), {:7.2f} ms (FrameLoader, {} of {} "
+              "frames displayed)".format(sync, bg, bg_shown, T))
+
+
+if __name__ == "__main__":
+    main(*[int(arg) for arg in sys.argv[1:]])
@@ -0,0 +1,46 @@
+"""
+Throughput of a loop over DataSet.get_frame versus DataSet.get_frames (reads in storage order, chunks decompressed
+by a pool of threads), for the frames and the masks of a movie.
+The gain of the thread pool grows with the number of cores: h5py reads one chunk at a time, the decompression
+(zlib) runs in parallel.
+Usage (from the targettrack folder): python3 -m benchmarks.bench_batch_reads [W H D T n_threads]
+"""
+import os
+import sys
+import tempfile
+import time
+
+from benchmarks.synthetic import write_movie
+from src.datasets_code.h5Data import h5Data
+
+
+def throughput(fun, nbytes):
+    st = time.perf_counter()
+    fun()
+    return nbytes / 2 ** 20 / (time.perf_counter() - st)
+
+
+def main(W=512, H=512, D=32, T=40, n_threads=os.cpu_count()):
+    with tempfile.TemporaryDirectory() as tmpdir:
+        fn = write_movie(os.path.join(tmpdir, "movie.h5"), W=W, H=H, D=D, T=T, chunks=(1, W, H, 1))
+        data = h5Data(fn)
+        data.configure_cache(max_mb=0)   # measure the file, not the cache
+        times = list(range(T))
+        nbytes = T * W * H * D * 2
+        frame_loop = throughput(lambda: [data.get_frame(t) for t in times], nbytes)
+        frame_batch = throughput(lambda: data.get_frames(times, n_threads=n_threads), nbytes)
+        frame_iter = throughput(lambda: list(data.get_frames(times, stack=False, n_threads=n_threads)), nbytes)
+        mask_loop = throughput(lambda: [data.get_mask(t) for t in times], nbytes)
+        mask_batch = throughput(lambda: data.get_masks(times, n_threads=n_threads), nbytes)
+        data.close()
+
+    print("Movie: C=2 W={} H={} D={} T={}, {} threads".format(W, H, D, T, n_threads))
+    print("Frames, get_frame loop:         {:8.1f} MB/s".format(frame_loop))
+    print("Frames, get_frames (stacked):   {:8.1f} MB/s ({:.2f}x)".format(frame_batch, frame_batch / frame_loop))
+    print("Frames, get_frames (iterator):  {:8.1f} MB/s ({:.2f}x)".format(frame_iter, frame_iter / frame_loop))
+    print("Masks, get_mask loop:           {:8.1f} MB/s".format(mask_loop))
+    print("Masks, get_masks (stacked):     {:8.1f} MB/s ({:.2f}x)".format(mask_batch, mask_batch / mask_loop))
+
+
+if __name__ == "__main__":
+    main(*[int(arg) for arg in sys.argv[1:]])
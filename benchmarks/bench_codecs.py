@@ -0,0 +1,66 @@
+"""
+Write throughput, read throughput and compression ratio of each codec (see h5utils.codec_kwargs) on a sample of frames.
+Usage (from the targettrack folder): python3 -m benchmarks.bench_codecs [file.h5 [n_frames]]
+Without a file, synthetic frames are used; with a file (which is only read), n_frames frames evenly spread over the
+movie are used.
+"""
+import os
+import sys
+import tempfile
+import time
+import h5py
+import numpy as np
+
+from benchmarks.synthetic import synthetic_frame
+from src.h5utils import codec_kwargs
+
+CODECS = ["none", "lzf", "gzip-1", "gzip-4", "gzip-9"]
+
+
+def sample_frames(fn, n_frames):
+    """Reads n_frames frames evenly spread over the movie in fn (either layout)."""
+    with h5py.File(fn, "r") as h5:
+        T = int(h5.attrs["T"])
+        times = np.unique(np.linspace(0, T - 1, n_frames).astype(int))
+        if h5.attrs.get("layout") == "stacked":
+            return [h5["frames"][t] for t in times]
+        return [np.array(h5[str(t) + "/frame"]) for t in times]
+
+
+def bench_codec(frames, codec, tmpdir):
+    """:return: write throughput (MB/s), read throughput (MB/s), compression ratio"""
+    fn = os.path.join(tmpdir, codec + ".h5")
+    raw_mb = sum(frame.nbytes for frame in frames) / 2 ** 20
+    st = time.perf_counter()
+    with h5py.File(fn, "w") as h5:
+        for t, frame in enumerate(frames):
+            C, W, H, D = frame.shape
+            h5.create_dataset(str(t) + "/frame", data=frame.astype(np.int16), dtype="i2", chunks=(1, W, H, 1),
+                              **codec_kwargs(codec))
+    write = raw_mb / (time.perf_counter() - st)
+    st = time.perf_counter()
+    with h5py.File(fn, "r") as h5:
+        for t in range(len(frames)):
+            h5[str(t) + "/frame"][...]
+    read = raw_mb / (time.perf_counter() - st)
+    ratio = raw_mb * 2 ** 20 / os.path.getsize(fn)
+    os.remove(fn)
+    return write, read, ratio
+
+
+def main(fn=None, n_frames=20):
+    if fn is None:
+        frames = [synthetic_frame(2, 256, 256, 32, seed=t) for t in range(n_frames)]
+        print("{} synthetic frames of shape (2, 256, 256, 32)".format(n_frames))
+    else:
+        frames = sample_frames(fn, n_frames)
+        print("{} frames of shape {} from {}".format(len(frames), frames[0].shape, fn))
+    print("{:8s} {:>13s} {:>13s} {:>7s}".format("codec", "write (MB/s)", "read (MB/s)", "ratio"))
+    with tempfile.TemporaryDirectory() as tmpdir:
+        for codec in CODECS:
+            write, read, ratio = bench_codec(frames, codec, tmpdir)
+            print("{:8s} {:13.1f} {:13.1f} {:7.2f}".format(codec, write, read, ratio))
+
+
+if __name__ == "__main__":
+    main(sys.argv[1] if len(sys.argv) > 1 else None, *[int(arg) for arg in sys.argv[2:3]])
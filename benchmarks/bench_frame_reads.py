@@ -0,0 +1,54 @@
+"""
+Latency per frame change (red + green read, as in Controller.update) with full-frame reads on the old layout versus
+per-channel reads on frames chunked with one channel and one z-plane per chunk.
+Usage (from the targettrack folder): python3 -m benchmarks.bench_frame_reads [W H D T]
+"""
+import os
+import sys
+import tempfile
+import time
+import numpy as np
+
+from benchmarks.synthetic import write_movie
+from src.datasets_code.h5Data import h5Data
+
+
+def time_per_frame(fun, T, repeats=3):
+    times = []
+    for _ in range(repeats):
+        for t in range(T):
+            st = time.perf_counter()
+            fun(t)
+            times.append(time.perf_counter() - st)
+    return 1000 * np.median(times)
+
+
+def main(W=512, H=512, D=35, T=10):
+    with tempfile.TemporaryDirectory() as tmpdir:
+        old_fn = write_movie(os.path.join(tmpdir, "old.h5"), W=W, H=H, D=D, T=T)
+        new_fn = write_movie(os.path.join(tmpdir, "new.h5"), W=W, H=H, D=D, T=T, chunks=(1, W, H, 1))
+
+        old = h5Data(old_fn)
+
+        def full_frame_reads(t):
+            # what h5Data._get_frame used to do: read the whole frame, then select the channel
+            return np.array(old.dataset[str(t) + "/frame"])[0], np.array(old.dataset[str(t) + "/frame"])[1]
+
+        before = time_per_frame(full_frame_reads, T)
+        old_channel = time_per_frame(lambda t: (old.get_frame(t), old.get_frame(t, col="green")), T)
+        old.close()
+
+        new = h5Data(new_fn)
+        after = time_per_frame(lambda t: (new.get_frame(t), new.get_frame(t, col="green")), T)
+        one_plane = time_per_frame(lambda t: new.get_frame(t, z_range=(D // 2, D // 2 + 1)), T)
+        new.close()
+
+    print("Movie: C=2 W={} H={} D={} T={}".format(W, H, D, T))
+    print("Full-frame reads, old layout:         {:8.2f} ms/frame change".format(before))
+    print("Per-channel reads, old layout:        {:8.2f} ms/frame change".format(old_channel))
+    print("Per-channel reads, (1,W,H,1) chunks:  {:8.2f} ms/frame change".format(after))
+    print("Single z-plane, (1,W,H,1) chunks:     {:8.2f} ms".format(one_plane))
+
+
+if __name__ == "__main__":
+    main(*[int(arg) for arg in sys.argv[1:]])
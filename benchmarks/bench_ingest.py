@@ -0,0 +1,54 @@
+"""
+Conversion throughput (frames/s) and peak memory of h5ingest.ingest, the engine of nd22h5.py, on generated frames (no
+ND2 file needed), versus the serial loop that nd22h5.py used to run (gzip compression in the writing process).
+Usage (from the targettrack folder): python3 -m benchmarks.bench_ingest [W H D T n_workers]
+"""
+import os
+import sys
+import tempfile
+import time
+import h5py
+
+from benchmarks.synthetic import synthetic_frame
+from src.h5ingest import ingest, peak_rss_mb
+from src.h5utils import codec_kwargs
+
+
+class SyntheticFrames:
+    """Stands for the ND2 reader: generating a frame costs about as much CPU as decoding one."""
+    def __init__(self, W, H, D):
+        self.shape = (W, H, D)
+
+    def __call__(self, t):
+        return {"frame": synthetic_frame(2, *self.shape, seed=t)}
+
+
+def serial(fn, T, read):
+    with h5py.File(fn, "w") as h5:
+        for t in range(T):
+            frame = read(t)["frame"]
+            h5.create_dataset(str(t) + "/frame", data=frame, dtype="i2", **codec_kwargs("gzip"))
+
+
+def main(W=256, H=160, D=16, T=40, n_workers=os.cpu_count()):
+    read = SyntheticFrames(W, H, D)
+    attrs = {"name": "synthetic", "C": 2, "W": W, "H": H, "D": D, "N_neurons": 0}
+    with tempfile.TemporaryDirectory() as tmpdir:
+        st = time.perf_counter()
+        serial(os.path.join(tmpdir, "serial.h5"), T, read)
+        serial_fps = T / (time.perf_counter() - st)
+        serial_rss, _ = peak_rss_mb()
+        in_process = ingest(os.path.join(tmpdir, "in_process.h5"), T, read, attrs, n_workers=0)
+        parallel = ingest(os.path.join(tmpdir, "parallel.h5"), T, read, attrs, n_workers=n_workers)
+
+    print("Movie: C=2 W={} H={} D={} T={}".format(W, H, D, T))
+    print("{:28s} {:>10s} {:>18s}".format("", "frames/s", "peak RSS (MB)"))
+    print("{:28s} {:10.1f} {:18.0f}".format("serial loop (old nd22h5)", serial_fps, serial_rss))
+    print("{:28s} {:10.1f} {:18.0f}".format("ingest, no workers", in_process["frames_per_s"],
+                                            in_process["writer_rss_mb"]))
+    print("{:28s} {:10.1f} {:18.0f}".format("ingest, {} workers".format(n_workers), parallel["frames_per_s"],
+                                            max(parallel["writer_rss_mb"], parallel["workers_rss_mb"])))
+
+
+if __name__ == "__main__":
+    main(*[int(arg) for arg in sys.argv[1:]])
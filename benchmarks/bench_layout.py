@@ -0,0 +1,62 @@
+"""
+Per-frame layout ("{t}/frame", "{t}/mask") versus stacked layout ("frames", "masks", see h5utils.to_stacked_layout):
+file open time, sequential scan throughput and random-access latency.
+Usage (from the targettrack folder): python3 -m benchmarks.bench_layout [W H D T]
+"""
+import os
+import shutil
+import sys
+import tempfile
+import time
+import numpy as np
+
+from benchmarks.synthetic import write_movie
+from src import h5utils
+from src.datasets_code.h5Data import h5Data
+
+
+def measure(fn, T, n_random=50, seed=0):
+    """:return: open time (ms), scan throughput (MB/s), median random-access latency (ms)"""
+    st = time.perf_counter()
+    data = h5Data(fn)
+    data.segmented_times()   # lists the masks, as the GUI does when opening a file
+    open_time = time.perf_counter() - st
+
+    data.configure_cache(max_mb=0)   # measure the file, not the cache
+    st = time.perf_counter()
+    nbytes = 0
+    for t in range(T):
+        nbytes += data.get_frame(t).nbytes + data.get_frame(t, col="green").nbytes + data.get_mask(t).nbytes
+    scan = nbytes / 2 ** 20 / (time.perf_counter() - st)
+
+    latencies = []
+    for t in np.random.default_rng(seed).integers(0, T, n_random):
+        st = time.perf_counter()
+        data.get_frame(t)
+        latencies.append(time.perf_counter() - st)
+    data.close()
+    return 1000 * open_time, scan, 1000 * np.median(latencies)
+
+
+def main(W=256, H=160, D=16, T=500):
+    with tempfile.TemporaryDirectory() as tmpdir:
+        per_frame_fn = write_movie(os.path.join(tmpdir, "per_frame.h5"), W=W, H=H, D=D, T=T, chunks=(1, W, H, 1))
+        stacked_fn = os.path.join(tmpdir, "stacked.h5")
+        shutil.copyfile(per_frame_fn, stacked_fn)
+        st = time.perf_counter()
+        h5utils.to_stacked_layout(stacked_fn)
+        migration = time.perf_counter() - st
+
+        results = {"per-frame": measure(per_frame_fn, T), "stacked": measure(stacked_fn, T)}
+        sizes = {"per-frame": os.path.getsize(per_frame_fn), "stacked": os.path.getsize(stacked_fn)}
+
+    print("Movie: C=2 W={} H={} D={} T={} (migration took {:.1f} s)".format(W, H, D, T, migration))
+    print("{:10s} {:>10s} {:>14s} {:>16s} {:>10s}".format("layout", "open (ms)", "scan (MB/s)", "random (ms)",
+                                                          "size (MB)"))
+    for layout, (open_time, scan, random_access) in results.items():
+        print("{:10s} {:10.1f} {:14.1f} {:16.2f} {:10.1f}".format(layout, open_time, scan, random_access,
+                                                               sizes[layout] / 2 ** 20))
+
+
+if __name__ == "__main__":
+    main(*[int(arg) for arg in sys.argv[1:]])
@@ -0,0 +1,60 @@
+"""
+Time to renumber one neuron across the whole movie: the loop that Controller.renumber_All_mask_instances used to run
+(read, edit and save every mask, then read it again and recompute its labels as mask_change does), versus
+mask_edit.edit_masks (label index to skip the frames without the neuron, lookup-table remap, masks written in chunks).
+The calcium activities, recomputed in both cases, are not included.
+Usage (from the targettrack folder): python3 -m benchmarks.bench_mask_edit [W H D T]
+"""
+import os
+import shutil
+import sys
+import tempfile
+import time
+import numpy as np
+
+from benchmarks.synthetic import write_movie
+from src.datasets_code.h5Data import h5Data
+from src.h5utils import rebuild_label_index
+from src.mask_processing.mask_edit import edit_masks
+
+
+def loop(data, old, new, times):
+    for t in times:
+        mask = data.get_mask(t)
+        if mask is not False:
+            mask[mask == old] = new
+            data.save_mask(t, mask)
+            np.unique(data.get_mask(t))
+
+
+def timed(fn, fun):
+    data = h5Data(fn)
+    st = time.perf_counter()
+    fun(data)
+    elapsed = time.perf_counter() - st
+    data.close()
+    return elapsed
+
+
+def main(W=256, H=160, D=16, T=100):
+    with tempfile.TemporaryDirectory() as tmpdir:
+        fn = write_movie(os.path.join(tmpdir, "movie.h5"), W=W, H=H, D=D, T=T, N_neurons=40)
+        rebuild_label_index(fn)   # as for masks saved by the GUI
+        data = h5Data(fn)
+        # neuron 41 is only present in one frame out of ten
+        edit_masks(data, {2: 41}, list(range(0, T, 10)))
+        data.close()
+        times = list(range(T))
+        print("Movie: W={} H={} D={} T={}".format(W, H, D, T))
+        for old, description in ((1, "in all frames"), (41, "in 10% of frames")):
+            results = []
+            for fun in (lambda d: loop(d, old, 99, times), lambda d: edit_masks(d, {old: 99}, times)):
+                copy = os.path.join(tmpdir, "copy.h5")
+                shutil.copy(fn, copy)
+                results.append(timed(copy, fun))
+            print("Neuron {:18s} loop: {:6.2f} s, edit_masks: {:6.2f} s ({:.1f}x)".format(
+                description, results[0], results[1], results[0] / results[1]))
+
+
+if __name__ == "__main__":
+    main(*[int(arg) for arg in sys.argv[1:]])
@@ -0,0 +1,51 @@
+"""
+Time per frame to play the movie back in maximum projection: reading both channels of each frame and projecting them
+(what displaying z = -1 costs when going through the frames), versus DataSet.get_mip, the first time (projections
+computed and stored in the file) and once they are stored (file reopened, so nothing is served from memory).
+The rendering of the projection (see bench_rendering) is not included.
+Usage (from the targettrack folder): python3 -m benchmarks.bench_projection_scrub [W H D T]
+"""
+import os
+import sys
+import tempfile
+import time
+import numpy as np
+
+from benchmarks.synthetic import write_movie
+from src.datasets_code.h5Data import h5Data
+
+
+def play_frames(data, T):
+    for t in range(T):
+        np.max(data.get_frame(t), axis=2), np.max(data.get_frame(t, col="green"), axis=2)
+
+
+def play_mips(data, T):
+    for t in range(T):
+        data.get_mip(t), data.get_mip(t, col="green")
+
+
+def timed(fn, fun, T):
+    data = h5Data(fn)
+    data.configure_cache(max_mb=0)   # nothing is served from memory
+    st = time.perf_counter()
+    fun(data, T)
+    data.flush()
+    elapsed = time.perf_counter() - st
+    data.close()
+    return 1000 * elapsed / T
+
+
+def main(W=256, H=160, D=16, T=100):
+    with tempfile.TemporaryDirectory() as tmpdir:
+        fn = write_movie(os.path.join(tmpdir, "movie.h5"), W=W, H=H, D=D, T=T, chunks=(1, W, H, 1))
+        print("Movie: W={} H={} D={} T={}".format(W, H, D, T))
+        frames = timed(fn, play_frames, T)
+        first = timed(fn, play_mips, T)
+        stored = timed(fn, play_mips, T)
+        print("Frames then projection: {:7.1f} ms/frame, get_mip: {:7.1f} ms/frame (first time), {:7.1f} ms/frame "
+              "(stored), {:.0f} frames/s".format(frames, first, stored, 1000 / stored))
+
+
+if __name__ == "__main__":
+    main(*[int(arg) for arg in sys.argv[1:]])
@@ -0,0 +1,128 @@
+"""
+Latency from a rendering slider move (or a z scroll) to the image handed to the display: the full-volume rendering
+that ImageRendering used to compute at every change before the figure showed one slice of it, versus
+ImageRendering.render_slice (only the displayed slice, frame statistics computed once, memoized slices), in float or
+with the uint8 lookup tables of integer frames (see ImageRendering._render_slice_lut).
+Same for the masks, on a mask change or a click that highlights a neuron: the full-volume colormap versus
+ImageRendering.render_mask_slice (palette lookup of the displayed slice).
+The figure is replaced by a stand-in that requests the displayed slice like MainFigWidget.update_image_display does;
+the transfer of the pixels to Qt is not included.
+Usage (from the targettrack folder): python3 -m benchmarks.bench_rendering [W H D]
+"""
+import sys
+import time
+import numpy as np
+
+from benchmarks.synthetic import synthetic_frame, synthetic_mask
+from src.graphic_interface.image_rendering import ImageRendering
+
+
+class Figure:
+    """Displays slice z of the image it is given, as MainFigWidget does."""
+    def __init__(self, z):
+        self.z = z
+        self.img_slice = None
+
+    def set_data(self, img_slice=None, mask_slice=None, label=None, depth=None):
+        if img_slice is not None:
+            self.img_slice = img_slice
+            self.shown = img_slice(self.z)
+        if mask_slice:
+            self.shown_mask = mask_slice(self.z)
+
+
+class Controller:
+    def __init__(self):
+        self.frame_registered_clients = []
+        self.highlighted_neuron_registered_clients = []
+        self.frame_img_registered_clients = []
+        self.mask_registered_clients = []
+        self.frame_loading_registered_clients = []
+
+
+def render_volume(rendering, z):
+    """The rendering of the whole volume as it used to be done at every change, then the displayed slice."""
+    img_r = rendering.im_rraw
+    mean_r = np.mean(img_r)
+    img_r = np.clip(((rendering.low * mean_r) <= img_r) * img_r, 0, (mean_r + (255 - mean_r) * rendering.high)) / 255 \
+        * rendering.blend_r
+    img_g = rendering.im_graw
+    mean_g = np.mean(img_g)
+    img_g = np.clip(((rendering.low * mean_g) <= img_g) * img_g, 0, (mean_g + (255 - mean_g) * rendering.high)) / 255 \
+        * rendering.blend_g
+    combined_img = np.concatenate((img_r[:, :, :, None], img_g[:, :, :, None], img_r[:, :, :, None]), axis=3)
+    return rendering._f_gamma(combined_img)[:, :, z]
+
+
+def color_volume(rendering, z):
+    """The coloring of the whole mask as it used to be done at every change, then the displayed slice."""
+    raw_mask = rendering.raw_mask
+    mask_rgba = rendering.cmap_mask((raw_mask % rendering.nmaskcolors + 1) * (raw_mask != 0))
+    mask_rgba[raw_mask == 0, 3] = 0
+    mask_rgba[raw_mask != 0, 3] = rendering.mask_transparency
+    if rendering.highlighted > 0:
+        mask_rgba[raw_mask == rendering.highlighted, 3] = rendering.highlighted_transparency
+    return mask_rgba[:, :, z].copy()
+
+
+def latency(fun, moves):
+    times = []
+    for move in moves:
+        st = time.perf_counter()
+        fun(move)
+        times.append(time.perf_counter() - st)
+    return 1000 * np.median(times)
+
+
+def main(W=512, H=512, D=35):
+    frame = synthetic_frame(2, W, H, D)
+    figure = Figure(D // 2)
+    rendering = ImageRendering(Controller(), figure, "synthetic", 1)
+    rendering.change_t(0)
+    rendering.change_img_data(frame[0], frame[1])
+    print("Frame: W={} H={} D={}".format(W, H, D))
+    gammas = list(range(20, 80))
+    rendering.lut_rendering = False
+    float_slice = latency(rendering.change_gamma, gammas)
+    float_bytes = figure.shown.nbytes
+    rendering.lut_rendering = True
+    gammas = list(range(80, 140))
+
+    def slider_old(gamma):
+        rendering.gamma = gamma / 100
+        render_volume(rendering, figure.z)
+
+    def scroll(z):
+        figure.z = z
+        figure.set_data(img_slice=rendering.render_slice)
+
+    print("Gamma slider move:      full volume {:7.1f} ms, displayed slice {:7.1f} ms (float), {:7.1f} ms (LUT), "
+          "slider moved back {:7.1f} ms".format(latency(slider_old, gammas), float_slice,
+                                                latency(rendering.change_gamma, gammas),
+                                                latency(rendering.change_gamma, gammas[-rendering.max_cached_slices:])))
+    print("Rendered slice:         {:.1f} MB (float), {:.1f} MB (LUT)".format(
+        float_bytes / 1e6, figure.shown.nbytes / 1e6))
+    rendering.change_gamma(40)
+    print("z scroll:               full volume {:7.1f} ms, displayed slice {:7.1f} ms, second pass {:7.1f} ms".format(
+        latency(lambda z: render_volume(rendering, z), range(D)), latency(scroll, range(D)),
+        latency(scroll, range(D - rendering.max_cached_slices, D))))
+    figure.z = -1
+    print("Gamma slider, max proj: displayed projection {:7.1f} ms".format(latency(rendering.change_gamma, gammas)))
+
+    figure.z = D // 2
+    masks = [synthetic_mask(W, H, D, seed=seed) for seed in range(5)]
+
+    def highlight_old(neuron):
+        rendering.highlighted = neuron
+        color_volume(rendering, figure.z)
+
+    print("Mask change:            full volume {:7.1f} ms, displayed slice {:7.1f} ms".format(
+        latency(lambda mask: (setattr(rendering, "raw_mask", mask), color_volume(rendering, figure.z)), masks),
+        latency(rendering.change_mask_data, masks)))
+    print("Highlight click:        full volume {:7.1f} ms, displayed slice {:7.1f} ms".format(
+        latency(highlight_old, range(1, 20)),
+        latency(lambda n: rendering.change_highlighted_neuron(high=n), range(20, 40))))
+
+
+if __name__ == "__main__":
+    main(*[int(arg) for arg in sys.argv[1:]])
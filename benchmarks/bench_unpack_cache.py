@@ -0,0 +1,87 @@
+"""
+Preparation of the training data of the neural networks: the per-frame .npy files that run_NNmasks_f.py used to write
+at every run, versus the unpack cache (one memory-mapped array per modality, see unpack_cache).
+Reported: unpack time, time to check the cache on the next run, disk footprint, and the reading part of an epoch
+(every annotated frame and its mask, as TrainDataset.__getitem__ loads them; the augmentation and the network are not
+included). Files are in the page cache, as they usually are right after unpacking.
+Usage (from the targettrack folder): python3 -m benchmarks.bench_unpack_cache [W H D T]
+"""
+import glob
+import os
+import sys
+import tempfile
+import time
+import h5py
+import numpy as np
+
+from benchmarks.synthetic import write_movie
+from src.neural_network_scripts import unpack_cache
+
+
+def unpack_npy(h5, T, datadir):
+    W, H = h5.attrs["W"], h5.attrs["H"]
+    for name in ("frames", "highs", "masks"):
+        os.makedirs(os.path.join(datadir, name))
+    for i in range(T):
+        np.save(os.path.join(datadir, "frames", "frame_" + str(i) + ".npy"),
+                np.array(h5[str(i) + "/frame"]).astype(np.int16))
+        np.save(os.path.join(datadir, "highs", "high_" + str(i) + ".npy"), np.full((1, W, H), 255).astype(np.int16))
+        if str(i) + "/mask" in h5.keys():
+            np.save(os.path.join(datadir, "masks", "mask_" + str(i) + ".npy"),
+                    np.array(h5[str(i) + "/mask"]).astype(np.int16))
+
+
+def unpack_cached(h5, T, datadir):
+    cache = unpack_cache.UnpackCache(datadir)
+    unpack_cache.unpack_frames(cache, h5, T)
+    times = [i for i in range(T) if str(i) + "/mask" in h5.keys()]
+    dsets = [h5[str(i) + "/mask"] for i in times]
+    cache.unpack("masks", unpack_cache.digest(times, *dsets), times, dsets[0].shape, np.int16,
+                 lambda i: h5[str(i) + "/mask"][...])
+    return cache
+
+
+def epoch_npy(datadir, times):
+    for ii in times:
+        np.load(datadir + "/frames/frame_" + str(ii) + ".npy")[:2] / 255
+        np.load(os.path.join(datadir, "masks", "mask_" + str(ii) + ".npy"))
+
+
+def epoch_cached(cache, times):
+    for ii in times:
+        cache.get("frames", ii)[:2] / 255
+        cache.get("masks", ii)
+
+
+def footprint(datadir):
+    return sum(os.stat(fn).st_blocks * 512 for fn in glob.glob(os.path.join(datadir, "**"), recursive=True)
+               if os.path.isfile(fn))
+
+
+def timed(fun, *args):
+    st = time.perf_counter()
+    result = fun(*args)
+    return time.perf_counter() - st, result
+
+
+def main(W=256, H=160, D=16, T=200):
+    with tempfile.TemporaryDirectory() as tmpdir:
+        fn = write_movie(os.path.join(tmpdir, "movie.h5"), W=W, H=H, D=D, T=T, chunks=(1, W, H, 1))
+        times = list(range(T))
+        print("Movie: W={} H={} D={} T={}".format(W, H, D, T))
+        with h5py.File(fn, "r") as h5:
+            npy_dir, cache_dir = os.path.join(tmpdir, "npy"), os.path.join(tmpdir, "cache")
+            t_npy, _ = timed(unpack_npy, h5, T, npy_dir)
+            t_cache, cache = timed(unpack_cached, h5, T, cache_dir)
+            t_check, _ = timed(unpack_cached, h5, T, cache_dir)
+        e_npy, _ = timed(epoch_npy, npy_dir, times)
+        e_cache, _ = timed(epoch_cached, unpack_cache.UnpackCache(cache_dir), times)
+        n_files = len(glob.glob(os.path.join(npy_dir, "*", "*")))
+        print("npy files:    unpack {:6.2f} s (every run), epoch read {:6.2f} s, {:7.1f} MB in {} files".format(
+            t_npy, e_npy, footprint(npy_dir) / 1e6, n_files))
+        print("unpack cache: unpack {:6.2f} s, next run {:6.2f} s, epoch read {:6.2f} s, {:7.1f} MB in {} files".format(
+            t_cache, t_check, e_cache, cache.nbytes() / 1e6, len(cache.index) + 1))
+
+
+if __name__ == "__main__":
+    main(*[int(arg) for arg in sys.argv[1:]])
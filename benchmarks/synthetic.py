@@ -0,0 +1,56 @@
+"""
+Helpers to generate synthetic movies for the benchmarks.
+The benchmarks are meant to be run from the targettrack folder, e.g. `python3 -m benchmarks.bench_frame_reads`
+"""
+import h5py
+import numpy as np
+
+
+def synthetic_frame(C, W, H, D, n_blobs=40, seed=0):
+    """
+    Generates a (C,W,H,D) int16 volume that looks (a little) like a worm recording: low Poisson background and bright
+    gaussian blobs. Pure noise would not compress like real data.
+    """
+    rng = np.random.default_rng(seed)
+    frame = rng.poisson(10, size=(C, W, H, D)).astype(np.float32)
+    grid_x, grid_y, grid_z = np.arange(W)[:, None, None], np.arange(H)[None, :, None], np.arange(D)[None, None, :]
+    for _ in range(n_blobs):
+        cx, cy, cz = rng.uniform(0, W), rng.uniform(0, H), rng.uniform(0, D)
+        blob = np.exp(-((grid_x - cx) ** 2 + (grid_y - cy) ** 2) / 18 - (grid_z - cz) ** 2 / 2)
+        frame += rng.uniform(50, 200) * blob[None]
+    return np.clip(frame, 0, 255).astype(np.int16)
+
+
+def synthetic_mask(W, H, D, n_neurons=40, seed=0):
+    """Generates a (W,H,D) int16 mask with n_neurons box-shaped neurons."""
+    rng = np.random.default_rng(seed)
+    mask = np.zeros((W, H, D), dtype=np.int16)
+    for n in range(1, n_neurons + 1):
+        x, y, z = rng.integers(0, W - 6), rng.integers(0, H - 6), rng.integers(0, max(1, D - 3))
+        mask[x:x + 6, y:y + 6, z:z + 3] = n
+    return mask
+
+
+def write_movie(fn, C=2, W=256, H=160, D=16, T=20, N_neurons=40, chunks=True, with_masks=True, **dset_kwargs):
+    """
+    Writes a synthetic movie in the format of assembleh5.py.
+    :param chunks: True for automatic h5py chunking, or a chunk shape for the frames (e.g. (1,W,H,1))
+    :param dset_kwargs: passed to create_dataset for frames and masks (default: gzip compression)
+    """
+    if not dset_kwargs:
+        dset_kwargs = {"compression": "gzip"}
+    with h5py.File(fn, "w") as h5:
+        for t in range(T):
+            h5.create_dataset(str(t) + "/frame", data=synthetic_frame(C, W, H, D, seed=t), dtype="i2", chunks=chunks,
+                              **dset_kwargs)
+            if with_masks:
+                h5.create_dataset(str(t) + "/mask", data=synthetic_mask(W, H, D, N_neurons, seed=t), dtype="i2",
+                                  **dset_kwargs)
+        h5.attrs["name"] = "synthetic"
+        h5.attrs["C"] = C
+        h5.attrs["W"] = W
+        h5.attrs["H"] = H
+        h5.attrs["D"] = D
+        h5.attrs["T"] = T
+        h5.attrs["N_neurons"] = N_neurons
+    return fn
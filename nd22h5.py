@@ -1,22 +1,33 @@
 import sys
 import os
 import numpy as np
-import h5py
 from nd2reader import ND2Reader
+from src.h5ingest import ingest
 
+# usage: python3 nd22h5.py file.nd2 out.h5 [codec] [n_workers]
+# Frames are decoded and compressed by n_workers processes (default: number of cores). If interrupted, re-running the
+# same command resumes the conversion from the last complete frame.
 
-nd2filename=sys.argv[1]
-hdfout=sys.argv[2]
 
-with ND2Reader(nd2filename) as images:
-    c = images.sizes['c']
-    x = images.sizes['x']
-    y = images.sizes['y']
-    z = images.sizes['z']
+def open_nd2(nd2filename):
+    images = ND2Reader(nd2filename)
     images.iter_axes = 't'
     images.bundle_axes = 'xyz'
+    return images
 
-    # compute number of frames, which is wrong in the metadata   (by dichotomy)
+
+def frame_count(images):
+    """
+    The number of frames that can be read. The metadata is used when its last frame can be read, otherwise (the
+    metadata is sometimes wrong) the number of frames is found by dichotomy.
+    """
+    n_frames = images.sizes.get('t')
+    if n_frames:
+        try:
+            images[n_frames - 1]
+            return n_frames
+        except Exception:
+            pass
     max_n_frames = len(images.metadata["frames"])
     mi = 0
     ma = max_n_frames
@@ -31,27 +42,47 @@ with ND2Reader(nd2filename) as images:
         if prev_t == t:
             break
         prev_t = t
-    t += 1
-
-    with h5py.File(hdfout, 'w') as hf:
-        for i1 in range(t):
-            im3d = np.zeros((c, x, y, z))
-            dset = hf.create_dataset(str(i1) + "/frame", (c, x-2, y, z), dtype="i2", compression="gzip")
-            if c>1:
-                for c1 in range(c):
-                    images.default_coords['c'] = c1
-                    im3d[1-c1] = np.array(images[i1]).astype(np.int32)
-            else:
-                im3d[0] = np.array(images[i1]).astype(np.int32)
-            dset[...] = im3d[:,:-2,:,:]
-        name1 = os.path.basename(hdfout)
-        name1 = name1.split(".")
-        name = name1[0]
-        print(name)
-        hf.attrs["name"]=name#os.path.basename(hdfout)
-        hf.attrs["C"]=c
-        hf.attrs["W"]=y
-        hf.attrs["H"]=x-2
-        hf.attrs["D"]=z
-        hf.attrs["T"]=t
-        hf.attrs["N_neurons"]=0
+    return t + 1
+
+
+class Nd2Frames:
+    """Reads the frames of an ND2 file for h5ingest.ingest; each worker process opens the file once."""
+    def __init__(self, nd2filename, c):
+        self.nd2filename = nd2filename
+        self.c = c
+        self._images = None
+
+    def __getstate__(self):
+        return {**self.__dict__, "_images": None}
+
+    def __call__(self, t):
+        if self._images is None:
+            self._images = open_nd2(self.nd2filename)
+        if self.c > 1:
+            frames = []
+            for c1 in range(self.c):
+                self._images.default_coords['c'] = c1
+                frames.append(np.array(self._images[t]))
+            im3d = np.stack(frames[::-1])
+        else:
+            im3d = np.array(self._images[t])[None]
+        return {"frame": im3d[:, :-2, :, :].astype(np.int16)}
+
+
+if __name__ == "__main__":
+    nd2filename=sys.argv[1]
+    hdfout=sys.argv[2]
+    codec=sys.argv[3] if len(sys.argv)>3 else "gzip"   # see h5utils.codec_kwargs
+    n_workers=int(sys.argv[4]) if len(sys.argv)>4 else None
+
+    with open_nd2(nd2filename) as images:
+        c = images.sizes['c'] if 'c' in images.sizes else 1
+        x = images.sizes['x']
+        y = images.sizes['y']
+        z = images.sizes['z']
+        t = frame_count(images)
+
+    name = os.path.basename(hdfout).split(".")[0]
+    print(name)
+    attrs = {"name": name, "C": c, "W": y, "H": x-2, "D": z, "N_neurons": 0}
+    ingest(hdfout, t, Nd2Frames(nd2filename, c), attrs, codec=codec, n_workers=n_workers)
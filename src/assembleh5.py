@@ -1,11 +1,31 @@
 #These are instructions to assemble a minimal h5 file compatible with our GUI
+import glob
 import h5py
 import numpy as np
+import os
 import sys
+from h5utils import codec_kwargs, row_chunks
 if len(sys.argv)>1:
     fn=sys.argv[1]
 else:
     fn="./data/example.h5"
+#compression of frames and masks: "gzip", "gzip-<level>" (0 to 9), "lzf" (faster to read, larger) or "none"
+if len(sys.argv)>2:
+    codec=sys.argv[2]
+else:
+    codec="gzip"
+
+#To assemble a real recording, give a glob of files with one time frame each (.npy arrays or TIFF stacks, see
+#h5ingest.ImageFiles), e.g. python3 src/assembleh5.py out.h5 gzip "recording/frame_*.tif" [n_workers]
+#The files are loaded and compressed by a pool of processes. If interrupted, the same command resumes the assembly.
+if len(sys.argv)>3:
+    sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+    from src.h5ingest import ingest, natural_sort, ImageFiles
+    frames=ImageFiles(natural_sort(glob.glob(sys.argv[3])))
+    C,W,H,D=frames(0)["frame"].shape
+    attrs={"name":os.path.basename(fn).split(".")[0],"C":C,"W":W,"H":H,"D":D,"N_neurons":0}
+    ingest(fn,len(frames.filenames),frames,attrs,codec=codec,n_workers=int(sys.argv[4]) if len(sys.argv)>4 else None)
+    sys.exit()
 
 h5=h5py.File(fn,"w")
 
@@ -19,13 +39,15 @@ N_neurons=40#in case we already know how many neurons we have
 
 for i in range(T):
     print(i)#just for check
-    dset=h5.create_dataset(str(i)+"/frame",(C,W,H,D),dtype="i2",compression="gzip")
+    #one chunk per channel and z-plane, so that the GUI can read a single channel/z-plane without decompressing the rest
+    dset=h5.create_dataset(str(i)+"/frame",(C,W,H,D),dtype="i2",chunks=(1,W,H,1),**codec_kwargs(codec))
     dset[...]=(np.random.random((C,W,H,D))*255).astype(np.int16)#int16 is i2
-    dset=h5.create_dataset(str(i)+"/mask",(W,H,D),dtype="i2",compression="gzip")
+    dset=h5.create_dataset(str(i)+"/mask",(W,H,D),dtype="i2",**codec_kwargs(codec))
     dset[...]=(np.random.randint(0,N_neurons+1,(W,H,D))).astype(np.int16)
 
 #initialize points
-dset=h5.create_dataset("pointdat",(T,N_neurons+1,3),dtype="f4")
+#chunks of whole frames, so that saving the annotations of a frame only rewrites a small chunk
+dset=h5.create_dataset("pointdat",(T,N_neurons+1,3),dtype="f4",chunks=row_chunks((T,N_neurons+1,3),4))
 dset[...]=(np.random.random((T,N_neurons+1,3))*np.array([W,H,D])[None,None,:]).astype(np.float32)
 dset[:,0]=np.nan
 
@@ -37,4 +59,5 @@ h5.attrs["H"]=H
 h5.attrs["D"]=D
 h5.attrs["T"]=T
 h5.attrs["N_neurons"]=N_neurons
+h5.attrs["codec"]=codec
 h5.close()
@@ -1,6 +1,10 @@
 import abc
+import hashlib
 import numpy as np
+from concurrent.futures import ThreadPoolExecutor
 from src.graphic_interface.image_standardizer import ImageAligner, ImageCropper
+from .frame_cache import FrameCache, Prefetcher
+from src.h5utils import label_stats
 
 
 
@@ -13,6 +17,8 @@ class DataSet:
     def __init__(self, dataset_path=None):
         self.aligner = None
         self.cropper = None
+        self.cache = FrameCache()   # LRU cache of the frames and masks read (see self.configure_cache)
+        self._prefetcher = None
         self._align = False
         self.crop = False
         self.coarse_seg_mode = False # MB added
@@ -78,8 +84,7 @@ class DataSet:
     @crop.setter
     def crop(self, value):
         if value and self.cropper is None:
-            orig_shape = self.get_frame(0, force_original=True).shape
-            self.cropper = ImageCropper(self, orig_shape)
+            self.cropper = ImageCropper(self, tuple(self.frame_shape))
         self._crop = value
 
     @abc.abstractmethod
@@ -134,15 +139,110 @@ class DataSet:
     # reading the data
 
     @abc.abstractmethod
-    def _get_frame(self, t, col="red"):
-        """Gets the original frame"""
+    def _get_frame(self, t, col="red", z_range=None):
+        """
+        Gets the original frame, for the given channel only.
+        :param z_range: None (all z-planes) or (z_start, z_end), the interval of z-planes to read
+        """
         raise NotImplementedError
 
-    def get_frame(self, t, col="red", force_original=False):
-        frame = self._get_frame(t, col=col)
+    def get_frame(self, t, col="red", force_original=False, z_range=None):
+        """
+        Gets the video frame of time t in channel col.
+        Whole frames go through self.cache; a z_range is served from the cached frame if there is one.
+        :param t: time frame
+        :param col: "red" or "green", the channel to read
+        :param force_original: forces to return the original image, without transformation
+        :param z_range: None or (z_start, z_end). If given, only these z-planes are returned (and, as far as possible,
+            read from disk).
+        :return frame: 3D numpy array (W*H*D, or W*H*(z_end-z_start) if z_range is given)
+        """
+        key = self._cache_key("frame", t, col, force_original)
+        if z_range is not None:
+            if key in self.cache:
+                frame = self.cache.get(key)
+                if frame is not None:
+                    return frame[:, :, z_range[0]:z_range[1]].copy()
+            return self._read_frame(t, col, force_original, z_range)
+        frame = self.cache.get(key)
+        if frame is None:
+            generation = self.cache.generation
+            frame = self._read_frame(t, col, force_original)
+            self.cache.put(key, frame, generation)
+        return frame.copy()
+
+    def _read_frame(self, t, col="red", force_original=False, z_range=None):
+        """Same as get_frame, without the cache."""
         if force_original:
-            return frame
-        return self._transform(t, frame)
+            return self._get_frame(t, col=col, z_range=z_range)
+        if self.align or self.crop:
+            stored_signature = self._aligned_view_signature(t)
+            if stored_signature is not None and stored_signature == self._transform_signature(t):
+                return self._get_aligned_frame(t, col=col, z_range=z_range)
+        if self.align and z_range is not None:
+            # the alignment is a 3D transformation, it needs the whole volume
+            frame = self._transform(t, self._get_frame(t, col=col))
+            return frame[:, :, z_range[0]:z_range[1]]
+        return self._transform(t, self._get_frame(t, col=col, z_range=z_range))
+
+    def _aligned_view_signature(self, t):
+        """
+        Gets the signature (see self._transform_signature) of the stored aligned view of frame t, or None if there is
+        no stored aligned view.
+        """
+        return None
+
+    def _get_aligned_frame(self, t, col="red", z_range=None):
+        """
+        Gets the frame of time t from the stored aligned view (for the given channel only).
+        :param z_range: None (all z-planes) or (z_start, z_end), the interval of z-planes to read
+        """
+        raise NotImplementedError
+
+    def get_mip(self, t, col="red"):
+        """
+        Gets the maximum projection along z of the video frame of time t in channel col (see get_frame), and the mean
+        of the frame, with which the projection is rendered as the frame would be (see ImageRendering).
+        Projections are kept in self.cache and, if the data set supports it, stored with the data (see _stored_mip), so
+        that the movie can be played back from projections without reading the frames.
+        :return: (mip, mean): W*H array, float
+        """
+        mip_key, mean_key = self._cache_key("mip", t, col), self._cache_key("mip_mean", t, col)
+        mip, mean = self.cache.get(mip_key), self.cache.get(mean_key)
+        if mip is None or mean is None:
+            generation = self.cache.generation
+            stored = self._stored_mip(t)
+            if stored is None:
+                stored = self._compute_mip(t)
+            for i, channel in enumerate(["red", "green"][:len(stored[0])]):
+                self.cache.put(self._cache_key("mip", t, channel), stored[0][i], generation)
+                self.cache.put(self._cache_key("mip_mean", t, channel), np.array(stored[1][i]), generation)
+            channel = 0 if col == "red" else 1
+            mip, mean = stored[0][channel], stored[1][channel]
+        return mip.copy(), float(mean)
+
+    def _compute_mip(self, t):
+        """
+        The projections and means (see get_mip) of all channels of frame t, computed from the frames (which go through
+        self.cache) and stored with the data.
+        :return: (mips, means): C*W*H array, array of C floats
+        """
+        frames = [self.get_frame(t, col) for col in ["red", "green"][:self.nb_channels or 1]]
+        mips = np.stack([np.max(frame, axis=2) for frame in frames])
+        means = np.array([np.mean(frame) for frame in frames])
+        self._store_mip(t, mips, means)
+        return mips, means
+
+    def _stored_mip(self, t):
+        """
+        The projections and means (see _compute_mip) of frame t stored with the data for the current transformation
+        (see self._transform_signature), or None.
+        """
+        return None
+
+    def _store_mip(self, t, mips, means):
+        """Stores with the data the projections and means of frame t (see _stored_mip), if the data set supports it."""
+        pass
 
     @abc.abstractmethod
     def _get_mask(self, t):
@@ -160,11 +260,81 @@ class DataSet:
         :return segmented: 3D numpy array with segmented[x,y,z] = segment_id, or 0 for background
         Returns False if mask not present.
         """
+        key = self._cache_key("mask", t, "coarse" if self.coarse_seg_mode else "regular", force_original)
+        mask = self.cache.get(key)
+        if mask is None:
+            generation = self.cache.generation
+            mask = self._read_mask(t, force_original)
+            if mask is False:
+                return mask
+            self.cache.put(key, mask, generation)
+        return mask.copy()
+
+    def _read_mask(self, t, force_original=False):
+        """Same as get_mask, without the cache."""
         orig_segmented = self._get_mask(t)
         if force_original or orig_segmented is False:
             return orig_segmented
         return self._transform(t, orig_segmented, True)
 
+    def get_frames(self, times, col="red", force_original=False, stack=True, n_threads=4, batch_size=16):
+        """
+        Gets the frames of several times (see get_frame), much faster than calling get_frame in a loop: the frames are
+        read in the order in which they are stored, decompressed and transformed by a pool of threads.
+        Cached frames are served from self.cache, but the frames read are not added to it (so that going through the
+        whole movie does not evict the frames around the current time).
+        :param times: list or range of time frames
+        :param stack: if True, returns a (len(times),W,H,D) array; else returns an iterator over the frames (in the
+            order of times), which only holds batch_size frames in memory at once.
+        :param n_threads: number of reading threads
+        :param batch_size: number of frames read at once when iterating (all frames are read at once if stack)
+        """
+        frames = self._iter_batches("frame", times, col, force_original, n_threads, None if stack else batch_size)
+        if stack:
+            return np.stack(list(frames))
+        return frames
+
+    def get_masks(self, times, force_original=False, stack=True, n_threads=4, batch_size=16):
+        """
+        Gets the masks of several times (see get_mask and get_frames).
+        :return: if stack, a (len(times),W,H,D) array (raises KeyError if a mask is missing); else an iterator over
+            the masks in the order of times, with False for the missing masks.
+        """
+        masks = self._iter_batches("mask", times, "coarse" if self.coarse_seg_mode else "regular", force_original,
+                                   n_threads, None if stack else batch_size)
+        if stack:
+            masks = list(masks)
+            missing = [t for t, mask in zip(times, masks) if mask is False]
+            if missing:
+                raise KeyError("No mask for times {}".format(missing))
+            return np.stack(masks)
+        return masks
+
+    def _iter_batches(self, kind, times, sub, force_original, n_threads, batch_size):
+        """
+        Yields the frames or masks (see _cache_key for kind and sub) of times, reading batch_size of them (all of them
+        if None) at once, each batch in the order given by self._read_position.
+        """
+        times = list(times)
+        if kind == "frame":
+            read = lambda t: self._read_frame(t, sub, force_original)
+        else:
+            read = lambda t: self._read_mask(t, force_original)
+        with ThreadPoolExecutor(max_workers=n_threads) as pool:
+            for start in range(0, len(times), batch_size or max(len(times), 1)):
+                times_batch = times[start:start + (batch_size or len(times))]
+                values = {t: self.cache.get(self._cache_key(kind, t, sub, force_original)) for t in set(times_batch)}
+                todo = sorted([t for t, value in values.items() if value is None],
+                              key=lambda t: self._read_position(kind, t))
+                values.update(zip(todo, pool.map(read, todo)))
+                for t in times_batch:
+                    value = values[t]
+                    yield value if value is False else value.copy()
+
+    def _read_position(self, kind, t):
+        """Sort key to read the frames or masks (kind) of several times in the order in which they are stored."""
+        return t
+
     def get_NN_mask(self, t: int, NN_key: str):
         """
         Gets the mask predicted by the network designated by NN_key for time t.
@@ -299,6 +469,32 @@ class DataSet:
         """
         raise NotImplementedError
 
+    def get_label_stats(self, t, NN_key=None):
+        """
+        Gets the label index of the mask of time t (respects self.coarse_seg_mode), or of the mask predicted by a NN.
+        Never applies a transformation.
+        :param NN_key: None for the annotated mask, or the key of a NN for its predicted mask
+        :return: None if there is no such mask, else an L*8 array with one line [label, voxel count, x_start, x_stop,
+            y_start, y_stop, z_start, z_stop] per label present in the mask (see h5utils.label_stats)
+        """
+        if NN_key is not None:
+            mask = self.get_NN_mask(t, NN_key)
+        else:
+            mask = self.get_mask(t, force_original=True)
+        if mask is False:
+            return None
+        return label_stats(mask)
+
+    def mask_labels(self, t, NN_key=None):
+        """
+        Gets the labels (neurons) present in the mask of time t, without the background. See get_label_stats.
+        :return: 1D array of labels, or None if there is no such mask
+        """
+        stats = self.get_label_stats(t, NN_key)
+        if stats is None:
+            return None
+        return stats[:, 0]
+
     def get_existing_neurons(self, t):
         """
         :param t: time
@@ -318,6 +514,64 @@ class DataSet:
                 existing_neurons = np.full(self.nb_neurons + 1, False)
         return existing_neurons
 
+    ####################################################################################
+    # caching the data
+
+    def _cache_key(self, kind, t, sub, force_original=False):
+        """
+        Key of self.cache for the frame or mask of time t.
+        :param kind: "frame" or "mask" (or "mip" and "mip_mean" for the projections of a frame, see get_mip)
+        :param sub: the channel for a frame, the kind of segmentation (coarse or regular) for a mask
+        """
+        transfo = None if force_original or not (self.align or self.crop) else (self.align, self.crop)
+        return kind, t, sub, transfo
+
+    def configure_cache(self, max_mb=None, prefetch_radius=None):
+        """
+        Sets the size of the frame cache and starts (or stops) prefetching.
+        :param max_mb: maximum size of the cache, in MB (0 disables the cache). None to leave unchanged.
+        :param prefetch_radius: number k of frames to prefetch on each side of the current frame (0 or None to not
+            prefetch)
+        """
+        if max_mb is not None:
+            self.cache.max_bytes = int(max_mb * 2 ** 20)
+            self.cache.clear()
+        self.stop_prefetch()
+        if prefetch_radius and self.cache.max_bytes:
+            self._prefetcher = Prefetcher(self, prefetch_radius)
+            self._prefetcher.start()
+
+    def prefetch_around(self, t):
+        """Asks the prefetching thread (if any) to load the frames and masks around time t."""
+        if self._prefetcher is not None:
+            self._prefetcher.request(t)
+
+    def prefetch(self, t):
+        """Loads the frame (all channels) and mask of time t into the cache, as they would be read by the GUI."""
+        generation = self.cache.generation
+        for col in ["red", "green"][:self.nb_channels or 1]:
+            key = self._cache_key("frame", t, col)
+            if key not in self.cache:
+                self.cache.put(key, self._read_frame(t, col), generation)
+        key = self._cache_key("mask", t, "coarse" if self.coarse_seg_mode else "regular")
+        if key not in self.cache:
+            mask = self._read_mask(t)
+            if mask is not False:
+                self.cache.put(key, mask, generation)
+
+    def is_cached(self, t):
+        """Whether the frame (all channels) of time t is in the cache, so that the GUI reads it without delay."""
+        return all(self._cache_key("frame", t, col) in self.cache for col in ["red", "green"][:self.nb_channels or 1])
+
+    def stop_prefetch(self):
+        if self._prefetcher is not None:
+            self._prefetcher.stop()
+            self._prefetcher = None
+
+    def cache_stats(self):
+        """:return: dict with the numbers of hits and misses of the cache, and its number of items and size in bytes"""
+        return self.cache.stats()
+
     ####################################################################################
     # editing the data
 
@@ -356,11 +610,20 @@ class DataSet:
             self._save_frame(t,frameR,frameG,mask)
         else:
             self._save_frame(t,frameR,frameG, 0)
+        self.cache.invalidate(t)
 
     @abc.abstractmethod
     def _save_mask(self, t, mask):
         raise NotImplementedError
 
+    def flush(self):
+        """Waits until everything saved so far is written (see h5Data, which writes masks and points in the background)."""
+        pass
+
+    def pending_writes(self):
+        """The number of saves that are not written yet."""
+        return 0
+
     def save_mask(self, t, mask, force_original=False,centerRot=0):
         """
         Stores (or replaces if existing?) the segmentation for time t.
@@ -374,6 +637,7 @@ class DataSet:
             else:
                 mask = self._reverse_transform(t, mask)
         self._save_mask(t, mask)
+        self.cache.invalidate(t, kind="mask")
 
     def _save_green_mask(self, t, mask):
         raise NotImplementedError
@@ -388,6 +652,22 @@ class DataSet:
         if not force_original:
             mask = self._reverse_transform(t, mask)
         self._save_green_mask(t, mask)
+        self.cache.invalidate(t, kind="mask")
+
+    def save_masks(self, times, masks, green=False):
+        """
+        Stores the segmentations of several times at once, in one pass over the file and with a single invalidation of
+        the cached masks. The masks are stored as they are (no inverse transform, see reverse_transform_params).
+        :param times: time frames
+        :param masks: iterable of the corresponding masks (3D numpy arrays, see save_mask)
+        :param green: if True, the masks are merged as green masks (see save_green_mask)
+        """
+        for t, mask in zip(times, masks):
+            if green:
+                self._save_green_mask(t, mask)
+            else:
+                self._save_mask(t, mask)
+        self.cache.invalidate(kind="mask")
 
     @abc.abstractmethod
     def save_NN_mask(self, t, NN_key, mask):
@@ -410,6 +690,15 @@ class DataSet:
         """Saves the given features for segment s of time t."""
         raise NotImplementedError
 
+    @abc.abstractmethod
+    def save_features_bulk(self, segments, ftr_dicts):
+        """
+        Saves the given features for many segments at once.
+        :param segments: list of (t, s)
+        :param ftr_dicts: list of feature dicts, one for each segment in segments
+        """
+        raise NotImplementedError
+
     @abc.abstractmethod
     def assign(self, assignment_dict):
         """
@@ -493,12 +782,19 @@ class DataSet:
     @abc.abstractmethod
     def pull_NN_results(self, NetName, runname, newpath):
         """
-        Reads the NN pointdat results from h5 file named by key.
-        :param key: designates an NN run from which to get the data.
-        :return:
+        Adds to self the results of NN run NetName_runname, from the h5 file newpath written by the NN script.
+        The results may be kept in their own file rather than copied (see materialize_NN_results); newpath is no
+        longer expected to exist afterwards.
         """
         raise NotImplementedError
 
+    def materialize_NN_results(self, NN_key):
+        """
+        Copies into the data set itself the results of NN run NN_key that are kept in their own file (see
+        pull_NN_results), and deletes that file. Does nothing if they already are in the data set.
+        """
+        pass
+
     def get_method_results(self, method_name:str):
         """
         :param method_name: str, the name of the method instance (such as NN)
@@ -513,9 +809,33 @@ class DataSet:
         raise NotImplementedError
 
 
+    @abc.abstractmethod
+    def build_aligned_view(self, times=None):
+        """
+        Stores the frames of given times, transformed according to the current mode (self.align and self.crop), so
+        that get_frame does not need to transform them again. Frames whose stored view is up to date are skipped.
+        :param times: iterable of time frames (all frames if None)
+        """
+        raise NotImplementedError
+
     ####################################################################################
     # defining the transformations
 
+    def _transform_signature(self, t):
+        """
+        Identifies the transformation currently applied to frame t: the transformation mode, and a hash of the
+        transformation matrix and of the crop limits. A stored aligned view of frame t is valid iff it was built with
+        the same signature.
+        """
+        sha = hashlib.sha1()
+        if self.align:
+            transform = self.get_transformation(t)
+            if transform is not None:
+                sha.update(np.ascontiguousarray(transform, dtype=np.float64).tobytes())
+        if self.crop:
+            sha.update(np.array(self.cropper.crop_lims(), dtype=np.int64).tobytes())
+        return "align={},crop={},{}".format(int(self.align), int(self.crop), sha.hexdigest())
+
     def _transform(self, t, img, is_mask=False):
         if self.align:
             img = self.aligner.align(img, t, is_mask)
@@ -524,6 +844,22 @@ class DataSet:
         return img
 
 
+    def reverse_transform_params(self, t, centerRot=0):
+        """
+        The parameters of the reverse transformations that _reverse_transform applies at time t, as keyword arguments
+        of image_standardizer.reverse_transform_mask (which can then be applied outside of this process).
+        """
+        params = {}
+        if self.crop:
+            params["crop_lims"] = self.cropper.crop_lims()
+            params["orig_shape"] = self.cropper.orig_shape
+        if self.align:
+            if centerRot:
+                params["angle_offset"] = self.get_transfoAngle(t)
+            else:
+                params["transform"] = self.get_transformation(t)
+        return params
+
     def _reverse_transform(self, t, img,centerRot=0):
         """
         Depending on current transformation mode, applies the necessary reverse transformations to img which is assumed
@@ -77,8 +77,11 @@ class nd2Data(AnnotationData, WormReader, FeatureData, OrigFrameInfo, DataSet):
         self._ci_int = ci_int
         # TODO: be able to save this
 
-    def _get_frame(self, t, col="red"):
-        return self.get_3d_img(t=t, c=col)
+    def _get_frame(self, t, col="red", z_range=None):
+        frame = self.get_3d_img(t=t, c=col)
+        if z_range is not None:
+            frame = frame[:, :, z_range[0]:z_range[1]]
+        return frame
 
     def _get_mask(self, t=0):
         return AnnotationData.get_mask(self, t=t, force_original=True)
@@ -0,0 +1,184 @@
+import threading
+from collections import OrderedDict
+
+
+class FrameCache:
+    """
+    Size-bounded LRU cache of frames and masks read from a DataSet.
+    Keys are (kind, t, channel, transformation) tuples, see DataSet._cache_key.
+    The cache is shared between the main thread and the prefetching thread, hence the lock.
+    """
+    def __init__(self, max_bytes=512 * 2 ** 20):
+        """
+        :param max_bytes: the maximum total size of the cached arrays. 0 disables the cache.
+        """
+        self.max_bytes = max_bytes
+        self.nbytes = 0
+        self.hits = 0
+        self.misses = 0
+        # incremented at each invalidation, so that values read before an invalidation are not inserted afterwards
+        self.generation = 0
+        self._items = OrderedDict()
+        self._lock = threading.RLock()
+
+    def __contains__(self, key):
+        with self._lock:
+            return key in self._items
+
+    def __len__(self):
+        return len(self._items)
+
+    def get(self, key):
+        """
+        :return: the cached array for key (or None if absent). Counts a hit or a miss.
+        """
+        with self._lock:
+            if key not in self._items:
+                self.misses += 1
+                return None
+            self.hits += 1
+            self._items.move_to_end(key)
+            return self._items[key]
+
+    def put(self, key, value, generation=None):
+        """
+        Stores value under key, evicting the least recently used arrays if needed.
+        :param generation: if given, value is only stored if the cache has not been invalidated since self.generation
+            was equal to generation.
+        """
+        with self._lock:
+            if generation is not None and generation != self.generation:
+                return
+            if value.nbytes > self.max_bytes:
+                return
+            if key in self._items:
+                self.nbytes -= self._items.pop(key).nbytes
+            self._items[key] = value
+            self.nbytes += value.nbytes
+            while self.nbytes > self.max_bytes:
+                _, old = self._items.popitem(last=False)
+                self.nbytes -= old.nbytes
+
+    def invalidate(self, t=None, kind=None):
+        """
+        Removes the entries of time t (all times if None) and of given kind (all kinds if None).
+        """
+        with self._lock:
+            self.generation += 1
+            for key in list(self._items.keys()):
+                if (t is None or key[1] == t) and (kind is None or key[0] == kind):
+                    self.nbytes -= self._items.pop(key).nbytes
+
+    def invalidate_transformed(self, t=None):
+        """Removes the transformed entries (of time t, or of all times if None); the original ones stay valid."""
+        with self._lock:
+            self.generation += 1
+            for key in list(self._items.keys()):
+                if key[3] is not None and (t is None or key[1] == t):
+                    self.nbytes -= self._items.pop(key).nbytes
+
+    def clear(self):
+        self.invalidate()
+
+    def stats(self):
+        return {"hits": self.hits, "misses": self.misses, "items": len(self._items), "nbytes": self.nbytes}
+
+
+class Prefetcher(threading.Thread):
+    """
+    Background thread that loads the frames (and masks) around the current time frame into the cache of a DataSet,
+    closest frames first.
+    """
+    def __init__(self, data, radius):
+        """
+        :param data: instance of DataSet
+        :param radius: the frames t-radius, ..., t+radius are prefetched around the current time t
+        """
+        super().__init__(daemon=True)
+        self.data = data
+        self.radius = radius
+        self._center = None
+        self._wakeup = threading.Condition()
+        self._stopped = False
+
+    def request(self, t):
+        """Asks to prefetch around time t (replaces any previous, unfinished request)."""
+        with self._wakeup:
+            self._center = t
+            self._wakeup.notify()
+
+    def stop(self):
+        with self._wakeup:
+            self._stopped = True
+            self._wakeup.notify()
+        self.join()
+
+    def run(self):
+        while True:
+            with self._wakeup:
+                while self._center is None and not self._stopped:
+                    self._wakeup.wait()
+                if self._stopped:
+                    return
+                center, self._center = self._center, None
+            for dt in sorted(range(-self.radius, self.radius + 1), key=abs):
+                t = center + dt
+                if dt == 0 or not 0 <= t < self.data.frame_num:
+                    continue
+                with self._wakeup:
+                    if self._stopped or self._center is not None:   # the current time changed, start again
+                        break
+                try:
+                    self.data.prefetch(t)
+                except Exception:   # the file may be closing, prefetching is only best effort
+                    break
+
+
+class FrameLoader(threading.Thread):
+    """
+    Background thread that loads the frame (all channels) and mask of the time frame the GUI is going to, into the cache
+    of a DataSet, so that reading and transforming them does not block the GUI. Only the latest request is served: the
+    requests made while a frame is being read replace each other, and the frames that are not wanted anymore once read
+    are not reported.
+    """
+    def __init__(self, data, on_loaded):
+        """
+        :param data: instance of DataSet
+        :param on_loaded: function of t called (from this thread) once the frame of time t is in the cache of data
+            (or once it failed to be read, so that the error is raised when the GUI reads it)
+        """
+        super().__init__(daemon=True)
+        self.data = data
+        self.on_loaded = on_loaded
+        self._t = None
+        self._wakeup = threading.Condition()
+        self._stopped = False
+
+    def request(self, t):
+        """Asks to load time t (replaces any previous, unfinished request)."""
+        with self._wakeup:
+            self._t = t
+            self._wakeup.notify()
+
+    def stop(self):
+        with self._wakeup:
+            self._stopped = True
+            self._wakeup.notify()
+        self.join()
+
+    def run(self):
+        while True:
+            with self._wakeup:
+                while self._t is None and not self._stopped:
+                    self._wakeup.wait()
+                if self._stopped:
+                    return
+                t, self._t = self._t, None
+            try:
+                self.data.prefetch(t)
+            except Exception:   # the GUI reads the frame itself, and gets the error
+                pass
+            with self._wakeup:
+                if self._stopped or self._t is not None:   # the GUI has moved on in the meantime
+                    continue
+            self.on_loaded(t)
@@ -1,8 +1,15 @@
 from .DataSet import DataSet
 from src.parameters.parameters import ParameterInitializer
+from src.parameters.GlobalParameters import GlobalParameters
+from src.helpers.helpers import batch, parallel_process2
+from src.graphic_interface.image_standardizer import transform_frame
+from src.h5utils import codec_kwargs, file_codec, label_stats, read_label_index, write_label_index, read_direct, \
+    write_direct, storage_position, row_chunks, write_changed_rows
+from .write_queue import WriteBehindQueue
 import h5py
 import numpy as np
 import os
+import shutil
 import warnings
 from collections import defaultdict
 
@@ -10,6 +17,13 @@ from collections import defaultdict
 class h5Data(DataSet):
     def __init__(self, dataset_path=None):
         self.dataset = h5py.File(dataset_path, "r+")
+        # masks and points are saved in the background (see _save_mask, set_poindat), reads wait for pending writes
+        self._writes = WriteBehindQueue()
+        self._writes.start()
+        self._written = {}   # key -> array last written to that dataset, to only rewrite the frames that changed
+        # stacked layout: all frames in one (T,C,W,H,D) dataset "frames", all masks in one (T,W,H,D) dataset "masks"
+        # (see h5utils.to_stacked_layout); otherwise, one dataset "{t}/frame" and "{t}/mask" per time frame
+        self.stacked_layout = self.dataset.attrs.get("layout") == "stacked"
         super(h5Data, self).__init__(dataset_path)
         self.dataset.attrs["dset_path_from_GUI"] = dataset_path
         if "name" not in self.dataset.attrs:
@@ -27,8 +41,13 @@ class h5Data(DataSet):
         if "pointdat" in self.dataset:
             self.point_data = True
         if "C" not in self.dataset.attrs:   # or self.dataset.attrs["C"] is None
-            if "0/frame" in self.dataset:
+            if self.stacked_layout:
+                self.dataset.attrs["C"] = self.dataset["frames"].shape[1]   # number of channels
+            elif "0/frame" in self.dataset:
                 self.dataset.attrs["C"] = self.dataset["0/frame"].shape[0]   # number of channels
+        self._feature_rows = None   # (t, s) -> row of the feature table, read from the file when first needed
+        if "features" in self.dataset:
+            self._migrate_features()
 
     @property
     def point_data(self):
@@ -45,7 +64,7 @@ class h5Data(DataSet):
         if value:
             if "pointdat" not in self.dataset:
                 shape = (len(self.frames), self.nb_neurons+1, 3)
-                self.dataset.create_dataset("pointdat", shape, dtype="f4")
+                self.dataset.create_dataset("pointdat", shape, dtype="f4", chunks=row_chunks(shape, 4))
                 self.dataset["pointdat"][...] = np.full(shape, np.nan, dtype=np.float32)
         else:
             if "neuron_presence" not in self.dataset:
@@ -95,6 +114,19 @@ class h5Data(DataSet):
             return None
         return self.dataset.attrs["C"]
 
+    @property
+    def codec(self):
+        """The compression codec of the frames and masks (see h5utils.codec_kwargs)"""
+        return file_codec(self.dataset)
+
+    @codec.setter
+    def codec(self, value):
+        codec_kwargs(value)   # raises ValueError if the codec is unknown
+        self.dataset.attrs["codec"] = value
+
+    def _codec_kwargs(self):
+        return codec_kwargs(self.codec)
+
     @property
     def frame_shape(self):
         '''
@@ -111,11 +143,13 @@ class h5Data(DataSet):
         '''
         #the if condition is for making sure files processed by previous gui can be used
         if self.dataset.attrs["N_neurons"]==0:
+            self._wait_mask_writes()
             count=0
             neuronsNum =0
             for f in range(int(self.dataset.attrs["T"])):
-                if 'mask' in self.dataset[str(f)]:
-                    neuronsNum = np.max([len(np.unique(np.array(self.dataset[str(f)+'/mask']))),neuronsNum])
+                if self._has_mask_dset(f, "mask"):
+                    # +1 for the background, which is not in the label index
+                    neuronsNum = np.max([len(self._label_stats(f, "mask")) + 1,neuronsNum])
                     count=count+1
                     if count >4:
                         break
@@ -140,6 +174,9 @@ class h5Data(DataSet):
         pointdat[t][n] = [x,y,z] where x,y,z are the coordinates of neuron n in time frame t (neurons start
         at n>=1, 0 is for background and contains np.nans)
         """
+        pending = self._writes.pending_args(("pointdat",))
+        if pending is not None:
+            return pending[0].copy()
         return np.array(self.dataset["pointdat"])
 
     @property
@@ -148,24 +185,40 @@ class h5Data(DataSet):
         self.frame_num * (self.nb_neurons+1) array of booleans indicating presence of each neuron at each time frame
         Returns None if it is not defined (then it should be defined soon!)
         """
+        pending = self._writes.pending_args(("neuron_presence",))
+        if pending is not None:
+            return pending[0].copy()
         if "neuron_presence" not in self.dataset:
             return None
         return np.array(self.dataset["neuron_presence"])
 
     @neuron_presence.setter
     def neuron_presence(self, value):
+        # written by the background thread, only the frames that changed since the last save
+        self._writes.put(("neuron_presence",), self._write_neuron_presence, np.array(value, dtype=bool))
+
+    def _write_neuron_presence(self, value):
         key = "neuron_presence"
         if key not in self.dataset:
-            self.dataset.create_dataset(key, (self.frame_num, self.nb_neurons + 1), dtype=bool,
-                                        maxshape=(None, None))
+            self.dataset.create_dataset(key, value.shape, dtype=bool, maxshape=(None, None),
+                                        chunks=row_chunks(value.shape, 1))
         elif self.dataset[key].shape != value.shape:
             try:
                 self.dataset[key].resize(value.shape)
-            except RuntimeError:   # cannot resize because maxshape was given at creation (can happen with older datasets)
+            except (RuntimeError, TypeError):   # cannot resize because maxshape was not given at creation (can happen with older datasets)
                 del self.dataset[key]
-                self.dataset.create_dataset(key, (self.frame_num, self.nb_neurons + 1), dtype=bool,
-                                            maxshape=(None, None))
-        self.dataset[key][...] = value
+                self.dataset.create_dataset(key, value.shape, dtype=bool, maxshape=(None, None),
+                                            chunks=row_chunks(value.shape, 1))
+            self._written.pop(key, None)
+        self._write_rows(key, value)
+
+    def _write_rows(self, key, value):
+        """Writes value into the dataset key, only rewriting the time frames that changed since the last write."""
+        old = self._written.get(key)
+        if old is None:
+            old = self.dataset[key][...]
+        write_changed_rows(self.dataset[key], value, old)
+        self._written[key] = value
 
     @property
     def frame_num(self):
@@ -181,15 +234,32 @@ class h5Data(DataSet):
 
     @property
     def ca_act(self):
+        self._writes.flush(("ca_act",))
         if "ci_int" not in self.dataset:
             return None
         return np.array(self.dataset["ci_int"])
 
     def close(self):
+        self._writes.stop()
+        self.stop_prefetch()
         self.dataset.close()
 
     def save(self):
-        pass
+        self.flush()
+
+    def flush(self):
+        self._writes.flush()
+
+    def pending_writes(self):
+        return self._writes.depth()
+
+    def _wait_mask_writes(self, t=None):
+        """Waits until the masks of time t (of all times if None) saved in the background are written."""
+        if t is None:
+            self._writes.flush()
+        else:
+            self._writes.flush(*[(kind, t, mask_key) for kind in ("mask", "green_mask")
+                                 for mask_key in ("mask", "coarse_mask")])
 
     @classmethod
     def _create_dataset(cls, dataset_path):
@@ -207,10 +277,13 @@ class h5Data(DataSet):
 
     def segmented_times(self, force_regular_seg=False):
         # Todo: for Harvard lab data, should it filter and return only frames with pointdat?
+        self._wait_mask_writes()
         if self.coarse_seg_mode and not force_regular_seg:
             mask_key = "coarse_mask"
         else:
             mask_key = "mask"
+        if self.stacked_layout and mask_key == "mask":
+            return [int(t) for t in np.flatnonzero(self.dataset["mask_present"])]
         return [t for t in self.frames if str(t) + "/{}".format(mask_key) in self.dataset]
 
     def ground_truth_frames(self):
@@ -228,12 +301,142 @@ class h5Data(DataSet):
     ####################################################################################
     # reading the data
 
-    def _get_frame(self, t, col="red"):
+    def _get_frame(self, t, col="red", z_range=None):
         '''
-        The frame
+        The frame. Only the hyperslab of the requested channel (and z-planes) is read from the file, with
+        h5utils.read_direct so that several threads can read frames in parallel (see get_frames).
         :param t: Integer, the time
+        :param col: "red" or "green", the channel
+        :param z_range: None or (z_start, z_end), the z-planes to read
         '''
-        return np.array(self.dataset[str(t) + "/frame"])[0 if col == "red" else 1]
+        channel = 0 if col == "red" else 1
+        if self.stacked_layout:
+            dset, index = self.dataset["frames"], (t, channel)
+        else:
+            dset, index = self.dataset[str(t) + "/frame"], (channel,)
+        if z_range is None:
+            return read_direct(dset, index)
+        return read_direct(dset, index + (slice(None), slice(None), slice(z_range[0], z_range[1])))
+
+    def _get_full_frame(self, t):
+        """The original frame of time t, all channels: (C,W,H,D) array."""
+        if self.stacked_layout:
+            return read_direct(self.dataset["frames"], (t,))
+        return read_direct(self.dataset[str(t) + "/frame"])
+
+    def _read_position(self, kind, t):
+        if self.stacked_layout and kind in ("frame", "mask"):
+            return t   # the chunks of a stacked dataset are stored in time order
+        key = "{}/{}".format(t, "frame" if kind == "frame" else ("coarse_mask" if self.coarse_seg_mode else "mask"))
+        if key not in self.dataset:
+            return 0
+        return storage_position(self.dataset[key])
+
+    def _has_mask_dset(self, t, mask_key):
+        """Whether the mask mask_key ("mask", "seg", "coarse_mask"...) exists for time t."""
+        if self.stacked_layout and mask_key == "mask":
+            return t < len(self.dataset["mask_present"]) and bool(self.dataset["mask_present"][t])
+        return str(t) + "/{}".format(mask_key) in self.dataset
+
+    def _read_mask_dset(self, t, mask_key):
+        """Reads the (existing) mask mask_key of time t."""
+        if self.stacked_layout and mask_key == "mask":
+            return self.dataset["masks"][t]
+        return np.array(self.dataset[str(t) + "/{}".format(mask_key)])
+
+    def _write_mask_dset(self, t, mask_key, mask, replace=False):
+        """
+        Writes mask as the mask mask_key of time t.
+        :param replace: if True, an existing per-frame dataset is deleted and re-created instead of overwritten
+        """
+        if mask_key in ("mask", "coarse_mask"):
+            write_label_index(self.dataset, mask_key, t, mask)
+        if self.stacked_layout and mask_key == "mask":
+            if t >= len(self.dataset["masks"]):
+                self.dataset["masks"].resize(t + 1, axis=0)
+                self.dataset["mask_present"].resize(t + 1, axis=0)
+            self.dataset["masks"][t] = mask.astype(np.int16)
+            self.dataset["mask_present"][t] = True
+            return
+        key = str(t) + "/{}".format(mask_key)
+        if replace and key in self.dataset:
+            del self.dataset[key]
+        if key not in self.dataset:
+            self.dataset.create_dataset(key, mask.shape, dtype="i2", **self._codec_kwargs())
+        write_direct(self.dataset[key], mask)
+
+    def _label_stats(self, t, mask_key):
+        """
+        The label index of the (existing) mask mask_key of time t, see h5utils.label_stats.
+        Masks written before the index existed are indexed on first access.
+        """
+        stats = read_label_index(self.dataset, mask_key, t)
+        if stats is None:
+            if mask_key.startswith("net/"):
+                mask = np.array(self.dataset["{}/{}/predmask".format(mask_key, t)])
+            else:
+                mask = self._read_mask_dset(t, mask_key)
+            write_label_index(self.dataset, mask_key, t, mask)
+            stats = label_stats(mask)
+        return stats
+
+    def _drop_label_index(self, kind):
+        """Deletes the label index of all masks of given kind (e.g. "net/<NN key>"), when they were replaced."""
+        if "label_index/" + kind in self.dataset:
+            del self.dataset["label_index/" + kind]
+
+    def get_label_stats(self, t, NN_key=None):
+        if NN_key is not None:
+            self._writes.flush(("NN_mask", NN_key, t))
+            if "net/{}/{}/predmask".format(NN_key, t) not in self.dataset:
+                return None
+            return self._label_stats(t, "net/" + NN_key)
+        mask_key = "coarse_mask" if self.coarse_seg_mode else "mask"
+        self._wait_mask_writes(t)
+        if not self._has_mask_dset(t, mask_key):
+            return None
+        return self._label_stats(t, mask_key)
+
+    def _aligned_view_signature(self, t):
+        key = str(t) + "/aligned_frame"
+        if key not in self.dataset:
+            return None
+        return self.dataset[key].attrs["signature"]
+
+    def _get_aligned_frame(self, t, col="red", z_range=None):
+        channel = 0 if col == "red" else 1
+        dset = self.dataset[str(t) + "/aligned_frame"]
+        if z_range is None:
+            return read_direct(dset, (channel,))
+        return read_direct(dset, (channel, slice(None), slice(None), slice(z_range[0], z_range[1])))
+
+    def _stored_mip(self, t):
+        self._writes.flush(("mip", t))
+        key = str(t) + "/mip"
+        if key not in self.dataset or self.dataset[key].attrs["signature"] != self._transform_signature(t):
+            return None
+        return read_direct(self.dataset[key]), np.array(self.dataset[key].attrs["means"])
+
+    def _store_mip(self, t, mips, means):
+        self._writes.put(("mip", t), self._write_mip, t, mips.astype(np.int16), means, self._transform_signature(t))
+
+    def _write_mip(self, t, mips, means, signature):
+        # "{t}/mip" is a group in the stacked layout too, like "{t}/aligned_frame"
+        key = str(t) + "/mip"
+        if key in self.dataset and self.dataset[key].shape != mips.shape:
+            del self.dataset[key]
+        if key not in self.dataset:
+            self.dataset.create_dataset(key, mips.shape, dtype="i2", **self._codec_kwargs())
+        write_direct(self.dataset[key], mips)
+        self.dataset[key].attrs["means"] = means
+        self.dataset[key].attrs["signature"] = signature
+
+    def _drop_mip(self, t):
+        """Deletes the stored projections of frame t, which are outdated once the original frame changes."""
+        self._writes.flush(("mip", t))
+        key = str(t) + "/mip"
+        if key in self.dataset:
+            del self.dataset[key]
 
     def _get_mask(self, t):
         '''
@@ -244,13 +447,27 @@ class h5Data(DataSet):
             mask_key = "coarse_mask"
         else:
             mask_key = "mask"
-        key = str(t) + "/{}".format((mask_key))
-        if key not in self.dataset:
+        pending = self._pending_mask(t, mask_key)
+        if pending is not None:
+            return pending
+        if not self._has_mask_dset(t, mask_key):
             return False
-        return np.array(self.dataset[key])
+        return self._read_mask_dset(t, mask_key)
+
+    def _pending_mask(self, t, mask_key):
+        """
+        The mask mask_key of time t saved by _save_mask and not written yet, None if there is none. A pending green
+        mask is written first, since it is merged with the mask in the file.
+        """
+        self._writes.flush(("green_mask", t, mask_key))
+        pending = self._writes.pending_args(("mask", t, mask_key))
+        return None if pending is None else pending[-1]
 
     def get_NN_mask(self, t, NN_key):
         # No transform is applied because the mask is saved with the transforation already applied.
+        pending = self._writes.pending_args(("NN_mask", NN_key, t))
+        if pending is not None:
+            return pending[-1].copy()
         knn = f"net/{NN_key}/{t}/predmask"
         if knn not in self.dataset:
             return False
@@ -283,6 +500,7 @@ class h5Data(DataSet):
                 seg_key = "coarse_seg"
             else:
                 seg_key = "seg"
+        self._wait_mask_writes(t)
         skey = str(t) + "/{}".format(seg_key)
         if not skey in self.dataset.keys():
             print("segmentation not found for this frame ")#MB added to extract the troubling frame
@@ -324,7 +542,9 @@ class h5Data(DataSet):
         print('id features: '+str(filt))
 
         print(segs)
-        features = np.vstack([np.array(self.dataset["features/{}/{}".format(t, s)])[filt] for t, s in segs])
+        rows = self._feature_index()
+        features = self.dataset["feature_table/values"][...]
+        features = features[[rows[(int(t), int(s))] for t, s in segs]][:, filt]
         # Sanity check in case where the feature column becomes sparse (very few objects or variation present)
         feature_is_sparse = np.sum(np.isnan(features), axis=0) > (0.5 * features.shape[0])
         if any(feature_is_sparse):
@@ -444,12 +664,53 @@ class h5Data(DataSet):
     # editing the data
 
     def replace_frame(self, t, img_red, img_green):
-        old_img = np.array(self.dataset[str(t) + "/frame"], dtype=np.int16)
-        self.dataset[str(t) + "/frame"][...] = np.stack([img_red, img_green]).astype(np.int16)
+        old_img = self._get_full_frame(t).astype(np.int16)
+        new_img = np.stack([img_red, img_green]).astype(np.int16)
+        if self.stacked_layout:
+            self.dataset["frames"][t] = new_img
+        else:
+            self.dataset[str(t) + "/frame"][...] = new_img
         orig_key = str(t) + "/oriframe"
         if orig_key not in self.dataset:
-            self.dataset.create_dataset(orig_key, old_img.shape, dtype="i2", compression="gzip")
+            self.dataset.create_dataset(orig_key, old_img.shape, dtype="i2", chunks=self._frame_chunks(old_img.shape),
+                                        **self._codec_kwargs())
         self.dataset[orig_key][...] = old_img
+        self._drop_aligned_view(t)
+        self._drop_mip(t)
+        for kind in ("frame", "mip", "mip_mean"):
+            self.cache.invalidate(t, kind=kind)
+
+    @staticmethod
+    def _frame_chunks(shape):
+        """
+        Chunk shape for a (C,W,H,D) frame dataset: one channel and one z-plane per chunk, so that reading a single
+        channel or a few z-planes only decompresses the chunks that are needed.
+        """
+        return (1, shape[1], shape[2], 1)
+
+    def build_aligned_view(self, times=None):
+        if times is None:
+            times = self.frames
+        crop_lims = self.cropper.crop_lims() if self.crop else None
+        todo = [t for t in times if self._aligned_view_signature(t) != self._transform_signature(t)]
+        # only a few frames per process are held in memory at once
+        for times_batch in batch(todo, n=2 * (GlobalParameters.n_processes or 8)):
+            args = [(self._get_full_frame(t), self.get_transformation(t) if self.align else None,
+                     crop_lims) for t in times_batch]
+            aligned_frames = parallel_process2(args, transform_frame)
+            for t, frame in zip(times_batch, aligned_frames):
+                key = str(t) + "/aligned_frame"
+                if key in self.dataset:
+                    del self.dataset[key]
+                self.dataset.create_dataset(key, data=frame.astype(np.int16), chunks=self._frame_chunks(frame.shape),
+                                            **self._codec_kwargs())
+                self.dataset[key].attrs["signature"] = self._transform_signature(t)
+
+    def _drop_aligned_view(self, t):
+        """Deletes the stored aligned view of frame t, which is outdated once the original frame changes."""
+        key = str(t) + "/aligned_frame"
+        if key in self.dataset:
+            del self.dataset[key]
 
     def _save_frame(self, t, frameR,frameG=0, mask=0):#MB added
         '''
@@ -461,6 +722,7 @@ class h5Data(DataSet):
         '''
         if self.point_data and np.any(mask):
             raise ValueError("Masks and point data would interfere.")
+        self._wait_mask_writes(t)
         # update the number of frames if necessary
         if "T" not in self.dataset.attrs or t >= self.frame_num:
             self.dataset.attrs["T"] = t + 1
@@ -487,12 +749,21 @@ class h5Data(DataSet):
             frameTot[1] = frameG
         else:
             frameTot[0] = frameR
-        if fkey not in self.dataset:
-            self.dataset.create_dataset(fkey, frameTot.shape, dtype="i2", compression="gzip")
+        self._drop_aligned_view(t)
+        if self.stacked_layout:
+            frames = self.dataset["frames"]
+            if frameTot.shape != frames.shape[1:]:
+                raise ValueError("Frame of shape {} cannot be stored in a movie of frames of shape {}."
+                                 .format(frameTot.shape, frames.shape[1:]))
+            if t >= len(frames):
+                frames.resize(t + 1, axis=0)
+            frames[t] = frameTot.astype(np.int16)
         else:
-            del self.dataset[fkey]
-            self.dataset.create_dataset(fkey, frameTot.shape,  dtype="i2", compression="gzip")
-        self.dataset[fkey][...] = frameTot.astype(np.int16)
+            if fkey in self.dataset:
+                del self.dataset[fkey]
+            self.dataset.create_dataset(fkey, frameTot.shape, dtype="i2", chunks=self._frame_chunks(frameTot.shape),
+                                        **self._codec_kwargs())
+            self.dataset[fkey][...] = frameTot.astype(np.int16)
         self.dataset.attrs["W"] = SizeR[0]
         self.dataset.attrs["H"] = SizeR[1]
         self.dataset.attrs["D"] = SizeR[2]
@@ -504,13 +775,8 @@ class h5Data(DataSet):
             else:
                 mask_key = "mask"
                 seg_key = "seg"
-            mkey = str(t) + "/{}".format(mask_key)
-            skey = str(t) + "/{}".format(seg_key)
-            for key in (mkey, skey):
-                if key in self.dataset:
-                    del self.dataset[key]
-                self.dataset.create_dataset(key, mask.shape,  dtype="i2", compression="gzip")
-                self.dataset[key][...] = mask.astype(np.int16)
+            for key in (mask_key, seg_key):
+                self._write_mask_dset(t, key, mask, replace=True)
 
     def _save_mask(self, t, mask):
         '''
@@ -529,12 +795,13 @@ class h5Data(DataSet):
         else:
             mask_key = "mask"
             seg_key = "seg"
-        mkey = str(t) + "/{}".format(mask_key)
-        skey = str(t) + "/{}".format(seg_key)
-        for key in (mkey, skey):
-            if key not in self.dataset:
-                self.dataset.create_dataset(key, mask.shape, dtype="i2", compression="gzip")
-            self.dataset[key][...] = mask.astype(np.int16)
+        # compressed and written by the background thread; a later save of the same mask replaces this one
+        self._writes.put(("mask", t, mask_key), self._write_masks, t, (mask_key, seg_key),
+                         np.array(mask, dtype=np.int16))
+
+    def _write_masks(self, t, keys, mask):
+        for key in keys:
+            self._write_mask_dset(t, key, mask)
 
     def _save_green_mask(self, t, mask):
         '''
@@ -555,32 +822,38 @@ class h5Data(DataSet):
         else:
             mask_key = "mask"
             seg_key = "seg"
-        mkey = str(t) + "/{}".format(mask_key)
-        skey = str(t) + "/{}".format(seg_key)
-        for key in (mkey, skey):
-            if key not in self.dataset:
-                self.dataset.create_dataset(key, mask.shape, dtype="i2", compression="gzip")
-                self.dataset[key][...] = mask.astype(np.int16)
+        self._writes.put(("green_mask", t, mask_key), self._write_green_masks, t, (mask_key, seg_key),
+                         np.array(mask, dtype=np.int16))
+
+    def _write_green_masks(self, t, keys, mask):
+        for key in keys:
+            if not self._has_mask_dset(t, key):
+                self._write_mask_dset(t, key, mask)
             else:
-                maskRed = self.dataset[key][...]
+                maskRed = self._read_mask_dset(t, key)
                 maskRed[maskRed==0] = mask[maskRed==0]
-                self.dataset[key][...] = maskRed.astype(np.int16)
+                self._write_mask_dset(t, key, maskRed)
 
     def save_NN_mask(self, t, NN_key, mask):
         # The mask is saved with the transforation already applied.
+        self._writes.put(("NN_mask", NN_key, t), self._write_NN_mask, t, NN_key, np.array(mask, dtype=np.int16))
+
+    def _write_NN_mask(self, t, NN_key, mask):
         knn = f"net/{NN_key}/{t}/predmask"
+        write_label_index(self.dataset, "net/" + NN_key, t, mask)
         if knn not in self.dataset:
-            self.dataset.create_dataset(knn, mask.shape, dtype="i2", compression="gzip")
-        self.dataset[knn][...] = mask.astype(np.int16)
+            self.dataset.create_dataset(knn, mask.shape, dtype="i2", **self._codec_kwargs())
+        write_direct(self.dataset[knn], mask)
 
     def import_external_NN(self,Extfile,name):
+        self._writes.flush()
         if not 'net' in self.dataset:
             group = self.dataset.create_group('net')
         else:
             group  = self.dataset['net']
-        if name in self.dataset:
-            del self.dataset[name]    
+        self._remove_NN_results(name)
         Extfile.dataset.copy(name, group)
+        self._drop_label_index(name)
 
 
     def flag_as_gt(self, frames):
@@ -590,12 +863,85 @@ class h5Data(DataSet):
             self.dataset.attrs["ground_truth"] = np.hstack([self.dataset.attrs["ground_truth"], frames])
 
     def save_features(self, t, s, ftr_dict):
-        key = "features/{}/{}".format(t,s)
-        list = self._feature_dict_to_array(ftr_dict)
-        if key in self.dataset:
-            del self.dataset[key]
-        self.dataset.create_dataset(key, (len(list),),dtype="float", compression="gzip")   # Todo: choose dtype?
-        self.dataset[key][...] = list
+        self.save_features_bulk([(t, s)], [ftr_dict])
+
+    def save_features_bulk(self, segments, ftr_dicts):
+        if not len(segments):
+            return
+        values = np.array([self._feature_dict_to_array(ftr_dict) for ftr_dict in ftr_dicts], dtype=float)
+        self._write_feature_rows(segments, values, columns=list(ftr_dicts[0].keys()))
+
+    def _feature_index(self):
+        """The dict (t, s) -> row of segment s of time t in the feature table."""
+        if self._feature_rows is None:
+            self._feature_rows = {}
+            if "feature_table" in self.dataset:
+                for row, (t, s) in enumerate(self.dataset["feature_table/index"][...]):
+                    self._feature_rows[(int(t), int(s))] = row
+        return self._feature_rows
+
+    def _write_feature_rows(self, segments, values, columns=None):
+        """
+        Writes the features of given segments into the feature table "feature_table": one row per (t, s), the segment
+        of each row in "feature_table/index" and its features in "feature_table/values".
+        Rows of segments already in the table are overwritten, the others are appended.
+        :param segments: list of (t, s)
+        :param values: len(segments) * nb_features array
+        :param columns: the names of the features
+        """
+        rows = self._feature_index()
+        if "feature_table" not in self.dataset:
+            group = self.dataset.create_group("feature_table")
+            group.create_dataset("index", (0, 2), dtype="i4", maxshape=(None, 2), chunks=(4096, 2))
+            group.create_dataset("values", (0, values.shape[1]), dtype="float", maxshape=(None, values.shape[1]),
+                                 chunks=(4096, values.shape[1]), compression="gzip")
+            if columns is not None:
+                group.attrs["columns"] = columns
+        index_dset = self.dataset["feature_table/index"]
+        values_dset = self.dataset["feature_table/values"]
+        if values.shape[1] != values_dset.shape[1]:
+            raise ValueError("Got {} features per segment, but the feature table has {}."
+                             .format(values.shape[1], values_dset.shape[1]))
+        latest = dict(zip([(int(t), int(s)) for t, s in segments], values))   # the last values of each segment
+        segments, values = list(latest.keys()), np.array(list(latest.values()))
+        n_rows = len(index_dset)
+        new_segments = []
+        for seg in segments:
+            if seg not in rows:
+                rows[seg] = n_rows + len(new_segments)
+                new_segments.append(seg)
+        if new_segments:
+            index_dset.resize(len(rows), axis=0)
+            values_dset.resize(len(rows), axis=0)
+            index_dset[n_rows:] = np.array(new_segments)
+        positions = np.array([rows[seg] for seg in segments])
+        # the appended rows are written as one slice, the overwritten ones by patching the slice that contains them
+        appended = positions >= n_rows
+        if appended.any():
+            values_dset[n_rows:] = values[appended][np.argsort(positions[appended])]
+        if not appended.all():
+            start, stop = positions[~appended].min(), positions[~appended].max() + 1
+            block = values_dset[start:stop]
+            block[positions[~appended] - start] = values[~appended]
+            values_dset[start:stop] = block
+
+    def _migrate_features(self):
+        """
+        Moves the features of the older layout (one dataset "features/{t}/{s}" per segment) into the feature table.
+        Writing the same rows again is harmless, so an interrupted migration is simply redone at the next opening.
+        """
+        segments, values = [], []
+        for t, group in self.dataset["features"].items():
+            for s, dset in group.items():
+                segments.append((int(t), int(s)))
+                values.append(np.array(dset))
+        if segments:
+            nb_features = max(len(v) for v in values)
+            table = np.full((len(segments), nb_features), np.nan)
+            for row, v in enumerate(values):
+                table[row, :len(v)] = v
+            self._write_feature_rows(segments, table)
+        del self.dataset["features"]
 
     @classmethod
     def _feature_dict_to_array(cls, ftr_dict):
@@ -637,8 +983,9 @@ class h5Data(DataSet):
                 mask_key = "coarse_mask"
             else:
                 mask_key = "mask"
-            key = str(t) + "/{}".format(mask_key)
-            self.dataset[key][...] = mask.astype(np.int16)
+            # queued like the other saves of this mask, so that an older save still pending does not overwrite it
+            self._writes.put(("mask", t, mask_key), self._write_masks, t, (mask_key,), np.array(mask, dtype=np.int16))
+            self.cache.invalidate(t, kind="mask")
 
     def save_transformation_matrix(self, t, matrix,trans_mode=0):
         if trans_mode==0:
@@ -656,6 +1003,7 @@ class h5Data(DataSet):
                 del self.dataset[key+'/offset']
             self.dataset.create_dataset(key+'/angle', data=matrix[0])
             self.dataset.create_dataset(key+'/offset', data=matrix[1:])
+        self.cache.invalidate_transformed(t)
 
     def save_ref(self, t, ref):
         if "ref_frames" not in self.dataset:
@@ -669,6 +1017,7 @@ class h5Data(DataSet):
 
     def save_ROI_params(self, xleft, xright, yleft, yright):
         self.dataset.attrs["ROI"] = [xleft, xright, yleft, yright]
+        self.cache.invalidate_transformed()
 
     def save_frame_match(self, orig, new):
         group_key = "original_match"
@@ -720,9 +1069,13 @@ class h5Data(DataSet):
         elif not self.point_data:
             raise ValueError("Masks and point data would interfere.")
 
-        self.dataset["pointdat"][...] = pointdat.astype(np.float32)
+        self._writes.put(("pointdat",), self._write_pointdat, pointdat.astype(np.float32))
         # TODO: deal with changing nb of neurons
 
+    def _write_pointdat(self, pointdat):
+        # only the frames edited since the last save are written
+        self._write_rows("pointdat", pointdat)
+
     def set_NN_pointdat(self, key):
         '''
         set NN pointdat
@@ -735,20 +1088,66 @@ class h5Data(DataSet):
             self.dataset.create_dataset("NN_pointdat", nn_dset.shape, dtype="f4")
         self.dataset["NN_pointdat"][...] = nn_dset
 
+    def _NN_results_path(self, NN_key):
+        """Where the results of NN run NN_key are kept when they are not in the data set file (see pull_NN_results)."""
+        return os.path.splitext(self.dataset.filename)[0] + "_NN", NN_key + ".h5"
+
+    def _is_mounted(self, identifier):
+        return identifier in self.dataset and isinstance(self.dataset.get(identifier, getlink=True), h5py.ExternalLink)
+
+    def _remove_NN_results(self, identifier):
+        """Deletes the results identifier ("net/<NN key>"), and their file if they are mounted."""
+        if self._is_mounted(identifier):
+            link = self.dataset.get(identifier, getlink=True)
+            del self.dataset[identifier]
+            fn = os.path.join(os.path.dirname(self.dataset.filename), link.filename)
+            if os.path.exists(fn):
+                os.remove(fn)
+        elif identifier in self.dataset:
+            del self.dataset[identifier]
+
     # TODO: make sure results are correctly accessed, including for masks.
     def pull_NN_results(self, NetName, runname, newpath):
+        """
+        The results of the run are not copied into the data set file: the file newpath (the NN snapshot, see
+        h5utils.nn_snapshot, whose frames file has been deleted) is moved next to the data set file and mounted as
+        "net/<NetName>_<runname>" with an external link, so that pulling is immediate whatever the size of the results.
+        They can be copied into the data set file later with materialize_NN_results.
+        """
         if self.point_data is None:
             self.point_data = True
         elif not self.point_data:
             raise ValueError("Masks and point data would interfere.")
-        identifier = "net/" + NetName + "_" + runname
-        del self.dataset[identifier]
+        NN_key = NetName + "_" + runname
+        identifier = "net/" + NN_key
+        self._writes.flush()
+        self._remove_NN_results(identifier)
+        dirname, fn = self._NN_results_path(NN_key)
+        os.makedirs(dirname, exist_ok=True)
+        shutil.move(newpath, os.path.join(dirname, fn))
+        with h5py.File(os.path.join(dirname, fn), "r+") as h5net:
+            # the links to the frames and previous runs of the snapshot, whose file is gone
+            for key in list(h5net.keys()) + ["net/" + key for key in h5net.get("net", {})]:
+                if isinstance(h5net.get(key, getlink=True), h5py.ExternalLink):
+                    del h5net[key]
         if "net" not in self.dataset.keys():
             self.dataset.create_group("net")
-        h5net = h5py.File(newpath, "r")
-        h5net.copy(identifier, self.dataset["net"])
-        h5net.close()
-        print("Merging Training results of ", NetName+"_"+runname, " into ", self.name)
+        self.dataset["net"][NN_key] = h5py.ExternalLink(os.path.join(os.path.basename(dirname), fn), "/" + identifier)
+        self._drop_label_index(identifier)
+        print("Merging Training results of ", NN_key, " into ", self.name)
+
+    def materialize_NN_results(self, NN_key):
+        identifier = "net/" + NN_key
+        self._writes.flush()
+        if not self._is_mounted(identifier):
+            return
+        tmp_key = NN_key + "_materializing"
+        if tmp_key in self.dataset["net"]:
+            del self.dataset["net"][tmp_key]
+        self.dataset.copy(self.dataset[identifier], self.dataset["net"], name=tmp_key)
+        self._remove_NN_results(identifier)
+        self.dataset.move("net/" + tmp_key, identifier)
+        print("Copied the results of ", NN_key, " into ", self.name)
 
     def get_method_results(self, method_name):
         key = "helper_" + method_name
@@ -771,7 +1170,15 @@ class h5Data(DataSet):
         neurons, the second is frames.
         """
         assert (self.nb_neurons==ca_activity.shape[0]) and (len(self.frames)==ca_activity.shape[1]),"ci_int Shape mismatch"
-        if "ci_int" in self.dataset:
-            del self.dataset["ci_int"]
-        self.dataset.create_dataset("ci_int", shape=ca_activity.shape, dtype="f4", compression="gzip")
-        self.dataset["ci_int"][...] = ca_activity
+        # written by the background thread, only the neurons whose activity changed since the last save
+        self._writes.put(("ca_act",), self._write_ca_act, np.array(ca_activity, dtype=np.float32))
+
+    def _write_ca_act(self, ca_activity):
+        key = "ci_int"
+        if key in self.dataset and self.dataset[key].shape != ca_activity.shape:
+            del self.dataset[key]
+            self._written.pop(key, None)
+        if key not in self.dataset:
+            self.dataset.create_dataset(key, shape=ca_activity.shape, dtype="f4", compression="gzip",
+                                        chunks=row_chunks(ca_activity.shape, 4))
+        self._write_rows(key, ca_activity)
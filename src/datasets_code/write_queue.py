@@ -0,0 +1,104 @@
+import atexit
+import threading
+from collections import OrderedDict
+
+
+class WriteBehindQueue(threading.Thread):
+    """
+    Background thread that performs the writes of a DataSet (masks, points...) in the order in which they were
+    enqueued, so that saving returns immediately.
+    Writes are identified by a key (e.g. ("mask", t, "mask")): enqueuing a write whose key is still pending replaces it,
+    only the last one is performed.
+    All pending writes are performed before the interpreter exits normally.
+    """
+    def __init__(self, max_depth=32):
+        """
+        :param max_depth: enqueuing blocks while that many writes are pending (bounds the memory held by the queue)
+        """
+        super().__init__(daemon=True)
+        self.max_depth = max_depth
+        self._pending = OrderedDict()   # key -> (function, args)
+        self._running = None   # (key, args) of the write being performed
+        self._error = None
+        self._cond = threading.Condition()
+        self._stopped = False
+        atexit.register(self.stop)
+
+    def put(self, key, fun, *args):
+        """Enqueues fun(*args), replacing the pending write of the same key if any."""
+        with self._cond:
+            self._cond.wait_for(lambda: len(self._pending) < self.max_depth or key in self._pending
+                                or self._error is not None)
+            if self._error is not None:
+                self._raise_error()
+            self._pending.pop(key, None)
+            self._pending[key] = (fun, args)
+            self._cond.notify_all()
+
+    def depth(self):
+        """The number of writes that are pending or being performed."""
+        with self._cond:
+            return len(self._pending) + (self._running is not None)
+
+    def pending_args(self, key):
+        """The arguments of the write of given key if it is pending or being performed, None otherwise."""
+        with self._cond:
+            if key in self._pending:
+                return self._pending[key][1]
+            if self._running is not None and self._running[0] == key:
+                return self._running[1]
+            return None
+
+    def flush(self, *keys):
+        """
+        Waits until the pending writes (or only the writes of given keys) are performed.
+        Raises the exception of a failed write, if any.
+        """
+        def done():
+            if self._error is not None:
+                return True
+            if not keys:
+                return not self._pending and self._running is None
+            return not any(key in self._pending or (self._running is not None and self._running[0] == key)
+                           for key in keys)
+        with self._cond:
+            self._cond.wait_for(done)
+            if self._error is not None:
+                self._raise_error()
+
+    def stop(self):
+        """Performs the pending writes then stops the thread."""
+        if self._stopped:
+            return
+        try:
+            self.flush()
+        finally:
+            with self._cond:
+                self._stopped = True
+                self._cond.notify_all()
+            if self.is_alive():
+                self.join()
+            atexit.unregister(self.stop)
+
+    def _raise_error(self):
+        error, self._error = self._error, None
+        raise RuntimeError("A background write failed, the pending writes were discarded") from error
+
+    def run(self):
+        while True:
+            with self._cond:
+                self._cond.wait_for(lambda: self._pending or self._stopped)
+                if not self._pending:   # stopped
+                    return
+                key, (fun, args) = self._pending.popitem(last=False)
+                self._running = (key, args)
+            try:
+                fun(*args)
+            except Exception as error:
+                with self._cond:
+                    self._error = error
+                    self._pending.clear()
+            finally:
+                with self._cond:
+                    self._running = None
+                    self._cond.notify_all()
@@ -3,7 +3,7 @@ from . import gui_elements_plots as plots
 from . import gui_elements_controls as controls
 from . import image_rendering
 from PyQt5.QtWidgets import *
-from PyQt5 import QtGui
+from PyQt5 import QtGui, QtCore
 
 from ..helpers import QtHelpers
 
@@ -18,6 +18,7 @@ class gui(QMainWindow):
         super().__init__()
         self.controller = controller
         self.controller.freeze_registered_clients.append(self)
+        self.controller.repack_registered_clients.append(self)
         self.settings = settings
 
         self.setWindowTitle("Targettrack")
@@ -140,6 +141,13 @@ class gui(QMainWindow):
 
         self.centralWidget.setLayout(tracking_grid)
 
+        # number of saves that are still being written in the background (see h5Data)
+        self.write_status = QLabel()
+        self.statusBar().addPermanentWidget(self.write_status)
+        self.write_status_timer = QtCore.QTimer(self)
+        self.write_status_timer.timeout.connect(self._show_pending_writes)
+        self.write_status_timer.start(500)
+
 
 
         # these work wherever the mouse is, this is to move between times
@@ -159,6 +167,16 @@ class gui(QMainWindow):
         self.eventbucket['x']=QShortcut(QKeySequence('x'), self)
         self.eventbucket['x'].activated.connect(lambda:self.activate_rotate(abort=True))
 
+    def _show_pending_writes(self):
+        n_pending = self.controller.pending_writes()
+        self.write_status.setText("Writing {} save(s)...".format(n_pending) if n_pending else "All changes written")
+
+    def change_repack_status(self, running, ok=True):
+        if running:
+            self.statusBar().showMessage("Repacking the data set in the background...")
+        else:
+            self.statusBar().showMessage("Data set repacked" if ok else "Repacking failed (see the console)", 10000)
+
     def _make_move_relative(self, nb):
         def fun():
             self.controller.move_relative_time(nb)
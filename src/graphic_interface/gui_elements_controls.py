@@ -914,6 +914,12 @@ class NNControlTab(QScrollArea):
             main_layout.addWidget(approve_mask,row, 0,1, 2)
             row += 1
 
+            # the results of NN runs are kept in their own file until copied into the data set file
+            materialize_mask = QPushButton("Store NN masks in file")
+            materialize_mask.clicked.connect(self.controller.materialize_NN_masks)
+            main_layout.addWidget(materialize_mask, row, 0, 1, 2)
+            row += 1
+
             # MB added: to get the validation frames ids:
             #CFP: made this conditional to masks
             val_frame_box = QtHelpers.CollapsibleBox("Validation frames id:")  # MB added
@@ -1341,6 +1347,9 @@ class MaskProcessingTab(QScrollArea):
         crop_btn = QPushButton("Crop")
         crop_btn.clicked.connect(self.controller.define_crop_region)
         main_layout.addWidget(crop_btn)
+        aligned_btn = QPushButton("Store aligned frames")
+        aligned_btn.clicked.connect(self.controller.store_aligned_frames)
+        main_layout.addWidget(aligned_btn)
 
         wid = QWidget()
         wid.setLayout(main_layout)
@@ -1405,6 +1414,8 @@ class ExportImportTab(QScrollArea):
             """
             super().__init__()
             self.controller = controller
+            self.controller.export_progress_registered_clients.append(self)
+            self.export_progress = None   # the progress dialog of the running export, if any
 
             preproc_tab_grid = QGridLayout()
             row = 0
@@ -1611,7 +1622,22 @@ class ExportImportTab(QScrollArea):
             bg_subt=int(self.bg_subt.text())
             resized_width = int(self.resized_width.text())
             resized_height = int(self.resized_height.text())
-            self.controller.Preprocess_and_save(frame_range,Tot_del_fr,Z_int,X_int,Y_int,bg_blur,sd_blur,bg_subt,resized_width,resized_height)
+            self.export_progress = QProgressDialog("Exporting frames...", None, 0, 100)
+            self.export_progress.setWindowModality(Qt.WindowModal)
+            self.export_progress.showNormal()
+            QApplication.processEvents()
+            try:
+                self.controller.Preprocess_and_save(frame_range,Tot_del_fr,Z_int,X_int,Y_int,bg_blur,sd_blur,bg_subt,resized_width,resized_height)
+            finally:
+                self.export_progress.close()
+                self.export_progress = None
+
+        def change_export_progress(self, done, total, eta):
+            if self.export_progress is None:
+                return
+            self.export_progress.setLabelText("Exported {}/{} frames, about {:.0f} s left".format(done, total, eta))
+            self.export_progress.setValue(int(100 * done / max(total, 1)))
+            QApplication.processEvents()
 
         def import_file(self):
             FileAddress = self.import_address.text()
@@ -1787,6 +1813,12 @@ class GoTo(QWidget):
         gobut.setStyleSheet("background-color : rgb(93,177,130); border-radius: 4px; min-height: 20px; min-width: 50px")
         gobut.clicked.connect(self.signal_goto)
         self.grid.addWidget(gobut, 0, 2)
+
+        # plays the movie back from the maximum projections of the frames
+        playbut = QPushButton("Play projections")
+        playbut.setCheckable(True)
+        playbut.toggled.connect(self.controller.toggle_projection_scrub)
+        self.grid.addWidget(playbut, 0, 3)
         self.setLayout(self.grid)
 
     def signal_goto(self):
@@ -38,8 +38,8 @@ class MainFigWidget(pg.PlotWidget,QGraphicsItem):
         self.mask_img = pg.ImageItem(np.zeros((100, 100, 4)))
         self.addItem(self.mask_img)
 
-        self.img_data = None
-        self.mask_data = None
+        self.img_slice = None   # function z -> the image of slice z (see set_data)
+        self.mask_slice = None   # function z -> the mask of slice z (see set_data)
 
         self.hideAxis('bottom')
         self.hideAxis('left')
@@ -175,7 +175,7 @@ class MainFigWidget(pg.PlotWidget,QGraphicsItem):
         if value == -1:
             self.z = value
         else:
-            prop = int(np.clip(value, 0, self.img_data.shape[2]-1))
+            prop = int(np.clip(value, 0, self.zmax))
             if not np.isnan(prop):
                 self.z = prop
         self.update_image_display()
@@ -185,22 +185,28 @@ class MainFigWidget(pg.PlotWidget,QGraphicsItem):
             for key, plot in self.pointsetplots.items():
                 plot.setSize(self.size_func(self.pointsetsdata[key][:, 2]))
 
-    def set_data(self, img=None, mask=None, label=None):
+    def set_data(self, img_slice=None, mask_slice=None, label=None, depth=None):
         """
         Change the data to display (the image, mask, and label can be changed independently) and update the display accordingly.
-        :param img: the (3D) image to display
-        :param mask: the (3D) mask to display. Give None if not changing, give False if removing mask, give new mask to change.
+        :param img_slice: function z -> the (2D, RGB) image of slice z, or of the maximum projection if z is -1;
+            only the displayed slice is computed
+        :param depth: the number of z-slices of the image, if it changes
+        :param mask_slice: function z -> the (2D, RGBA) mask of slice z, or of the maximum projection if z is -1.
+            Give None if not changing, give False if removing mask, give new function to change.
         :param label: label to display. Must contain one {} field, to be filled by z.
         """
-        if img is not None:
-            self.img_data = img
+        if img_slice is not None:
+            self.img_slice = img_slice
+            if depth is not None:
+                self.zmax = depth - 1
+                self.z = min(self.z, self.zmax)
             self.update_image_display()
 
-        if mask is not None:
-            if mask is False:   # in this case remove the mask
-                self.mask_data = None
+        if mask_slice is not None:
+            if mask_slice is False:   # in this case remove the mask
+                self.mask_slice = None
             else:
-                self.mask_data = mask
+                self.mask_slice = mask_slice
             self.update_mask_display()
 
         if label is not None:
@@ -211,29 +217,26 @@ class MainFigWidget(pg.PlotWidget,QGraphicsItem):
         """
         Updates the display of the image
         """
+        if self.img_slice is None:
+            return
         # SJR: Figure out which image (z-slice or maximum intensity projection)
-        if self.z == -1:
-            img = np.max(self.img_data, axis=2)
-        else:
-            img = self.img_data[:, :, self.z]
+        img = self.img_slice(self.z)
 
+        # uint8 images are rendered with lookup tables, see ImageRendering.render_slice
+        levels = (0, 255) if img.dtype == np.uint8 else (0, 1)
         self.img.setImage(img, autoLevels=self.autolevels,
-                          levels=(0, 1))  # Todo: verify that levels does not override autoLevels
+                          levels=levels)  # Todo: verify that levels does not override autoLevels
 
     def update_mask_display(self):
         """
         Updates the display of the mask
         """
         # SJR: Only deal with mask if there is one
-        if self.mask_data is None:
+        if self.mask_slice is None:
             self.mask_img.clear()
         else:
-            # SJR: Figure out which image (z-slice or z-average of mask colors)
-            if self.z == -1:
-                mask = np.max(self.mask_data, axis=2)#MB changes mean to max
-            else:
-                mask = self.mask_data[:, :, self.z].copy()
-            self.mask_img.setImage(mask)
+            # SJR: Figure out which image (z-slice or z-projection of mask colors)
+            self.mask_img.setImage(self.mask_slice(self.z))
 
 
 class ActivityPlotWidget(pg.PlotWidget,QGraphicsItem):
@@ -1,4 +1,5 @@
 import numpy as np
+from collections import OrderedDict
 from matplotlib import cm
 import matplotlib as mpl
 import scipy.ndimage as sim
@@ -16,6 +17,9 @@ class ImageRendering:
     highlighted_transparency = 0.8
     # SJR: default number of mask colors; if there are more neurons than this number, repeat colors
     nmaskcolors = 15#MB changed the color to 15
+    # number of rendered slices kept in memory, to redisplay them without recomputing when scrolling through z or
+    # moving a slider back
+    max_cached_slices = 32
 
     def __init__(self, controller, figure, data_name, nb_frames):
         """
@@ -27,26 +31,45 @@ class ImageRendering:
         controller.highlighted_neuron_registered_clients.append(self)
         controller.frame_img_registered_clients.append(self)
         controller.mask_registered_clients.append(self)
+        controller.frame_loading_registered_clients.append(self)
         self.figure = figure
 
         # skeleton of label displayed on the figure.
         # The two labels are concatenated in the end, but their fields for t and z must be filled separately.
         self.label1 = "Dataset: " + data_name + " frame= {}/" + str(nb_frames)
         self.label2 = "; z = {}"
+        # whether the frame of time self.t is being read (the image displayed is still that of the previous frame)
+        self.loading = False
 
         # The raw red-channel and green-channel images (provided by the controller):
         self.im_rraw = None
         self.im_graw = None
         # The raw mask data (provided by the controller):
         self.raw_mask = None
-        # The 3-channel rendered image to be displayed (computed by self):
-        self.rendered_img = None
-        # The 4-channel rendered mask to be displayed (computed by self):
-        self.rendered_mask = None
+        # Only the displayed slice (or maximum projection) of the frame is rendered, see render_slice.
+        # The time of the frame (provided by the controller):
+        self.t = None
+        # Statistics, projections and blurred red channel of the frame, computed once per frame (see _volume):
+        self._volume_cache = {}
+        # When only the projections of the frame are given (see change_projection_data): the projection and mean of
+        # each channel, {"r": (mip, mean), "g": (mip, mean)}
+        self._projection = None
+        # Rendered slices, by (t, z, rendering parameters), least recently used first:
+        self._slices = OrderedDict()
+        # The lookup tables of the current frame and rendering parameters: (key, tables)
+        self._luts = (None, None)
+        # The RGBA color of each label of the mask, see _mask_palette (the displayed slice of the mask is colored with
+        # a lookup in the palette, see render_mask_slice):
+        self._palette = None
+        self._palette_highlighted = 0   # the highlighted neuron in self._palette
+        self._n_labels = 0   # 1 + the largest label of the mask
+        self._mask_mip = None   # the projection of the mask along z, computed when first displayed
 
         # Many image rendering parameters
         self.gamma = 0.4
         self.fast_gamma = True
+        # integer frames are rendered to uint8 through per-channel lookup tables (see _render_slice_lut)
+        self.lut_rendering = True
         self.blend_r = 1
         self.blend_g = 1
         self.high = 100
@@ -69,7 +92,17 @@ class ImageRendering:
 
     def change_t(self, t):
         """Changes the label"""
-        label = self.label1.format(t) + self.label2
+        self.t = t
+        self._update_label()
+
+    def change_loading(self, loading):
+        """Shows (or removes) the loading indicator in the label"""
+        if loading != self.loading:
+            self.loading = loading
+            self._update_label()
+
+    def _update_label(self):
+        label = self.label1.format(self.t) + (" (loading...)" if self.loading else "") + self.label2
         self.figure.set_data(label=label)
 
     def change_autolevels(self):
@@ -138,16 +171,52 @@ class ImageRendering:
         :param img_r: h*w*d array, the red-channel of the video frame
         :param img_g: h*w*d array, the green-channel of the video frame (or None if only one channel is to be used)
         """
+        if self._projection is not None or not (self._same_data(self.im_rraw, img_r)
+                                                and self._same_data(self.im_graw, img_g)):
+            self._new_frame()
+        self._projection = None
         self.im_rraw = img_r
         self.im_graw = img_g
         self._update_image()
 
+    def change_projection_data(self, mip_r, mean_r, mip_g=None, mean_g=None):
+        """
+        Callback when only the maximum projection of the video frame is to be displayed (e.g. when playing the movie
+        back, see Controller.toggle_projection_scrub); the projection is displayed whatever the z-slice.
+        Blurring is not applied (it needs the frame).
+        :param mip_r, mip_g: h*w arrays, the maximum projections along z of the red and green channels (mip_g is None
+            if only one channel is to be used)
+        :param mean_r, mean_g: the means of the channels of the frame, relative to which the thresholds are applied
+        """
+        self._new_frame()
+        self._projection = {"r": (mip_r, mean_r)}
+        if mip_g is not None:
+            self._projection["g"] = (mip_g, mean_g)
+        self.im_rraw = self.im_graw = None
+        self._update_image()
+
+    def _new_frame(self):
+        """Drops what was computed from the data of the current frame."""
+        self._volume_cache = {}
+        self._luts = (None, None)
+        for key in [key for key in self._slices if key[0] == self.t]:
+            del self._slices[key]
+
+    @staticmethod
+    def _same_data(old, new):
+        if old is None or new is None:
+            return old is None and new is None
+        return old is new or (old.shape == new.shape and np.array_equal(old, new))
+
     def change_mask_data(self, mask):
         """
         Callback when the mask displayed changes.
         :param mask: h*w*d array, the mask
         """
         self.raw_mask = mask
+        self._mask_mip = None
+        if mask is not None:
+            self._n_labels = int(np.max(mask)) + 1
         self._update_mask()
 
     def _f_gamma(self, x):  # CFP
@@ -172,81 +241,233 @@ class ImageRendering:
                 return n, w2 / w, w1 / w
             last = el
 
-    def compute_rendered_img(self):  # AD
-        """
-        Computes the image (from the video, independently of the presence of masks or points) to be displayed
-        :return: the h*w*3 array of the frame to be displayed
-        """
-        if self.blur_image:
-            # SJR: if blurring chosen, blur the image before doing anything else
-            # this needs to be cleaned up, e.g., with respect to dimensions (?).
-            # I just copied this from the segmentation code
-            sigm = self.blur_s
-            bg_factor = self.blur_b
-            xysize, xysize2, zsize = self.dimensions
-            sdev = np.array([sigm, sigm, sigm * xysize / zsize])
-            im = self.im_rraw
-            img_r = sim.gaussian_filter(im, sigma=sdev) - sim.gaussian_filter(im, sigma=sdev * bg_factor)
-            self.im_rraw = img_r#MB added to change threshold obtained from blurred image
-        else:
-            img_r = self.im_rraw
-
+    def _render_params(self):
+        return (self.gamma, self.fast_gamma, self.blend_r, self.blend_g, self.high, self.low, self._blurred(),
+                self.blur_s, self.blur_b, self.lut_rendering)
+
+    def _volume(self, key, fun):
+        """Per-frame value key, computed by fun() on first access."""
+        if key not in self._volume_cache:
+            self._volume_cache[key] = fun()
+        return self._volume_cache[key]
+
+    def _blurred(self):
+        """Whether the red channel is blurred (the projections alone cannot be)."""
+        return self.blur_image and self._projection is None
+
+    def _has_green(self):
+        if self._projection is not None:
+            return "g" in self._projection
+        return self.im_graw is not None
+
+    def _channel_volume(self, channel):
+        """The red ("r", blurred if blurring is chosen) or green ("g") channel of the frame."""
+        if channel == "g":
+            return self.im_graw
+        if not self._blurred():
+            return self.im_rraw
+        return self._volume(("blurred", self.blur_s, self.blur_b), self._blur)
+
+    def _blur_key(self, channel):
+        return channel, self._blurred() and channel == "r" and (self.blur_s, self.blur_b)
+
+    def _blur(self):
+        # SJR: if blurring chosen, blur the image before doing anything else
+        # this needs to be cleaned up, e.g., with respect to dimensions (?).
+        # I just copied this from the segmentation code
+        sigm = self.blur_s
+        bg_factor = self.blur_b
+        xysize, xysize2, zsize = self.dimensions
+        sdev = np.array([sigm, sigm, sigm * xysize / zsize])
+        im = self.im_rraw.astype(np.float32)
+        # the thresholds are then relative to the blurred image
+        return sim.gaussian_filter(im, sigma=sdev) - sim.gaussian_filter(im, sigma=sdev * bg_factor)
+
+    def _channel_slice(self, channel, z):
+        """
+        Slice z of the channel of the frame (see _channel_volume), or its maximum projection along z if z is -1
+        (computed once per frame, or given by change_projection_data).
+        """
+        if self._projection is not None:
+            return self._channel_data(channel)
+        volume = self._channel_volume(channel)
+        if z == -1:
+            return self._volume(("mip",) + self._blur_key(channel), lambda: np.max(volume, axis=2))
+        return volume[:, :, z]
+
+    def _channel_mean(self, channel):
+        if self._projection is not None:
+            return self._projection[channel][1]
+        volume = self._channel_volume(channel)
+        return self._volume(("mean",) + self._blur_key(channel), lambda: np.mean(volume))
+
+    def _channel_data(self, channel):
+        """The array the slices of the channel come from: the frame (see _channel_volume), or its projection."""
+        if self._projection is not None:
+            return self._projection[channel][0]
+        return self._channel_volume(channel)
+
+    def _channel_range(self, channel):
+        """The range of values of the channel covered by its lookup table (see _render_slice_lut)."""
+        return self._volume(("range",) + self._blur_key(channel), lambda: self._range(self._channel_data(channel)))
+
+    def _render_channel(self, img, mean, blend):
+        threshold = ((self.low * mean) <= img)
+        return np.clip(threshold * img, 0, (mean + (255 - mean) * self.high)) / 255 * blend
+
+    def render_slice(self, z):  # AD
+        """
+        Computes the image (from the video, independently of the presence of masks or points) to be displayed.
+        Rendered slices are memoized, and the statistics of the frame computed once per frame.
+        :param z: the slice to render, or -1 for the maximum projection along z (since the rendering is increasing in
+            the pixel values, this is the rendering of the maximum projection of the frame)
+        :return: the h*w*3 array of the slice to be displayed: uint8 if it is rendered with lookup tables (see
+            _render_slice_lut), float (displayed with levels 0 to 1) otherwise
+        """
+        key = (self.t, -1 if self._projection is not None else z, self._render_params())
+        if key in self._slices:
+            self._slices.move_to_end(key)
+            return self._slices[key]
 
-        mean_r = np.mean(img_r)
-        threshold_r = ((self.low * mean_r) <= img_r)
-        img_r = np.clip(threshold_r * img_r, 0, (mean_r + (255 - mean_r) * self.high)) / 255 * self.blend_r
-        
-        if self.im_graw is not None:
-            mean_g = np.mean(self.im_graw)
-            threshold_g = ((self.low * mean_g) <= self.im_graw)
-            img_g = np.clip(threshold_g * self.im_graw, 0, (mean_g + (255 - mean_g) * self.high)) / 255 * self.blend_g
+        if self._use_lut():
+            rendered = self._render_slice_lut(z)
+        else:
+            rendered = self._render_slice_float(z)
+
+        self._slices[key] = rendered
+        while len(self._slices) > self.max_cached_slices:
+            self._slices.popitem(last=False)
+        return rendered
+
+    def _render_slice_float(self, z):
+        """The float rendering of slice z, see render_slice."""
+        img_r = self._render_channel(self._channel_slice("r", z).astype(np.float32), self._channel_mean("r"),
+                                     self.blend_r)
+        if self._has_green():
+            img_g = self._render_channel(self._channel_slice("g", z).astype(np.float32), self._channel_mean("g"),
+                                         self.blend_g)
         else:
             img_g = img_r * self.blend_g / (self.blend_r + 1e-8)
         img_b = img_r  # blue channel is also green for a two channel image
         # SJR: This is why the red channel is really pink / purple
 
         # combine the three channels in one
-        combined_img = np.concatenate((img_r[:, :, :, None], img_g[:, :, :, None], img_b[:, :, :, None]), axis=3)
+        combined_img = np.stack((img_r, img_g, img_b), axis=2).astype(np.float32)
+        return self._apply_gamma(combined_img)
+
+    def _use_lut(self):
+        """Whether the frame can be rendered with lookup tables: integer values of at most 16 bits, not blurred."""
+        if not self.lut_rendering or self._blurred():
+            return False
+        dtypes = [self._channel_data(channel).dtype for channel in ("r", "g")[:1 + self._has_green()]]
+        return all(np.issubdtype(dtype, np.integer) and dtype.itemsize <= 2 for dtype in dtypes)
+
+    def _lut(self, values, mean, blend, scale=1.):
+        """The uint8 rendering (threshold, clip, blend, gamma) of the raw intensities values."""
+        rendered = self._apply_gamma(self._render_channel(values.astype(np.float32), mean, blend) * scale)
+        return (np.clip(rendered, 0, 1) * 255 + 0.5).astype(np.uint8)
+
+    def _channel_luts(self):
+        """
+        The lookup tables of the current frame and rendering parameters, built when either changes:
+        (lo_r, table_r, lo_g, table_g) where table_r[v - lo_r] are the red, green and blue values of red intensity v
+        (green is 0 if there is a green channel), and table_g[v - lo_g] the green value of green intensity v.
+        """
+        key = (self.t, self._render_params())
+        if self._luts[0] != key:
+            lo_r, hi_r = self._channel_range("r")
+            values = np.arange(lo_r, hi_r + 1)
+            mean_r = self._channel_mean("r")
+            table_r = np.zeros((len(values), 3), dtype=np.uint8)
+            table_r[:, 0] = table_r[:, 2] = self._lut(values, mean_r, self.blend_r)
+            lo_g, table_g = 0, None
+            if not self._has_green():
+                table_r[:, 1] = self._lut(values, mean_r, self.blend_r, self.blend_g / (self.blend_r + 1e-8))
+            else:
+                lo_g, hi_g = self._channel_range("g")
+                table_g = self._lut(np.arange(lo_g, hi_g + 1), self._channel_mean("g"), self.blend_g)
+            self._luts = (key, (lo_r, table_r, lo_g, table_g))
+        return self._luts[1]
+
+    def _render_slice_lut(self, z):
+        """Same as _render_slice_float, but uint8, with one lookup per channel instead of the float computations."""
+        lo_r, table_r, lo_g, table_g = self._channel_luts()
+        rendered = np.take(table_r, self._slice_index(self._channel_slice("r", z), lo_r), axis=0)
+        if table_g is not None:
+            rendered[:, :, 1] = np.take(table_g, self._slice_index(self._channel_slice("g", z), lo_g))
+        return rendered
+
+    @staticmethod
+    def _range(volume):
+        """The range of values of volume covered by its lookup table: from 0 (so that the values need not be shifted
+        to index it) or the minimum if negative, to the maximum."""
+        return min(int(np.min(volume)), 0), int(np.max(volume))
+
+    @staticmethod
+    def _slice_index(img, lo):
+        if lo == 0:
+            return img
+        return img.astype(np.int32) - lo
+
+    def _apply_gamma(self, img):
         if self.fast_gamma:
-            self.rendered_img = self._f_gamma(combined_img)
-        else:
-            self.rendered_img = combined_img ** self.gamma
+            return self._f_gamma(img)
+        return img ** self.gamma
 
-    def compute_rendered_mask(self):  # AD
+    def _mask_palette(self):
         """
-        Computes the mask array to be displayed (transparent where there is no neuron, semi-transparent where there is)
-        :return: the h*w*4 array of the masks to be displayed
+        The RGBA color of each label of the mask (transparent where there is no neuron, semi-transparent where there
+        is), built when the mask has labels beyond the palette, and patched when the highlighted neuron changes.
         """
-        # Warning: this could be longer than before because we compute the colormap for the whole mask instead of just
-        # one slice (but in return, changing z should be faster)
-        mask_rgba = self.cmap_mask((self.raw_mask % self.nmaskcolors + 1) * (self.raw_mask != 0))
-        mask_rgba[self.raw_mask == 0, 3] = 0
-        mask_rgba[self.raw_mask != 0, 3] = self.mask_transparency
-
-        if self.highlighted > 0:
-            mask_rgba[self.raw_mask == self.highlighted, 3] = self.highlighted_transparency
-
-        self.rendered_mask = mask_rgba
+        if self._palette is None or len(self._palette) < self._n_labels:
+            labels = np.arange(self._n_labels)
+            palette = self.cmap_mask((labels % self.nmaskcolors + 1) * (labels != 0)).astype(np.float32)
+            palette[:, 3] = self.mask_transparency
+            palette[0, 3] = 0
+            self._palette = palette
+            self._palette_highlighted = 0
+        if self._palette_highlighted != self.highlighted:
+            if 0 < self._palette_highlighted < len(self._palette):
+                self._palette[self._palette_highlighted, 3] = self.mask_transparency
+            if 0 < self.highlighted < len(self._palette):
+                self._palette[self.highlighted, 3] = self.highlighted_transparency
+            self._palette_highlighted = self.highlighted
+        return self._palette
+
+    def render_mask_slice(self, z):  # AD
+        """
+        Computes the mask to be displayed, by looking up the color of each label in the palette (see _mask_palette).
+        :param z: the slice to render, or -1 for the maximum projection along z (each pixel has the color of the
+            largest label along z)
+        :return: the h*w*4 array of the slice of the mask to be displayed
+        """
+        palette = self._mask_palette()
+        if z == -1:
+            if self._mask_mip is None:
+                self._mask_mip = np.max(self.raw_mask, axis=2)
+            mask = self._mask_mip
+        else:
+            mask = self.raw_mask[:, :, z]
+        if not np.issubdtype(mask.dtype, np.integer):
+            mask = mask.astype(np.intp)
+        return np.take(palette, mask, axis=0)
 
     def _update_image(self):
         """
-        Recomputes the image rendering and changes the display
+        Changes the display; the figure renders the slice it displays (see render_slice), or the projection whatever the
+        slice when only the projection is given (the depth of the figure is then left unchanged)
         """
-        # compute the new image
-        self.compute_rendered_img()
-
-        # then actually change the display
-        self.figure.set_data(img=self.rendered_img)
+        if self._projection is not None:
+            self.figure.set_data(img_slice=lambda z: self.render_slice(-1))
+        else:
+            self.figure.set_data(img_slice=self.render_slice, depth=self.im_rraw.shape[2])
 
     def _update_mask(self):
         """
-        Recomputes the mask rendering and changes the display
+        Changes the display of the mask
         """
         if self.raw_mask is None:
-            self.figure.set_data(mask=False)
+            self.figure.set_data(mask_slice=False)
         else:
-            # compute the new mask
-            self.compute_rendered_mask()
-
-            # then actually change the display
-            self.figure.set_data(mask=self.rendered_mask)
+            # the figure colors the slice it displays
+            self.figure.set_data(mask_slice=self.render_mask_slice)
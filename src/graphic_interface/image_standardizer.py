@@ -22,15 +22,21 @@ class ImageAligner:
         transform = self.data.get_transformation(t)
         if transform is None:
             return img_frame
+        return self.warp(img_frame, transform, ismask)
 
+    @classmethod
+    def warp(cls, image, transform, ismask=False):
+        """
+        Applies the affine transformation transform to image (as in self.align, but without reading the transformation
+        from self.data, so that it can run in worker processes).
+        """
         if ismask:
             order = 0
             cval = 0
         else:
             order = 3   # default value of affine_transform
-            cval = np.median(img_frame)  # why median??
-        new_image = self.apply_transform(img_frame, transform, mode='constant', cval=cval, order=order)
-        return new_image
+            cval = np.median(image)  # why median??
+        return affine_transform(image, transform[:, :3], transform[:, 3], mode='constant', cval=cval, order=order)
 
     def dealign(self, image, t,centerRot):
         """
@@ -128,11 +134,12 @@ class ImageCropper:
 
         image_shape = image.shape
         if self.orig_shape is None:
-            self.orig_shape = image_shape  # Todo: always safe??
-        assert self.orig_shape == image_shape, "ImageResizerCrop has not been designed to deal with images of different sizes, you will have problems with inverse resizing."
+            # the shape of whole frames, not of image, which may only hold a range of z-planes (see DataSet.get_frame)
+            self.orig_shape = tuple(self.data.frame_shape)
+        # only x and y are cropped, so a subset of the z-planes can be cropped too
+        assert tuple(self.orig_shape[:2]) == tuple(image_shape[:2]), "ImageResizerCrop has not been designed to deal with images of different sizes, you will have problems with inverse resizing."
         # Todo: dealing with images of different sizes could be useful if we want to shrink images when rotating??
-        x_left, x_right, y_left, y_right = self.data.get_ROI_params()
-        x_left, x_right, y_left, y_right = self._find_crop_lims(x_left, x_right, y_left, y_right)
+        x_left, x_right, y_left, y_right = self.crop_lims()
 
         cropped_frame = image[x_left:x_right, y_left:y_right, :]   # Todo: take care of z properly
         return cropped_frame
@@ -147,12 +154,17 @@ class ImageCropper:
         image_shape = mask.shape
         #assert image_shape[2] == 32
 
-        x_left, x_right, y_left, y_right = self.data.get_ROI_params()
-        x_left, x_right, y_left, y_right = self._find_crop_lims(x_left, x_right, y_left, y_right)
+        x_left, x_right, y_left, y_right = self.crop_lims()
         new_mask = np.zeros(self.orig_shape)
         new_mask[x_left:x_right, y_left:y_right, :] = mask#MB changed 33 to 1:image_shape[2]+1
         return new_mask
 
+    def crop_lims(self):
+        """
+        :return: crop_x_left, crop_x_right, crop_y_left, crop_y_right, the limits of the region cropped by self.crop
+        """
+        return self._find_crop_lims(*self.data.get_ROI_params())
+
     def _find_crop_lims(self, x_left, x_right, y_left, y_right):
         """
         Finds the limits of the region that will be cropped, given the limits of the Region Of Interest.
@@ -168,3 +180,45 @@ class ImageCropper:
         crop_y_left = max(0, y_left - missing_y)   # add missing pixels to the left, if possible
         crop_y_right = y_right + missing_y - (y_left - crop_y_left)   # add remaining missing pixels to the right (if left space was too short)
         return crop_x_left, crop_x_right, crop_y_left, crop_y_right
+
+
+def transform_frame(frame, transform=None, crop_lims=None):
+    """
+    Aligns then crops each channel of frame, as DataSet._transform does for a single channel. Only depends on its
+    arguments, so that it can be used with helpers.parallel_process2.
+    :param frame: (C,W,H,D) numpy array
+    :param transform: None (no alignment) or the transformation matrix of the frame (see ImageAligner.warp)
+    :param crop_lims: None (no cropping) or (x_left, x_right, y_left, y_right), as output by ImageCropper.crop_lims
+    :return: the transformed (C,W',H',D) frame
+    """
+    channels = []
+    for img in frame:
+        if transform is not None:
+            img = ImageAligner.warp(img, transform)
+        if crop_lims is not None:
+            img = img[crop_lims[0]:crop_lims[1], crop_lims[2]:crop_lims[3], :]
+        channels.append(img)
+    return np.stack(channels)
+
+
+def reverse_transform_mask(mask, crop_lims=None, orig_shape=None, transform=None, angle_offset=None):
+    """
+    Undoes the cropping then the alignment of a mask, as DataSet._reverse_transform does. Only depends on its
+    arguments, so that it can run in worker processes.
+    :param crop_lims: None (no cropping) or the limits of the crop (see ImageCropper.crop_lims)
+    :param orig_shape: the shape of the uncropped mask (only needed with crop_lims)
+    :param transform: None, or the transformation matrix of the alignment (see ImageAligner.dealign with centerRot=0)
+    :param angle_offset: None, or (angle, offset) of the alignment (see ImageAligner.dealign with centerRot=1)
+    """
+    if crop_lims is not None:
+        new_mask = np.zeros(orig_shape)
+        new_mask[crop_lims[0]:crop_lims[1], crop_lims[2]:crop_lims[3], :] = mask
+        mask = new_mask
+    aligner = ImageAligner(None)
+    if angle_offset is not None and angle_offset[0] is not None:
+        angle, offset = angle_offset
+        mask = aligner.apply_inverse_transform(mask, transform=0, mode='constant', cval=0, order=0, centerRot=1,
+                                               angleDeg=-angle, offset=-offset)
+    elif transform is not None:
+        mask = aligner.apply_inverse_transform(mask, transform, mode='constant', cval=0, order=0)
+    return mask
@@ -0,0 +1,196 @@
+"""
+Parallel, resumable writing of movies into h5 files (in the format of assembleh5.py).
+Worker processes read (decode) the frames and compress them chunk by chunk; the calling process is the only writer,
+and stores the compressed chunks as they are (h5py write_direct_chunk), so that it does not compress anything itself.
+The number of frames written is recorded in the file after each batch, so that an interrupted ingestion can be
+resumed from the last complete frame.
+"""
+import multiprocessing
+import os
+import re
+import resource
+import time
+import zlib
+import h5py
+import numpy as np
+
+from src.h5utils import codec_kwargs
+
+# attribute of files being written, holding the number of complete frames (removed once all frames are written)
+PROGRESS_ATTR = "ingested_frames"
+
+_worker_read = None
+_worker_codec = None
+
+
+def chunk_shape(name, shape):
+    """
+    Chunks of the datasets written: one channel and one z-plane per chunk for frames (see h5Data._frame_chunks), one
+    z-plane per chunk for masks.
+    """
+    if name == "frame":
+        return (1, shape[1], shape[2], 1)
+    return shape[:-1] + (1,)
+
+
+def encode(arrays, codec):
+    """
+    Compresses the arrays of one time frame.
+    :param arrays: dict name ("frame", "mask"...) -> int16 array
+    :return: dict name -> (shape, chunks, data), data being a list of (chunk offset, compressed bytes) for gzip and
+        uncompressed data, or the array itself for other codecs (which are only available inside HDF5)
+    """
+    kwargs = codec_kwargs(codec)
+    encoded = {}
+    for name, array in arrays.items():
+        array = np.ascontiguousarray(array, dtype=np.int16)
+        chunks = chunk_shape(name, array.shape)
+        if kwargs.get("compression", "gzip") != "gzip":
+            encoded[name] = (array.shape, chunks, array)
+            continue
+        data = []
+        ranges = [range(0, n, c) for n, c in zip(array.shape, chunks)]
+        for offset in np.stack(np.meshgrid(*ranges, indexing="ij"), axis=-1).reshape(-1, array.ndim):
+            raw = array[tuple(slice(o, o + c) for o, c in zip(offset, chunks))].tobytes()
+            if kwargs:
+                raw = zlib.compress(raw, kwargs.get("compression_opts", 4))
+            data.append((tuple(int(o) for o in offset), raw))
+        encoded[name] = (array.shape, chunks, data)
+    return encoded
+
+
+def _init_worker(read, codec):
+    global _worker_read, _worker_codec
+    _worker_read, _worker_codec = read, codec
+
+
+def _read_and_encode(t):
+    return encode(_worker_read(t), _worker_codec)
+
+
+def raw_size(encoded):
+    """The uncompressed size (in bytes) of the output of encode."""
+    return sum(2 * int(np.prod(shape)) for shape, _, _ in encoded.values())
+
+
+def write_encoded(h5, t, encoded, codec):
+    """Writes the output of encode as the datasets "{t}/<name>" of the open file h5 (replacing existing ones)."""
+    for name, (shape, chunks, data) in encoded.items():
+        key = "{}/{}".format(t, name)
+        if key in h5:
+            del h5[key]
+        dset = h5.create_dataset(key, shape, dtype="i2", chunks=chunks, **codec_kwargs(codec))
+        if isinstance(data, np.ndarray):
+            dset[...] = data
+        else:
+            for offset, raw in data:
+                dset.id.write_direct_chunk(offset, raw)
+
+
+def peak_rss_mb():
+    """Peak resident memory (in MB) of this process and of its largest terminated child process."""
+    own = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+    children = resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss / 1024
+    return own, children
+
+
+def ingest(h5fn, T, read, attrs, codec="gzip", n_workers=None, resume=True, batch_size=None):
+    """
+    Writes the T frames given by read into the file h5fn, in parallel.
+    :param read: picklable function (e.g. an instance of a module-level class) such that read(t) is a dict name ->
+        array for time frame t, with at least "frame" (C,W,H,D) and optionally "mask" (W,H,D), "high"...
+    :param attrs: the attributes of the file ("name", "C", "W", "H", "D", "N_neurons"...); "T" and "codec" are set here
+    :param codec: see h5utils.codec_kwargs
+    :param n_workers: number of worker processes (None for the number of cores, 0 to read and compress in this process)
+    :param resume: if True and h5fn is a partially written file, only the missing frames are written
+    :param batch_size: number of frames in flight at once (bounds the memory used), defaults to 2 * n_workers
+    :return: dict with the number of frames written, the elapsed time, the frames/s, the (uncompressed) MB/s and the
+        peak RSS (in MB) of the writer and of the workers
+    """
+    if n_workers is None:
+        n_workers = os.cpu_count()
+    batch_size = batch_size or 2 * max(n_workers, 1)
+    st = time.perf_counter()
+    start = 0
+    if resume and os.path.exists(h5fn):
+        with h5py.File(h5fn, "r") as h5:
+            if PROGRESS_ATTR in h5.attrs:
+                start = int(h5.attrs[PROGRESS_ATTR])
+            elif "T" in h5.attrs and int(h5.attrs["T"]) == T:   # already complete
+                start = T
+    if start == T and os.path.exists(h5fn):
+        return {"frames": 0, "seconds": 0., "frames_per_s": 0., "mb_per_s": 0., "writer_rss_mb": 0.,
+                "workers_rss_mb": 0.}
+    h5 = h5py.File(h5fn, "r+" if start else "w")
+    if start:
+        print("Resuming {} from frame {}/{}".format(h5fn, start, T))
+    else:
+        h5.attrs[PROGRESS_ATTR] = 0
+    for t in range(start, T):   # leftovers of an interrupted batch
+        if str(t) in h5:
+            del h5[str(t)]
+    pool = None
+    if n_workers:
+        pool = multiprocessing.Pool(n_workers, initializer=_init_worker, initargs=(read, codec))
+        encode_all = pool.imap
+    else:
+        _init_worker(read, codec)
+        encode_all = map
+    nbytes = 0
+    try:
+        for batch_start in range(start, T, batch_size):
+            times = range(batch_start, min(batch_start + batch_size, T))
+            for t, encoded in zip(times, encode_all(_read_and_encode, times)):
+                write_encoded(h5, t, encoded, codec)
+                nbytes += raw_size(encoded)
+            h5.attrs[PROGRESS_ATTR] = times[-1] + 1
+            h5.flush()
+            elapsed = time.perf_counter() - st
+            print("{}: {}/{} frames, {:.1f} frames/s, {:.1f} MB/s".format(
+                h5fn, times[-1] + 1, T, (times[-1] + 1 - start) / elapsed, nbytes / 2 ** 20 / elapsed))
+        for key, val in attrs.items():
+            h5.attrs[key] = val
+        h5.attrs["T"] = T
+        h5.attrs["codec"] = codec
+        del h5.attrs[PROGRESS_ATTR]
+    finally:
+        if pool is not None:
+            pool.terminate()
+            pool.join()
+        h5.close()
+    elapsed = time.perf_counter() - st
+    writer_rss, workers_rss = peak_rss_mb()
+    stats = {"frames": T - start, "seconds": elapsed, "frames_per_s": (T - start) / elapsed,
+             "mb_per_s": nbytes / 2 ** 20 / elapsed, "writer_rss_mb": writer_rss, "workers_rss_mb": workers_rss}
+    print("{} frames written in {:.1f} s ({:.1f} frames/s, {:.1f} MB/s), peak RSS {:.0f} MB (writer), {:.0f} MB "
+          "(workers)".format(stats["frames"], elapsed, stats["frames_per_s"], stats["mb_per_s"], writer_rss,
+                             workers_rss))
+    return stats
+
+
+def natural_sort(filenames):
+    """Sorts file names with their numbers in numerical order (frame_2.tif before frame_10.tif)."""
+    return sorted(filenames, key=lambda fn: [int(s) if s.isdigit() else s for s in re.split(r"(\d+)", fn)])
+
+
+class ImageFiles:
+    """
+    Reads the frames for ingest from one file per time frame: .npy arrays, (C,W,H,D) or (W,H,D) as in the h5 files,
+    or TIFF stacks, in ImageJ order (D,H,W) or (D,C,H,W).
+    """
+    def __init__(self, filenames):
+        self.filenames = filenames
+
+    def __call__(self, t):
+        fn = self.filenames[t]
+        if fn.endswith(".npy"):
+            frame = np.load(fn)
+        else:
+            from skimage import io
+            frame = io.imread(fn)
+            if frame.ndim == 3:
+                frame = frame[:, None]
+            frame = frame.transpose(1, 3, 2, 0)
+        if frame.ndim == 3:
+            frame = frame[None]
+        return {"frame": frame}
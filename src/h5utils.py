@@ -1,18 +1,470 @@
 """
 Simple tool(s) for h5 handling
 """
+import functools as ft
 import h5py
+import itertools
 import os
+import multiprocessing
 import numpy as np
+import zlib
+from scipy import ndimage
 
-def repack(h5fn):
+def codec_kwargs(codec):
+    """
+    The keyword arguments of h5py's create_dataset for given compression codec.
+    :param codec: "gzip" (level 4), "gzip-<level>" (level from 0 to 9), "lzf" (faster, less compact) or "none"
+    """
+    if codec == "none":
+        return {}
+    if codec == "lzf":
+        return {"compression": "lzf"}
+    if codec == "gzip":
+        return {"compression": "gzip"}
+    if codec.startswith("gzip-") and codec[5:].isdigit() and 0 <= int(codec[5:]) <= 9:
+        return {"compression": "gzip", "compression_opts": int(codec[5:])}
+    raise ValueError("Unknown codec {}, expected gzip, gzip-<level>, lzf or none".format(codec))
+
+
+def file_codec(h5):
+    """The codec used for the frames and masks of the open h5 file h5 (files without the attribute use gzip)."""
+    return h5.attrs.get("codec", "gzip")
+
+
+def repack(h5fn, codec=None, progress=None):
+    """
+    Rewrites h5fn, which reclaims the space of deleted datasets.
+    The copy is written to h5fn + "_temp" and only replaces h5fn once complete, so an interruption leaves h5fn intact.
+    :param codec: if given (see codec_kwargs), the frames and masks (all int16 volumes) are re-compressed with this
+        codec, which is also recorded as the codec of the file.
+    :param progress: None or function called as progress(n_done, n_total) after each top-level key is copied
+    """
+    # imported here, so that the scripts that import this module as a top-level one (e.g. assembleh5.py) still work
+    from .neural_network_scripts import h5_compact
     h5=h5py.File(h5fn,"r")
     h5new=h5py.File(h5fn+"_temp","w")
-    for key,val in h5.items():
-        h5.copy(key,h5new)
+    if codec is None:
+        keys = list(h5.keys())
+        for i, key in enumerate(keys):
+            h5_compact.copy_item(h5, key, h5new)
+            if progress is not None:
+                progress(i + 1, len(keys))
+    else:
+        kwargs = codec_kwargs(codec)
+
+        def copy_item(name, obj):
+            if isinstance(obj, h5py.Group):
+                group = h5new.require_group(name)
+                for key, val in obj.attrs.items():
+                    group.attrs[key] = val
+                for key in obj:   # not visited, e.g. the NN runs mounted from their own file
+                    link = obj.get(key, getlink=True)
+                    if isinstance(link, h5py.ExternalLink):
+                        group[key] = h5py.ExternalLink(link.filename, link.path)
+            elif obj.dtype == np.int16 and obj.ndim >= 3:
+                dset = h5new.create_dataset(name, obj.shape, dtype="i2", chunks=obj.chunks, maxshape=obj.maxshape,
+                                            **kwargs)
+                if obj.chunks is not None and obj.chunks[0] == 1:   # one frame at a time, for the stacked layout
+                    for i in range(len(obj)):
+                        dset[i] = obj[i]
+                else:
+                    dset[...] = obj[...]
+                for key, val in obj.attrs.items():
+                    dset.attrs[key] = val
+            else:
+                h5.copy(obj, h5new, name=name)
+
+        keys = list(h5.keys())
+        for i, key in enumerate(keys):
+            if isinstance(h5.get(key, getlink=True), h5py.ExternalLink):   # e.g. the groups "{t}" of a NN snapshot
+                h5_compact.copy_item(h5, key, h5new)
+            else:
+                copy_item(key, h5[key])
+                if isinstance(h5[key], h5py.Group):
+                    h5[key].visititems(lambda name, obj: copy_item(key + "/" + name, obj))
+            if progress is not None:
+                progress(i + 1, len(keys))
     for key,val in h5.attrs.items():
         h5new.attrs[key]=val
+    if codec is not None:
+        h5new.attrs["codec"] = codec
     h5.close()
     h5new.close()
-    os.remove(h5fn)
-    os.rename(h5fn+"_temp",h5fn)
+    os.replace(h5fn+"_temp",h5fn)
+
+
+def reclaimable_bytes(h5fn):
+    """
+    Estimates how much space repacking h5fn would reclaim, see h5_compact.reclaimable_bytes.
+    :return: reclaimable, file_size (in bytes)
+    """
+    from .neural_network_scripts import h5_compact
+    return h5_compact.reclaimable_bytes(h5fn)
+
+
+def compact(h5fn, threshold=0.2, progress=None, verbose=True):
+    """
+    Repacks h5fn only if enough space can be reclaimed, which avoids rewriting large files for a few rewritten masks.
+    Safe against interruption (see repack); leftovers of an interrupted compaction are removed.
+    :param threshold: minimum fraction of the file size that must be reclaimable for the file to be repacked
+    :param progress: see repack
+    :return: True if the file was repacked
+    """
+    if os.path.exists(h5fn + "_temp"):
+        os.remove(h5fn + "_temp")
+    reclaimable, file_size = reclaimable_bytes(h5fn)
+    do_repack = reclaimable > threshold * file_size
+    if verbose:
+        print("{:.1f} MB reclaimable out of {:.1f} MB ({:.0%}), {}".format(
+            reclaimable / 2 ** 20, file_size / 2 ** 20, reclaimable / max(file_size, 1),
+            "repacking" if do_repack else "below the {:.0%} threshold, not repacking".format(threshold)))
+    if do_repack:
+        repack(h5fn, progress=progress)
+    return do_repack
+
+
+def _print_progress(h5fn, done, total):
+    print("Repacking {}: {}/{}".format(h5fn, done, total))
+
+
+def compact_in_background(h5fn, threshold=0.2):
+    """
+    Runs compact in a separate process, which prints its progress. The file must not be opened until it is done.
+    The process is spawned rather than forked, since the GUI that starts it has other threads running.
+    :return: the started multiprocessing.Process
+    """
+    process = multiprocessing.get_context("spawn").Process(target=compact, args=(h5fn, threshold),
+                                      kwargs={"progress": ft.partial(_print_progress, h5fn)})
+    process.start()
+    return process
+
+
+def to_stacked_layout(h5fn, compact=True):
+    """
+    Migrates the file h5fn in place from the per-frame layout (datasets "{t}/frame" and "{t}/mask") to the stacked
+    layout: a single (T,C,W,H,D) dataset "frames", a (T,W,H,D) dataset "masks" and a (T,) boolean dataset
+    "mask_present" telling which masks exist. Other per-frame datasets ("{t}/seg", "{t}/coarse_mask"...) are kept.
+    The file is only marked as stacked once everything is copied, so an interrupted migration can simply be re-run.
+    :param compact: whether to repack the file afterwards, to reclaim the space of the deleted datasets
+    """
+    h5 = h5py.File(h5fn, "r+")
+    T = int(h5.attrs["T"])
+    if h5.attrs.get("layout") != "stacked":
+        for key in ("frames", "masks", "mask_present"):   # leftovers of an interrupted migration
+            if key in h5:
+                del h5[key]
+        C, W, H, D = h5["0/frame"].shape
+        kwargs = codec_kwargs(file_codec(h5))
+        frames = h5.create_dataset("frames", (T, C, W, H, D), dtype="i2", maxshape=(None, C, W, H, D),
+                                   chunks=(1, 1, W, H, 1), **kwargs)
+        masks = h5.create_dataset("masks", (T, W, H, D), dtype="i2", maxshape=(None, W, H, D),
+                                  chunks=(1, W, H, 1), **kwargs)
+        mask_present = h5.create_dataset("mask_present", (T,), dtype=bool, maxshape=(None,))
+        for t in range(T):
+            frames[t] = h5[str(t) + "/frame"][...]
+            if str(t) + "/mask" in h5:
+                masks[t] = h5[str(t) + "/mask"][...]
+                mask_present[t] = True
+        h5.attrs["layout"] = "stacked"
+    for t in range(T):
+        for key in (str(t) + "/frame", str(t) + "/mask"):
+            if key in h5:
+                del h5[key]
+    h5.close()
+    if compact:
+        repack(h5fn)
+
+
+def to_per_frame_layout(h5fn, compact=True):
+    """
+    Migrates the file h5fn in place from the stacked layout back to the per-frame layout (see to_stacked_layout), as
+    expected by the neural network scripts. Can be re-run after an interruption.
+    :param compact: whether to repack the file afterwards, to reclaim the space of the deleted datasets
+    """
+    h5 = h5py.File(h5fn, "r+")
+    if h5.attrs.get("layout") == "stacked":
+        frames, masks, mask_present = h5["frames"], h5["masks"], h5["mask_present"]
+        _, C, W, H, D = frames.shape
+        kwargs = codec_kwargs(file_codec(h5))
+        for t in range(len(frames)):
+            for key in (str(t) + "/frame", str(t) + "/mask"):   # leftovers of an interrupted migration
+                if key in h5:
+                    del h5[key]
+            h5.create_dataset(str(t) + "/frame", data=frames[t], dtype="i2", chunks=(1, W, H, 1), **kwargs)
+            if t < len(mask_present) and mask_present[t]:
+                h5.create_dataset(str(t) + "/mask", data=masks[t], dtype="i2", **kwargs)
+        del h5.attrs["layout"]
+    for key in ("frames", "masks", "mask_present"):
+        if key in h5:
+            del h5[key]
+    h5.close()
+    if compact:
+        repack(h5fn)
+
+
+def snapshot_frames_path(dst_fn):
+    """The file holding the frames, masks and "high" datasets of the NN snapshot dst_fn (see nn_snapshot)."""
+    root, ext = os.path.splitext(dst_fn)
+    return root + "_frames" + ext
+
+
+def nn_snapshot(h5, dst_fn, run=None):
+    """
+    Writes into the new file dst_fn the part of the open file h5 that the neural network scripts read and write: the
+    attributes, the frames, the ground-truth masks, the "{t}/high" datasets, "distmat", the previous NN runs ("net")
+    and the label index of the masks. The frames and masks are written in the per-frame layout. Segmentations,
+    features, original or aligned frames... are left out, so the snapshot is much smaller than a copy of the file,
+    and h5 can stay open (and be edited) while a NN works on the snapshot.
+    The groups "{t}" and the previous runs are written in a second file (see snapshot_frames_path) and external links
+    to them in dst_fn, so that dst_fn only holds the results of the run and can be mounted as such into h5 (see
+    h5Data.pull_NN_results).
+    Per-frame datasets are copied without being decompressed.
+    :param run: the key ("<NetName>_<runname>") of the run that works on the snapshot; its previous results, if any,
+        are copied into dst_fn itself since the run overwrites them
+    """
+    stacked = h5.attrs.get("layout") == "stacked"
+    kwargs = codec_kwargs(file_codec(h5))
+    frames_fn = snapshot_frames_path(dst_fn)
+    link_fn = os.path.basename(frames_fn)
+    with h5py.File(dst_fn, "w") as dst, h5py.File(frames_fn, "w") as frames:
+        for key, val in h5.attrs.items():
+            if key != "layout":
+                dst.attrs[key] = val
+        for t in range(int(h5.attrs["T"])):
+            group = frames.create_group(str(t))
+            if stacked:
+                _, _, W, H, _ = h5["frames"].shape
+                group.create_dataset("frame", data=h5["frames"][t], dtype="i2", chunks=(1, W, H, 1), **kwargs)
+                if t < len(h5["mask_present"]) and h5["mask_present"][t]:
+                    group.create_dataset("mask", data=h5["masks"][t], dtype="i2", **kwargs)
+            for name in ("frame", "mask", "high"):
+                if name not in group and str(t) + "/" + name in h5:
+                    h5.copy(h5[str(t) + "/" + name], group, name=name)
+            dst[str(t)] = h5py.ExternalLink(link_fn, "/" + str(t))
+        # runs whose results are still in their own file (see h5Data.pull_NN_results) are copied like the others
+        for key in h5.get("net", {}):
+            if key == run:
+                h5.copy(h5["net/" + key], dst.require_group("net"), name=key)
+            else:
+                h5.copy(h5["net/" + key], frames.require_group("net"), name=key)
+                dst["net/" + key] = h5py.ExternalLink(link_fn, "/net/" + key)
+        for key in ("distmat", "label_index/mask"):
+            if key in h5:
+                parent, name = os.path.split(key)
+                h5.copy(h5[key], dst.require_group(parent) if parent else dst, name=name)
+
+
+def read_direct(dset, index=()):
+    """
+    Reads dset[index] by decompressing the chunks with zlib rather than through HDF5. h5py holds a global lock during
+    dset[index], while zlib releases the GIL, so several threads can decompress chunks at the same time.
+    Falls back to dset[index] for contiguous datasets and for filters other than gzip.
+    :param index: tuple of integers and slices (of step 1), completed with full slices
+    """
+    if dset.chunks is None or dset.compression not in (None, "gzip") or dset.shuffle or dset.fletcher32 \
+            or dset.scaleoffset is not None:
+        return dset[index]
+    starts, stops, dropped = [], [], []
+    for dim, size in enumerate(dset.shape):
+        sel = index[dim] if dim < len(index) else slice(None)
+        if isinstance(sel, slice):
+            start, stop, step = sel.indices(size)
+            if step != 1:
+                return dset[index]
+            starts.append(start)
+            stops.append(max(start, stop))
+        else:
+            sel = int(sel) + size if sel < 0 else int(sel)
+            starts.append(sel)
+            stops.append(sel + 1)
+            dropped.append(dim)
+    out = np.full([stop - start for start, stop in zip(starts, stops)], dset.fillvalue, dtype=dset.dtype)
+    ranges = [range(start // c * c, stop, c) for start, stop, c in zip(starts, stops, dset.chunks)]
+    for offset in itertools.product(*ranges):
+        try:
+            filter_mask, raw = dset.id.read_direct_chunk(offset)
+        except RuntimeError:   # the chunk was never written, it holds the fill value
+            continue
+        if dset.compression == "gzip" and not filter_mask & 1:
+            raw = zlib.decompress(raw)
+        chunk = np.frombuffer(raw, dtype=dset.dtype).reshape(dset.chunks)
+        lo = [max(start, o) for start, o in zip(starts, offset)]
+        hi = [min(stop, o + c) for stop, o, c in zip(stops, offset, dset.chunks)]
+        out[tuple(slice(l - start, h - start) for l, h, start in zip(lo, hi, starts))] = \
+            chunk[tuple(slice(l - o, h - o) for l, h, o in zip(lo, hi, offset))]
+    return out.reshape([n for dim, n in enumerate(out.shape) if dim not in dropped])
+
+
+def write_direct(dset, array):
+    """
+    Writes array into the whole of dset by compressing the chunks with zlib rather than through HDF5 (see read_direct),
+    so that other threads can use the file while the chunks are compressed.
+    Falls back to dset[...] = array for contiguous datasets and for filters other than gzip.
+    Raises ValueError if the shape of array is not that of dset.
+    """
+    if np.shape(array) != dset.shape:
+        raise ValueError("Cannot write an array of shape {} into dataset {} of shape {}".format(
+            np.shape(array), dset.name, dset.shape))
+    if dset.chunks is None or dset.compression not in (None, "gzip") or dset.shuffle or dset.fletcher32 \
+            or dset.scaleoffset is not None:
+        dset[...] = array
+        return
+    array = np.asarray(array, dtype=dset.dtype)
+    for offset in itertools.product(*[range(0, n, c) for n, c in zip(dset.shape, dset.chunks)]):
+        chunk = array[tuple(slice(o, o + c) for o, c in zip(offset, dset.chunks))]
+        if chunk.shape != dset.chunks:   # edge chunks are stored whole
+            full = np.full(dset.chunks, dset.fillvalue, dtype=dset.dtype)
+            full[tuple(slice(0, n) for n in chunk.shape)] = chunk
+            chunk = full
+        raw = np.ascontiguousarray(chunk).tobytes()
+        if dset.compression == "gzip":
+            raw = zlib.compress(raw, dset.compression_opts)
+        dset.id.write_direct_chunk(offset, raw)
+
+
+def row_chunks(shape, itemsize, target_bytes=4096):
+    """
+    Chunk shape for the arrays with one row per time frame (pointdat, neuron_presence): whole rows, about target_bytes
+    per chunk, so that saving the edits of one frame only rewrites a small chunk.
+    """
+    row_bytes = max(1, int(np.prod(shape[1:])) * itemsize)
+    return (max(1, min(shape[0], target_bytes // row_bytes)),) + tuple(shape[1:])
+
+
+def write_changed_rows(dset, new, old=None):
+    """
+    Writes new into dset, which holds old, by only writing the runs of consecutive rows (time frames) that differ
+    (nan being equal to nan). Everything is written if old is None or if the shapes differ.
+    :return: the number of rows written
+    """
+    if old is None or old.shape != new.shape or dset.shape != new.shape:
+        dset[...] = new
+        return len(new)
+    same = new == old
+    if new.dtype.kind == "f":
+        same |= np.isnan(new) & np.isnan(old)
+    rows = np.flatnonzero(~same.reshape(len(new), -1).all(axis=1))
+    for run in np.split(rows, np.flatnonzero(np.diff(rows) > 1) + 1):
+        if len(run):
+            dset[run[0]:run[-1] + 1] = new[run[0]:run[-1] + 1]
+    return len(rows)
+
+
+def storage_position(dset):
+    """The position in the file of the data of dset (of its first chunk if chunked), to read datasets in disk order."""
+    if dset.chunks is None:
+        return dset.id.get_offset() or 0
+    if dset.id.get_num_chunks() == 0:
+        return 0
+    return dset.id.get_chunk_info(0).byte_offset
+
+
+def label_stats(mask):
+    """
+    Computes the label index of a mask.
+    :param mask: 3D integer array, 0 for the background
+    :return: L*8 int32 array, with one line [label, voxel count, x_start, x_stop, y_start, y_stop, z_start, z_stop] for
+        each label present in mask (the background excluded), the box being mask[x_start:x_stop, ...].
+    """
+    labels, counts = np.unique(mask, return_counts=True)
+    keep = labels > 0
+    labels, counts = labels[keep], counts[keep]
+    stats = np.zeros((len(labels), 8), dtype=np.int32)
+    stats[:, 0] = labels
+    stats[:, 1] = counts
+    if len(labels):
+        boxes = ndimage.find_objects(np.where(mask > 0, mask, 0).astype(np.int32, copy=False))
+        for row, label in enumerate(stats[:, 0]):   # int labels, even for float masks
+            stats[row, 2:] = [bound for sl in boxes[label - 1] for bound in (sl.start, sl.stop)]
+    return stats
+
+
+def _label_index_key(kind, t):
+    """kind is the mask key ("mask" or "coarse_mask") or "net/<NN key>" for the masks predicted by a NN."""
+    return "label_index/{}/{}".format(kind, t)
+
+
+def write_label_index(h5, kind, t, mask):
+    """Stores the label index (see label_stats) of mask, the mask of given kind for time t, into the open file h5."""
+    key = _label_index_key(kind, t)
+    if key in h5:
+        del h5[key]
+    h5.create_dataset(key, data=label_stats(mask))
+
+
+def read_label_index(h5, kind, t):
+    """:return: the stored label index (see label_stats) of the mask of given kind for time t, None if not indexed"""
+    key = _label_index_key(kind, t)
+    if key not in h5:
+        return None
+    return h5[key][...]
+
+
+def _indexed_masks(h5):
+    """Yields (kind, t, dataset) for all the masks that the label index covers in the open file h5."""
+    stacked = h5.attrs.get("layout") == "stacked"
+    T = int(h5.attrs["T"])
+    for t in range(T):
+        if stacked:
+            if t < len(h5["mask_present"]) and h5["mask_present"][t]:
+                yield "mask", t, h5["masks"][t]
+        elif str(t) + "/mask" in h5:
+            yield "mask", t, h5[str(t) + "/mask"]
+        if str(t) + "/coarse_mask" in h5:
+            yield "coarse_mask", t, h5[str(t) + "/coarse_mask"]
+    for NN_key in h5.get("net", {}):
+        for t in range(T):
+            if "net/{}/{}/predmask".format(NN_key, t) in h5:
+                yield "net/" + NN_key, t, h5["net/{}/{}/predmask".format(NN_key, t)]
+
+
+def rebuild_label_index(h5fn):
+    """(Re)computes the label index of all masks of h5fn, e.g. for files written before the index existed."""
+    with h5py.File(h5fn, "r+") as h5:
+        if "label_index" in h5:
+            del h5["label_index"]
+        for kind, t, mask in _indexed_masks(h5):
+            write_label_index(h5, kind, t, mask[...])
+
+
+def check_label_index(h5fn):
+    """
+    Checks that the label index of h5fn matches its masks.
+    :return: list of (kind, t, problem) for each mask whose index is missing or wrong
+    """
+    problems = []
+    with h5py.File(h5fn, "r") as h5:
+        for kind, t, mask in _indexed_masks(h5):
+            stats = read_label_index(h5, kind, t)
+            if stats is None:
+                problems.append((kind, t, "missing"))
+            elif not np.array_equal(stats, label_stats(mask[...])):
+                problems.append((kind, t, "outdated"))
+    return problems
+
+
+if __name__ == "__main__":
+    # usage: python3 -m src.h5utils stack|unstack file.h5
+    #        python3 -m src.h5utils repack file.h5 [codec]
+    #        python3 -m src.h5utils compact file.h5 [threshold]
+    #        python3 -m src.h5utils rebuild_index|check_index file.h5
+    import sys
+    if sys.argv[1] == "stack":
+        to_stacked_layout(sys.argv[2])
+    elif sys.argv[1] == "unstack":
+        to_per_frame_layout(sys.argv[2])
+    elif sys.argv[1] == "repack":
+        repack(sys.argv[2], codec=sys.argv[3] if len(sys.argv) > 3 else None)
+    elif sys.argv[1] == "compact":
+        compact(sys.argv[2], threshold=float(sys.argv[3]) if len(sys.argv) > 3 else 0.2,
+                progress=lambda done, total: print("{}/{}".format(done, total)))
+    elif sys.argv[1] == "rebuild_index":
+        rebuild_label_index(sys.argv[2])
+    elif sys.argv[1] == "check_index":
+        problems = check_label_index(sys.argv[2])
+        for kind, t, problem in problems:
+            print("{} {}: label index {}".format(kind, t, problem))
+        print("{} problem(s) found".format(len(problems)))
+    else:
+        raise ValueError("Unknown command {}, expected stack, unstack, repack, compact, rebuild_index or check_index"
+                         .format(sys.argv[1]))
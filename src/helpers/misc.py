@@ -40,6 +40,14 @@ class ColorAssignment:
         #  duplicate colors when other colors are unused
 
 
+class ThreadSignal(QtCore.QObject):
+    """
+    Hands values over from a worker thread to the Qt thread: the functions connected to self.signal are called through
+    the Qt event loop, in the thread where this object was created.
+    """
+    signal = QtCore.pyqtSignal(object)
+
+
 class UpdateTimer:
     def __init__(self, interval, update_fun):
         """
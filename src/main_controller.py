@@ -13,11 +13,14 @@ import skimage.feature as skfeat
 import scipy.spatial as spat
 import scipy.ndimage as sim
 import cv2
+from PyQt5 import QtCore
 
 #Internal classes
 from .helpers import SubProcManager, QtHelpers, misc
 from . import h5utils
+from . import preprocess_export
 from .datasets_code.DataSet import DataSet
+from .datasets_code.frame_cache import FrameLoader
 import shutil
 
 #HarvardLab specific classes
@@ -30,9 +33,10 @@ from .mask_processing.features import FeatureBuilder
 from .mask_processing.clustering import Clustering
 from .mask_processing.classification import Classification
 from .mask_processing.image_register import Register_Rotate
+from .mask_processing import mask_edit, mask_import
+from .neural_network_scripts import unpack_cache
 from .mask_processing.NN_related import post_process_NN_masks, post_process_NN_masks2, post_process_NN_masks3, \
     post_process_NN_masks4, post_process_NN_masks5
-from .mask_processing.image_processing import blur, blacken_background, resize_frame
 
 # SJR: message box for indicating neuron number of new neuron and for renumbering neuron
 from .msgboxes import EnterCellValue as ecv
@@ -61,10 +65,32 @@ class Controller():
         self.data = dataset
         self.settings=settings
         print("Loading dataset:",self.data.name)
+        # the frames the GUI goes to are read in a background thread, and displayed through this signal once read (see
+        # update)
+        self._frame_loader = None
+        self._frame_loaded = misc.ThreadSignal()
+        self._frame_loaded.signal.connect(self._frame_loaded_in_background)
+        self._loaded_t = None   # the time frame that the background thread has just read
+        self.loading_frame = False   # whether the frame of self.i is being read in the background (see update)
+        self._configure_data_cache()
+        # disk budget of the unpacked training data kept by the NN runs, read by their subprocesses (see unpack_cache)
+        os.environ[unpack_cache.BUDGET_ENV] = str(self.settings.get("unpack_cache_budget_gb",
+                                                                    unpack_cache.DEFAULT_BUDGET_GB))
 
         self.ready = False
 
         self.timer = misc.UpdateTimer(1. / int(self.settings["fps"]), self.update)
+        self.autosave_timer = QtCore.QTimer()   # periodic autosave, see toggle_autosave
+        self.autosave_timer.timeout.connect(self.autosave)
+        # plays the movie back from the projections of the frames, see toggle_projection_scrub
+        self.scrub_timer = QtCore.QTimer()
+        self.scrub_timer.setInterval(int(1000 / float(self.settings.get("projection_scrub_fps", 25))))
+        self.scrub_timer.timeout.connect(self._scrub_step)
+        # checks whether the repack started by save_and_repack is done
+        self.repack_timer = QtCore.QTimer()
+        self.repack_timer.setInterval(500)
+        self.repack_timer.timeout.connect(self._check_repack)
+        self._repack = None   # (process, path of the data set) while repacking
 
         # whether data is going to be as points or as masks:
         self.point_data = self.data.point_data
@@ -213,6 +239,12 @@ class Controller():
         self.autocenter_registered_clients = []
         # here when some calcium intensity changes
         self.calcium_registered_clients = []
+        # here when the frame of the current time starts (True) or finishes (False) being read in the background
+        self.frame_loading_registered_clients = []
+        # here when a repack of the data set (save_and_repack) starts or finishes
+        self.repack_registered_clients = []
+        # here when an export (Preprocess_and_save) progresses
+        self.export_progress_registered_clients = []
         # here when the gui is disabled during NN run
         self.freeze_registered_clients = [self.timer]
 
@@ -258,11 +290,8 @@ class Controller():
             pass
         else:
             for t in range(old_t, self.frame_num):
-                mask = self.data.get_mask(t)
-                if mask is not False:
-                    present = np.unique(mask)
-                    if present[0] == 0:   # should be the case (background)
-                        present = present[1:]
+                present = self.data.mask_labels(t)   # from the label index, no need to read the mask
+                if present is not None:
                     self.neuron_presence[t, present] = True
         self.data.neuron_presence = self.neuron_presence
 
@@ -274,9 +303,9 @@ class Controller():
         if not self.timer.update_allowed(t_change):
             return
 
-        # save at update if autosave
-        if self.options["autosave"]:
-            self.save_status()
+        # save at update if autosave (unless it is periodic)
+        if self.options["autosave"] and not self.autosave_timer.isActive():
+            self.autosave()
 
 
         # time change event
@@ -288,6 +317,20 @@ class Controller():
             if self.options["mask_annotation_mode"]:
                 self.mask_temp = None
 
+            # the frame is read in the background; until then, the last displayed frame stays with a loading indicator
+            # (and cannot be edited, see _editing_blocked) and the display is updated once the frame is read (see
+            # _frame_loaded_in_background)
+            if self._frame_loader is not None and self._loaded_t != self.i and not self.data.is_cached(self.i):
+                self._frame_loader.request(self.i)
+                self.loading_frame = True
+                for client in self.frame_loading_registered_clients:
+                    client.change_loading(True)
+                return
+            self._loaded_t = None
+            self.loading_frame = False
+            for client in self.frame_loading_registered_clients:
+                client.change_loading(False)
+
         #load the images from the dataset
 
         if self.channel_num == 2:
@@ -327,6 +370,27 @@ class Controller():
         #peak calculation is only when requested
         self.peak_calced=False
 
+        # start loading the neighbouring frames once the current one is displayed
+        if t_change:
+            self.data.prefetch_around(self.i)
+
+    def _frame_loaded_in_background(self, t):
+        """Called in the Qt thread once the background thread has read the frame of time t (see update)."""
+        if t != self.i:   # the user has moved on, the frame of self.i has been requested since
+            return
+        self._loaded_t = t   # display it even if it is not in the cache (e.g. if it is too large for the cache)
+        self.update(t_change=True)
+
+    def _editing_blocked(self):
+        """
+        Whether the frame of the current time is still being read in the background (see update). The image, mask and
+        points displayed are then those of the previous frame, so they must not be edited: the edits would be saved
+        for the current time.
+        """
+        if self.loading_frame:
+            print("The frame is still loading, edit it once it is displayed")
+        return self.loading_frame
+
     def _show_masks(self):
         """
         In mask mode, whether we are currently showing masks.
@@ -391,6 +455,35 @@ class Controller():
         self.i = t
         self.update(t_change=True)
 
+    def toggle_projection_scrub(self):
+        """
+        Starts (or stops) playing the movie back from the maximum projections of the frames (see DataSet.get_mip),
+        which are read much faster than the frames once they are stored, at projection_scrub_fps frames per second.
+        While playing, only the time and the image are updated (the masks are hidden); everything is updated when
+        playing stops.
+        """
+        if self.scrub_timer.isActive():
+            self.scrub_timer.stop()
+            self.update(t_change=True)
+        else:
+            for client in self.mask_registered_clients:
+                client.change_mask_data(None)
+            self.scrub_timer.start()
+
+    def _scrub_step(self):
+        self.i = (self.i + 1) % self.frame_num
+        for client in self.frame_registered_clients:
+            client.change_t(self.i)
+        # the channels are chosen as in update
+        if self.channel_num == 2 and self.options["second_channel_only"]:
+            red, green = self.data.get_mip(self.i, col="green"), ()
+        elif self.channel_num == 2 and not self.options["first_channel_only"]:
+            red, green = self.data.get_mip(self.i), self.data.get_mip(self.i, col="green")
+        else:
+            red, green = self.data.get_mip(self.i), ()
+        for client in self.frame_img_registered_clients:
+            client.change_projection_data(*red, *green)
+
     def recompute_point_presence(self):
         """
         To be called when self.pointdat or self.NN_pointdat is modified
@@ -567,6 +660,8 @@ class Controller():
             client.change_ca_activity(self.hlab.ci_int)
 
     def frame_clicked(self, button, coords):
+        if self._editing_blocked():
+            return
         # a click with coordinates is received
         if self.options["defining_cropzone_mode"]:
             self.crop_points.append(coords[:2])
@@ -704,7 +799,7 @@ class Controller():
 
     def key_pressed(self, key, coords):
         # user hits keyboard. annotates or deletes neuron
-        if (None in coords) or (np.isnan(np.sum(coords))):
+        if (None in coords) or (np.isnan(np.sum(coords))) or self._editing_blocked():
             return
         if not self.point_data:
             QtHelpers.ErrorMessage("Pressing a key is not available for masks.")   # Todo: could be implemented?
@@ -770,6 +865,21 @@ class Controller():
             self.data.save_ROI_params(xleft, xright, yleft, yright)
             del self.crop_points
 
+    def store_aligned_frames(self):
+        """
+        Stores the aligned and cropped version of all frames in the dataset, so that they are not re-computed each time
+        they are read in aligned and cropped mode.
+        """
+        OrigCrop = self.data.crop
+        OrigAlign = self.data.align
+        self.data.crop = True
+        self.data.align = True
+        print("Storing aligned frames")
+        self.data.build_aligned_view()
+        print("Aligned frames stored")
+        self.data.align = OrigAlign
+        self.data.crop = OrigCrop
+
     def toggle_old_trainset(self):
         self.options["use_old_trainset"] = not self.options["use_old_trainset"]
         self.update()
@@ -818,137 +928,68 @@ class Controller():
         """
         MB defined this to import from another file that contains another NN run
         on our current file or th ecropped and rotated version of the file.
+        All the masks are imported at once (see mask_processing.mask_import): they are read in chunks, put back into
+        the original space in parallel and written in one pass, then the neuron presence and the calcium activities
+        are recomputed once.
         """
         self.save_status()
         self.update()
         ExtFile = DataSet.load_dataset(Address)
-        frameCheck = self.data.get_frame(0, col= "red")#We compare this with dimensions of the uploaded masks
-        shapeCheck = np.shape(frameCheck)
         transformBack = self.options["save_after_reversing"]
         UndoCuts = self.options["save_after_reversing_Cuts"]
-        for t in range(ExtFile.dataset.attrs["T"]):
-            #Assuming the imported file was a derivative of the current file after cropping, rotating and other preprocesses,
-            #fr t of imported file corresponds to frame "orig_index" of the current file
-            origIndex = ExtFile.get_frame_match(t)   # original number of frame that t corresponds to is saved in this dataset
-            if origIndex is False:
-                print("The map between the two files frame numbers is not found. It is taken to be identity")
-                origIndex = t
-
-            maskTemp = ExtFile.get_mask(t, force_original=True)   # don't apply crop and rotate on the imported masks
-            if maskTemp is not False and transformBack and origIndex < self.frame_num:
-                ExtFile.crop = True
-                ExtFile.align = True
-
-                img = maskTemp
-
-                if transformation_mode:
-                    origTrans,offset = ExtFile.get_transfoAngle(origIndex)
-                else:
-                    origTrans = self.data.get_transformation(origIndex)
-                origROI = self.data.get_ROI_params()
-                #copy the cropping parameters of the imported file temporarily into the current file:
-                if origROI is not None and origTrans is not None:
-                    TemptransParam = 1
-                else:
-                    TemptransParam = 0
-                self.data.save_ROI_params(*ExtFile.get_ROI_params())
-
-                if transformation_mode==0:
-                    centerRot=0
-                    self.data.save_transformation_matrix(origIndex, ExtFile.get_transformation(t))
-                else:
-                    centerRot=1
-                    mat = np.zeros(4)
-                    mat[0],mat[1:] = ExtFile.get_transfoAngle(t)
-                    self.data.save_transformation_matrix(origIndex,mat,1)
-                OrigCrop = self.data.crop
-                OrigAlign =self.data.align
-                self.data.crop = True   # so that the save_mask function applies the reverse transformations
-                self.data.align = True
-
-                if UndoCuts:
-                    Zvec = ExtFile.original_intervals("z")
-                    Yvec = ExtFile.original_intervals("y")
-                    Xvec = ExtFile.original_intervals("x")
-                    imgT = np.zeros((shapeCheck[0],shapeCheck[1],shapeCheck[2]))
-                    imgT[int(Xvec[0]):int(Xvec[1]),int(Yvec[0]):int(Yvec[1]),int(Zvec[0]):int(Zvec[1])] = img#np.shape(img)[2]] = img
-                    if green:
-                        self.data.save_green_mask(origIndex, imgT, False,centerRot)
-                    else:
-                        self.data.save_mask(origIndex, imgT, False,centerRot)
-
-                elif not np.shape(img)[2] == shapeCheck[2]:
-                    print("Z dimensions doesn't match. Zero entries are added to mask for compensation")
-                    Zvec = ExtFile.original_intervals("z")
-                    print(Zvec)
-                    Zvec = [0,31]
-                    imgT = np.zeros((np.shape(img)[0],np.shape(img)[1],shapeCheck[2]))
-                    imgT[:,:,int(Zvec[0]):int(Zvec[1])] = img[:,:,int(Zvec[0]):int(Zvec[1])]
-                    if green:
-                        self.data.save_green_mask(origIndex, imgT, False,centerRot)
-                    else:
-                        self.data.save_mask(origIndex, imgT, False, centerRot)
-                else:
-                    if green:
-                        self.data.save_green_mask(origIndex, img, False,centerRot)
-                    else:
-                        self.data.save_mask(origIndex, img, False,centerRot)
-                if TemptransParam == 1:   # Todo I think this just saves what was loaded identically
-                    if transformation_mode==0:
-                        self.data.save_transformation_matrix(origIndex, origTrans)
-                    else:
-                        mat = np.zeros(4)
-                        mat[0],mat[1:] = ExtFile.get_transfoAngle(t)
-                        self.data.save_transformation_matrix(origIndex,mat,1)
-
-                    self.data.save_ROI_params(*origROI)
-                self.data.align = OrigAlign
-                self.data.crop = OrigCrop
-                self.mask_change(origIndex)
-            elif maskTemp is not False and origIndex < self.frame_num:
-                img = maskTemp
-
-                if transformation_mode==1:
-                    centerRot=1
-                else:
-                    centerRot=0
-
-                if UndoCuts:
-                    Zvec = ExtFile.original_intervals("z")
-                    Yvec = ExtFile.original_intervals("y")
-                    Xvec = ExtFile.original_intervals("x")
-                    imgT = np.zeros((shapeCheck[0],shapeCheck[1],shapeCheck[2]))
-                    imgT[int(Xvec[0]):int(Xvec[1]),int(Yvec[0]):int(Yvec[1]),int(Zvec[0]):int(Zvec[1])] = img#np.shape(img)[2]] = img
-                    if green:
-                        self.data.save_green_mask(origIndex, imgT, False,centerRot)
-                    else:
-                        self.data.save_mask(origIndex, imgT, False,centerRot)
-                elif not np.shape(img)[2] == shapeCheck[2]:
-                    print("Z dimensions doesn't match. Zero entries are added to mask for compensation")
-                    Zvec = ExtFile.original_intervals("z")
-                    if Zvec is None:
-                        Zvec = [0,32]
-                    imgT = np.zeros((np.shape(img)[0],np.shape(img)[1],shapeCheck[2]))
-                    imgT[:,:,int(Zvec[0]):int(Zvec[1])] = img
-                    if green:
-                        self.data.save_green_mask(origIndex, imgT, True,centerRot)
-                    else:
-                        self.data.save_mask(origIndex, imgT, True,centerRot)
-
-                else:
-                    if green:
-                        self.data.save_green_mask(origIndex, img, True,centerRot)
-                    else:
-                        self.data.save_mask(origIndex, img, True,centerRot)
-                self.mask_change(origIndex)
+        #Assuming the imported file was a derivative of the current file after cropping, rotating and other preprocesses,
+        #fr t of imported file corresponds to frame "orig_index" of the current file
+        if "original_match" not in ExtFile.dataset:
+            print("The map between the two files frame numbers is not found. It is taken to be identity")
+        jobs = mask_import.plan_import(self.data, ExtFile, transformation_mode, transformBack, UndoCuts)
+        times = mask_import.import_masks(self.data, ExtFile, jobs, green=green)
         ExtFile.close()
-        print("mask upload finished")
+        self._masks_changed(times)
+        print("mask upload finished ({} masks)".format(len(times)))
+
+    def _masks_changed(self, times):
+        """
+        Updates everything that needs to be updated when the masks of the given times were all modified in the dataset
+        (as mask_change does for a single time frame, but with a single refresh of the clients).
+        """
+        labels = {t: self.data.mask_labels(t) for t in times}   # from the label index, no need to read the masks
+        max_neu = max([int(max(lab)) for lab in labels.values() if lab is not None and len(lab)], default=0)
+        if max_neu > self.n_neurons:
+            self.n_neurons = max_neu
+            self.data.nb_neurons = self.n_neurons
+        if self.neuron_presence.shape[1] < self.n_neurons + 1:
+            old_presence = self.neuron_presence
+            self.neuron_presence = np.zeros((self.frame_num, self.n_neurons + 1), dtype=bool)
+            self.neuron_presence[:, :old_presence.shape[1]] = old_presence
+        for t, lab in labels.items():
+            self.neuron_presence[t] = False
+            if lab is not None:
+                self.neuron_presence[t, lab] = True
+        # reduce number of neurons if the last neurons have disappeared (from all frames)
+        cumsum = np.cumsum(np.sum(self.neuron_presence, axis=0)[::-1])
+        if cumsum[0] == 0 and np.any(cumsum):
+            self.n_neurons = self.n_neurons - np.flatnonzero(cumsum)[0]
+            self.data.nb_neurons = self.n_neurons
+            self.neuron_presence = self.neuron_presence[:, :self.n_neurons + 1]
+        self.data.neuron_presence = self.neuron_presence
+        self.signal_nb_neurons_changed()
+        self.signal_present_all_times_changed()
+        for client in self.present_neurons_registered_clients:
+            client.change_present_neurons(present=np.flatnonzero(self.neuron_presence[self.i]))
+        self.update_mask_display()
+        # recompute corresponding calcium activities
+        for t in times:
+            self.hlab.update_ci(self.data, t=t)
+        for client in self.calcium_registered_clients:
+            client.change_ca_activity(self.hlab.ci_int)
 
     def Preprocess_and_save(self,frame_int,frame_deleted,Z_interval,X_interval,Y_interval,bg_blur,sd_blur,bg_subt,width,height):
         """
         MB defined this to select and delete the desired frames from the
         original movie or blur, subtract background andcrop in z direction.
         it saves the result in a new .h5 file in the directory of the original input files
+        The frames are processed in parallel (see preprocess_export.preprocess_and_save), the progress is sent to the
+        clients of self.export_progress_registered_clients.
         """
         if all(i in frame_deleted or i not in self.selected_frames for i in frame_int):
             print("No frames for new dataset, not doing anything. Please select frames.")
@@ -956,65 +997,6 @@ class Controller():
         self.save_status()
         self.update()
 
-        frameCheck = self.data.get_frame(0, col="red")
-        fr_shape = np.shape(frameCheck)
-
-        z_0 = int(Z_interval[0])
-        z_1 = int(Z_interval[1])
-
-        padXL = 0
-        padXR = 0
-        padYbottom = 0
-        padYtop = 0
-        padZlow = 0
-        padZhigh = 0
-
-        ## Determine the padding pixels needed in direction of x
-        if int(X_interval[0])<0:
-            x_0 = 0
-            padXL = 0-int(X_interval[0])
-        else:
-            x_0 = int(X_interval[0])
-
-        if int(X_interval[1])==0:
-            x_1 = fr_shape[0]
-        elif int(X_interval[1])>fr_shape[0]:
-            x_1 = fr_shape[0]
-            padXR = int(X_interval[1])-fr_shape[0]
-        else:
-            x_1 = int(X_interval[1])
-
-        ## Determine the padding pixels needed in direction of Y
-        if int(Y_interval[0]) <0:
-            y_0 = 0
-            padYbottom = 0-int(Y_interval[0])
-        else:
-            y_0 = int(Y_interval[0])
-
-        if int(Y_interval[1])==0:#doesn't change x and y coordinate if the upper bound is zero
-            y_1 = fr_shape[1]
-        elif int(Y_interval[1])>fr_shape[1]:
-            y_1 = fr_shape[1]
-            padYtop = int(Y_interval[1])-fr_shape[1]
-        else:
-            y_1 = int(Y_interval[1])
-
-        ## Determine the padding pixels needed in direction of Z
-        if int(Z_interval[0]) <0:
-            z_0 = 0
-            padZlow = 0-int(Z_interval[0])
-        else:
-            z_0 = int(Z_interval[0])
-
-        if int(Z_interval[1])==0:#doesn't change z coordinate if the upper bound is zero
-            z_1 = fr_shape[2]
-        elif int(Z_interval[1])>fr_shape[2]:
-            z_1 = fr_shape[2]
-            padZhigh = int(Z_interval[1])-fr_shape[2]
-        else:
-            z_1 = int(Z_interval[1])
-
-
         dset_path=self.data.path_from_GUI
         name = self.data_name
         dset_path_rev = dset_path[::-1]
@@ -1025,139 +1007,16 @@ class Controller():
             newpath = os.path.join(dset_path_cropped,key+".h5")
         else:
             newpath = key+".h5"
-        hNew = DataSet.create_dataset(newpath)
-        hNew.copy_properties(self.data, except_frame_num=True)
-        OrigCrop = self.data.crop
-        OrigAlign =self.data.align
-        if self.options["save_crop_rotate"]:
-            self.data.crop = True
-            self.data.align = True
-        l=0
-
-        key="distmat"
-        if key in self.data.dataset.keys():
-            distmat = self.data.dataset[key]   # TODO
-            ds = hNew.dataset.create_dataset(key,shape=np.shape(distmat),dtype="f4")
-            ds[...]=distmat
-            print("distmat saved")
-        #change the point annotation in accordance with resized dimensions.
-        if 'pointdat' in self.data.dataset.keys() or 'pointdat_old' in self.data.dataset.keys():
-            import copy
-            if 'pointdat' in self.data.dataset.keys():
-                pointkey0 = 'pointdat'
-            else:
-                pointkey0 = 'pointdat_old'
-            S0 =  np.array(self.data.dataset[pointkey0])
-            S = copy.deepcopy(S0)
-            x00,y00,z00 =np.nonzero(~np.isnan(S0))
-            for p in range(len(x00)):
-                S[x00[p],y00[p],0]=(S0[x00[p],y00[p],0]-x_0)
-                S[x00[p],y00[p],1]=(S0[x00[p],y00[p],1]-y_0)
-                S[x00[p],y00[p],2]=(S0[x00[p],y00[p],2]-z_0)
-            print("point coordinate aligned")
-            S_f = copy.deepcopy(S)
-            if self.options["save_resized"]:
-                x00,y00,z00 =np.nonzero(~np.isnan(S))
-                for p in range(len(x00)):
-                    S_f[x00[p],y00[p],0]=(S[x00[p],y00[p],0] * width/fr_shape[0])
-                    S_f[x00[p],y00[p],1]=(S[x00[p],y00[p],1] * height/fr_shape[1])
-                print("resized points saved")
-            hNew.dataset.create_dataset(pointkey0,data = S_f)
-
-        for i in frame_int:
-            if i not in frame_deleted and i in self.selected_frames:
-                if self.options["AutoDelete"]:
-                    kcoarse=str(i)+"/coarse_mask"
-                    if kcoarse in self.data.dataset.keys():
-                        if len(np.unique(self.data.dataset[kcoarse]))<3:
-                            continue
-
-                if hNew.nb_channels==2:
-                    if self.options["save_1st_channel"] ^ self.options["save_green_channel"]:
-                        frameGr = 0
-                    else:
-                        frameGr = self.data.get_frame(i, col= "green")
-                        frameGr = frameGr[:x_1,:y_1,:z_1]
-                        frameGr = frameGr[x_0:,y_0:,z_0:]
-                        frmean = int(np.mean(frameGr,axis=(0, 1,2)))
-                        frameGr = np.pad(frameGr, ((padXL, padXR),(padYtop, padYbottom), (padZlow,padZhigh)),
-                                    'constant', constant_values=((frmean, frmean),(frmean,frmean), (frmean,frmean)))#((frmean, frmean),(frmean,frmean), (frmean,frmean)))
-                        if self.options["save_resized"]:
-                            frameGr = resize_frame(frameGr,width,height)
-                else:
-                    frameGr = 0
-
-                if self.options["save_green_channel"] and not self.options["save_1st_channel"]:
-                    frameRd = self.data.get_frame(i, col= "green")
-                else:
-                    frameRd = self.data.get_frame(i, col="red")
-                if self.options["save_blurred"]:
-                    frameRd = blur(frameRd, bg_blur, sd_blur, self.options["save_subtracted_bg"], bg_subt)
-                elif self.options["save_subtracted_bg"]:
-                    frameRd = blacken_background(frameRd, bg_subt)
-                frameRd = frameRd[:x_1,:y_1,:z_1]
-                frameRd = frameRd[x_0:,y_0:,z_0:]
-                frmean = int(np.mean(frameRd,axis=(0, 1,2)))
-                frameRd = np.pad(frameRd, ((padXL, padXR),(padYtop, padYbottom),  (padZlow,padZhigh)),
-                            'constant', constant_values=((frmean, frmean),(frmean,frmean), (frmean,frmean)))#, constant_values=((frameRd, frameRd),(frameRd,frameRd), (frameRd,frameRd)))
-                if self.options["save_resized"]:
-                    frameRd = resize_frame(frameRd,width,height)
-
-                maskTemp = self.data.get_mask(i)
-                if maskTemp is not False:
-                    maskTemp = maskTemp[:x_1,:y_1,:z_1]
-                    maskTemp = maskTemp[x_0:,y_0:,z_0:]
-                    maskTemp = np.pad(maskTemp, ( (padXL, padXR),(padYtop, padYbottom), (padZlow,padZhigh)),'constant', constant_values=((0, 0),(0,0), (0,0)))
-                    hNew.nb_neurons = max(hNew.nb_neurons, len(np.unique(maskTemp)), np.max(maskTemp))
-                    if self.options["save_resized"]:
-                        maskTemp = resize_frame(maskTemp,width,height,mask=True)
-                    hNew.save_frame(l, frameRd, frameGr, mask = maskTemp , force_original=True)
-                else:
-                    hNew.save_frame(l,frameRd, frameGr ,force_original=True)
-                kcoarse=str(i)+"/coarse_mask"
-                if kcoarse in self.data.dataset.keys() and not self.options["save_crop_rotate"]:#TODO : check for compatibility with rotation and cropping modes
-                    CoarseSegTemp = self.data.dataset[kcoarse]
-                    CoarseSegTemp = CoarseSegTemp[:x_1,:y_1,:z_1]
-                    CoarseSegTemp = CoarseSegTemp[x_0:,y_0:,z_0:]
-                    CoarseSegTemp = np.pad(CoarseSegTemp, ((padXL, padXR),(padYtop, padYbottom), (padZlow,padZhigh)),'constant', constant_values=((0, 0),(0,0),(0,0)))
-                    kcoarsel=str(l)+"/coarse_mask"
-                    kcoarseSegl=str(l)+"/coarse_seg"
-                    hNew.dataset.create_dataset(kcoarsel, data=CoarseSegTemp.astype(np.int16), dtype="i2", compression="gzip")
-                    hNew.dataset.create_dataset(kcoarseSegl, data=CoarseSegTemp.astype(np.int16), dtype="i2", compression="gzip")
-                    print(i)
-                #save the transformation functions for later retrieval
-                matrix = self.data.get_transformation(i)
-                if self.options["save_crop_rotate"] or (matrix is not None):
-                    print(i)
-                    hNew.save_transformation_matrix(l, matrix)
-                hNew.save_frame_match(i, l)
-                real_time = self.data.get_real_time(i)
-                if real_time is not None:
-                    hNew.save_real_time(l, real_time)
-                l = l+1
-        if self.options["save_resized"]:
-            hNew.save_original_size(fr_shape)
-
-        X_interval0 = self.data.original_intervals("x")
-        Y_interval0 = self.data.original_intervals("y")
-        Z_interval0 = self.data.original_intervals("z")
-        if X_interval is not None:
-            if Y_interval[1]==0:
-                Y_interval[1]=Y_interval0[1]
-            if Y_interval[0]==0 and not Y_interval0[0]==0:
-                Y_interval[0]=Y_interval0[0]
-            if X_interval[1]==0:
-                X_interval[1]=X_interval0[1]
-            if X_interval[0]==0 and not X_interval0[0]==0:
-                X_interval[0]=X_interval0[0]
-        hNew.save_original_intervals(X_interval, Y_interval, Z_interval)
-
-        assert hNew.frame_num == l
-        self.data.align = OrigAlign
-        self.data.crop = OrigCrop
 
-        hNew.close()
+        times = preprocess_export.exported_times(self.data, [i for i in frame_int if i in self.selected_frames],
+                                                 frame_deleted, self.options["AutoDelete"])
+        preprocess_export.preprocess_and_save(self.data, newpath, times, X_interval, Y_interval, Z_interval, bg_blur,
+                                              sd_blur, bg_subt, width, height, self.options,
+                                              progress=self._export_progress)
 
+    def _export_progress(self, done, total, eta):
+        for client in self.export_progress_registered_clients:
+            client.change_export_progress(done, total, eta)
 
     def highlight_neuron(self, neuron_id_from1, block_unhighlight=False):
         """
@@ -1336,12 +1195,28 @@ class Controller():
 
     def toggle_autosave(self):
         """
-        Toggles the autosave option: when autosave is on, we save whenever update is called
+        Toggles the autosave option: when autosave is on, we save every autosave_interval_s seconds (see the settings),
+        or whenever update is called if autosave_interval_s is 0
         Then saves a first time if autosave is now on
         """
         self.options["autosave"] = not self.options["autosave"]
         if self.options["autosave"]:
-            self.save_status()
+            self.autosave()
+            interval = float(self.settings.get("autosave_interval_s", 0))
+            if interval > 0:
+                self.autosave_timer.start(int(interval * 1000))
+        else:
+            self.autosave_timer.stop()
+
+    def autosave(self):
+        """
+        Saves the annotations and calcium activities without waiting for them to be written: only the rows edited
+        since the last save are written, in the background (see h5Data.set_poindat and h5Data.ca_act).
+        """
+        if self.point_data:
+            self.save_pointdat()
+        self.data.neuron_presence = self.neuron_presence
+        self.data.ca_act = self.hlab.ci_int
 
     def close(self,arg,msg):
         ####Dependency
@@ -1556,7 +1431,7 @@ class Controller():
             self.box_details = None
 
     def renumber_mask_obj(self):
-        if self.highlighted == 0:
+        if self.highlighted == 0 or self._editing_blocked():
             return
         #MB added: to get the connected components of the mask
         labelArray,numFtr = sim.label(self.mask==self.highlighted)
@@ -1602,16 +1477,12 @@ class Controller():
             value = int(dlg.entry1.text())
             print("Renumbering", self.highlighted, "fro", fro, "to", to)
             if not self.point_data:#MB added this to use this feature for epfl data
-                for k in range(fro,to):
-                    mask_k = self.data.get_mask(k, force_original=False)  # MB added
-                    if mask_k is not False:
-                        mask_k[mask_k == self.highlighted] = value
-                        self.data.save_mask(k, mask_k, False)
-                        self.mask_change(k)
-
+                self._edit_masks({self.highlighted: value}, range(fro, to))
                 self.highlight_neuron(self.highlighted)
 
     def permute_masks(self, Permutation):
+        if self._editing_blocked():
+            return
         self.mask_temp = self.mask.copy()
         for l in range(len(Permutation)-1):
             k = Permutation[l]
@@ -1621,7 +1492,7 @@ class Controller():
             #self.highlight_neuron(self.highlighted)
 
     def delete_mask_obj(self):
-        if self.highlighted == 0:
+        if self.highlighted == 0 or self._editing_blocked():
             return
         # SJR: save old mask to allow undo
         self.mask_temp = self.mask.copy()
@@ -1642,18 +1513,24 @@ class Controller():
             return
 
         if not self.point_data:#MB added this to use this feature for epfl data
-            for k in range(fro,to):
-                mask_k = self.data.get_mask(k, force_original=False)  # MB added
-                if mask_k is not False:
-                    mask_k[mask_k == self.highlighted] = 0
-                    self.data.save_mask(k, mask_k, False)
-                    self.mask_change(k)
+            self._edit_masks({self.highlighted: 0}, range(fro, to))
 
         print("uccessfully deleted "+ str(self.highlighted) + " in all selected frames")
         # unhighlight and turn off neuron_bar button, careful!! does an update, which resets self.mask
         self.highlight_neuron(self.highlighted)
 
+    def _edit_masks(self, mapping, times):
+        """
+        Applies the label mapping (old label -> new label, 0 to delete) to the masks of the given times, see
+        mask_processing.mask_edit, then refreshes the presence and calcium activities once.
+        """
+        edited = mask_edit.edit_masks(self.data, mapping, list(times))
+        if edited:
+            self._masks_changed(edited)
+
     def undo_mask(self):
+        if self._editing_blocked():
+            return
         if self.options["mask_annotation_mode"] or self.options["boxing_mode"]:
             if self.mask_temp is not None:
                 self.mask = self.mask_temp
@@ -1686,7 +1563,8 @@ class Controller():
     def clear_NN_selective(self, fro, to):
         """
         Deletes the NN predictions within a time range for the highlighted neuron
-        :param fro, to: first and last frames for which to delete the NN predictions
+        :param fro, to: first and last frames for which to delete the NN predictions (for masks, the frames fro to to - 1,
+            as in renumber_All_mask_instances and delete_All_mask_instances)
         """
         if self.highlighted == 0:
             print("bug cfpark00@gmail.com")
@@ -1705,11 +1583,12 @@ class Controller():
                 client.change_ca_activity(self.hlab.ci_int)
             self.update()
         else:   # MB added this to use this feature for epfl data
-            for k in range(fro,to):
-                mask_k = self.data.get_mask(k, force_original=False)   # MB added
-                if mask_k is not False:
-                    mask_k[mask_k == self.highlighted] = 0
-                    self.mask_change(k)
+            # only the predictions of the selected NN instance are edited, never the ground truth masks
+            if self.NNmask_key == "":
+                print("You should first choose the NN instance")
+                return
+            mask_edit.edit_masks(self.data, {self.highlighted: 0}, range(fro, to), NN_key=self.NNmask_key)
+            self.update_mask_display()
             self.highlight_neuron(self.highlighted)   # todo: why not for point_data too?
 
     def approve_selective(self, fro, to):
@@ -1779,6 +1658,14 @@ class Controller():
                         self.mask_change(t)
                     else:
                         print("There are no predictions for this frame")
+
+    def materialize_NN_masks(self):
+        """Copies the predictions of the selected NN instance into the data set file (see h5Data.pull_NN_results)."""
+        if self.NNmask_key == "":
+            print("You should first choose the NN instance")
+        else:
+            self.data.materialize_NN_results(self.NNmask_key)
+
     def import_NN(self,Address):
         "save the parameters of NN trained on ExtFile for predicting the masks of the current file"
         ExtFile = DataSet.load_dataset(Address)
@@ -1827,7 +1714,6 @@ class Controller():
         if modelname == "RGN":
             return False, "RGN cannot be used for masks"
 
-        dset_path = self.data.path_from_GUI
         name = self.data.name
 
         # Check that the number of train/validation frames fits into the available number of frames
@@ -1849,9 +1735,9 @@ class Controller():
             return False, "There is an unpulled instance of this run."
 
         # we are safe now.
-        self.data.close()  # close
-        shutil.copyfile(dset_path, newpath)  # whole data set is copied in newpath
-        self.data = DataSet.load_dataset(dset_path)
+        # the NN works on a snapshot of the frames, masks and previous NN runs, the data set itself stays open
+        self.data.flush()
+        h5utils.nn_snapshot(self.data.dataset, newpath, run=modelname + "_" + instancename)
         if pred_mode:
             args = ["python3", "./src/neural_network_scripts/run_NNmasks_f.py", newpath, newlogpath,"2",str(epoch),"0","0",str(train),str(validation)]
         #setting the arguments of NN script.
@@ -1878,10 +1764,12 @@ class Controller():
             nnewpath = os.path.join(dfd, key + ".h5")
             nnewlogpath = os.path.join(dfd, key + ".log")
             shutil.move(newpath, os.path.join(key, nnewpath))
+            shutil.move(h5utils.snapshot_frames_path(newpath), os.path.join(key, h5utils.snapshot_frames_path(nnewpath)))
             shutil.copyfile(os.path.join("./src/neural_network_scripts/models", modelname + ".py"),
                             os.path.join(key, modelname + ".py"))
             shutil.copyfile("./src/neural_network_scripts/run_NNmasks_f.py", os.path.join(key, "run_NNmasks_f.py"))
             shutil.copyfile("./src/neural_network_scripts/NNtools.py", os.path.join(key, "NNtools.py"))
+            shutil.copyfile("./src/neural_network_scripts/unpack_cache.py", os.path.join(key, "unpack_cache.py"))
             with open(os.path.join(key, "run.sh"), "w") as f:
                 if not self.options["use_old_trainset"] and not self.options["generate_deformation"]:
                     Totstring = "0 " + str(epoch)+" 0 "+"0 "+str(train)+ " " +str(validation)
@@ -1945,6 +1833,10 @@ class Controller():
         NetName, runname = key.split("_")[-2:]
         newpath = os.path.join("data", "data_temp", key + ".h5")
         newlogpath = os.path.join("data", "data_temp", key + ".log")
+        # the frames of the snapshot are no longer needed, and no longer referenced once the results are pulled
+        frames_path = h5utils.snapshot_frames_path(newpath)
+        if os.path.exists(frames_path):
+            os.remove(frames_path)
         if success:
             self.data.pull_NN_results(NetName, runname, newpath)
             val, msg = True, "Pull Success"
@@ -1958,7 +1850,8 @@ class Controller():
             print("Deleting ", key)
             val, msg = True, "Deleted"
         os.remove(newlogpath)
-        os.remove(newpath)
+        if os.path.exists(newpath):
+            os.remove(newpath)
         self.subprocmanager.free(key)
         return val, msg
 
@@ -2056,12 +1949,36 @@ class Controller():
     def save_pointdat(self):
         self.data.set_poindat(self.pointdat)
 
+    def pending_writes(self):
+        """The number of saves of self.data that are not written to the file yet (see h5Data)."""
+        return self.data.pending_writes()
+
     def save_and_repack(self):
+        """
+        Saves and closes the data set, then repacks its file in a separate process if enough space can be reclaimed
+        (see h5utils.compact_in_background). The GUI is frozen, but not blocked, until the file is reopened (see
+        _check_repack).
+        """
+        if self._repack is not None:
+            return
         print("Repacking")
-        dset_path = self._close_data()
-        h5utils.repack(dset_path)
-        print("Repacked Dataset")
-        self._open_data(dset_path)
+        dset_path = self.pause_for_NN()
+        self._repack = (h5utils.compact_in_background(dset_path, float(self.settings.get("repack_threshold", 0.2))),
+                        dset_path)
+        for client in self.repack_registered_clients:
+            client.change_repack_status(True)
+        self.repack_timer.start()
+
+    def _check_repack(self):
+        process, dset_path = self._repack
+        if process.is_alive():
+            return
+        self.repack_timer.stop()
+        self._repack = None
+        self.unpause_for_NN(dset_path)
+        print("Repacked Dataset" if process.exitcode == 0 else "Repacking failed")
+        for client in self.repack_registered_clients:
+            client.change_repack_status(False, ok=process.exitcode == 0)
 
     def pause_for_NN(self):
         dset_path = self._close_data()
@@ -2074,14 +1991,33 @@ class Controller():
             client.unfreeze()
         self._open_data(dset_path)
 
+    def _configure_data_cache(self):
+        """
+        Sizes the frame cache of self.data and starts prefetching, according to the settings.
+        Also starts the thread that reads the frames in the background (see update), which needs the cache.
+        """
+        self.data.configure_cache(max_mb=float(self.settings.get("frame_cache_mb", 512)),
+                                  prefetch_radius=int(self.settings.get("prefetch_frames", 0)))
+        self._stop_frame_loader()
+        if int(self.settings.get("background_loading", 1)) and self.data.cache.max_bytes:
+            self._frame_loader = FrameLoader(self.data, self._frame_loaded.signal.emit)
+            self._frame_loader.start()
+
+    def _stop_frame_loader(self):
+        if self._frame_loader is not None:
+            self._frame_loader.stop()
+            self._frame_loader = None
+
     def _close_data(self):
         self.save_status()
         dset_path = self.data.path_from_GUI
+        self._stop_frame_loader()
         self.data.close()
         return dset_path
 
     def _open_data(self, dset_path):
         self.data = DataSet.load_dataset(dset_path)
+        self._configure_data_cache()
         if self.point_data:
             self.pointdat = self.data.pointdat
             for client in self.NN_instances_registered_clients:
@@ -26,7 +26,9 @@ class FeatureBuilder:
         """
         self.logger.debug(sys._getframe().f_code.co_name)
         dimensions = GlobalParameters.dimensions
-        for t in tqdm(frames):   # Todo: parallelize? (probably needs batches to get rid of classes)
+        frames = list(frames)
+        # the red frames are read ahead in batches, see DataSet.get_frames
+        for t, im_red in zip(tqdm(frames), self.data.get_frames(frames, stack=False)):   # Todo: parallelize? (probably needs batches to get rid of classes)
             if self.data.use_seg_for_feature:#MB added to get features from both segmentations or mask matrix
                 segmented = self.data.segmented_frame(t)
             else:
@@ -36,7 +38,6 @@ class FeatureBuilder:
             if not all_segs_bin.sum():
                 warnings.warn("Nothing was found by segmentation in frame {}".format(t))
                 continue
-            im_red = self.data.get_frame(t)
             if self.image_data is not None:
                 # get whole-frame, all-segments information (axes and center)
                 all_segs_data = get_all_segs_data(all_segs_bin, dimensions)#coordinates of mask pixels
@@ -48,12 +49,15 @@ class FeatureBuilder:
                 all_segs_data = None
                 rawimage_data = get_rawimage_data(im_red, dimensions)#MB changed it from None
             # Calculate features
+            segments, ftr_dicts = [], []
             for s in np.unique(segmented)[1:]:   # exclude  the first unique element which should always be 0
                 # TODO: this behaviour must be changed:
                 # use  all_segs_data or rawimage_data depending on whether "noseg" is used in ph.calculate_features:
                 if len(np.argwhere(segmented == s))>2:#MB added the if condition to avoid errors
                     ftr_dict = calculate_features(segmented == s, im_red, dimensions, all_segs_info=rawimage_data)
-                    self.data.save_features(t, s, ftr_dict)
+                    segments.append((t, s))
+                    ftr_dicts.append(ftr_dict)
+            self.data.save_features_bulk(segments, ftr_dicts)
 
 
 ########################################################################################################################
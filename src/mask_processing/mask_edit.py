@@ -0,0 +1,73 @@
+"""
+Bulk edition of the labels of the masks over a range of frames (renumbering or deleting a neuron in the whole movie...).
+An edit is a mapping old label -> new label (0 to delete), applied to each mask with a single lookup-table indexing.
+The frames whose masks do not contain any of the edited labels are found from the label index (see
+DataSet.mask_labels) and are neither read nor written; the other masks are read and written in chunks.
+Updating the neuron presence and the calcium activities is left to the caller, once for all frames (see
+Controller._masks_changed).
+The masks predicted by a NN are edited the same way, given the key of the NN.
+"""
+import numpy as np
+
+from ..helpers.helpers import batch
+
+
+def label_lut(mapping, max_label):
+    """
+    The lookup table of a label mapping.
+    :param mapping: dict old label -> new label
+    :param max_label: the largest label that the lookup table must accept
+    :return: 1D int16 array lut such that lut[label] is the new label of label
+    """
+    lut = np.arange(max(max_label, max(mapping)) + 1, dtype=np.int16)
+    for old, new in mapping.items():
+        lut[old] = new
+    return lut
+
+
+def remap(mask, lut):
+    """Applies the lookup table lut (see label_lut) to mask, extending lut if mask has larger labels."""
+    max_label = int(mask.max())
+    if max_label >= len(lut):
+        lut = np.concatenate([lut, np.arange(len(lut), max_label + 1, dtype=lut.dtype)])
+    return lut[mask]
+
+
+def affected_times(data, mapping, times, NN_key=None):
+    """
+    The times (among times) whose mask contains at least one of the labels of mapping, from the label index.
+    :param NN_key: None for the annotated masks, or the key of a NN for its predicted masks
+    """
+    labels = [old for old, new in mapping.items() if old != new]
+    affected = []
+    for t in times:
+        present = data.mask_labels(t, NN_key)
+        if present is not None and np.any(np.isin(labels, present)):
+            affected.append(t)
+    return affected
+
+
+def edit_masks(data, mapping, times, chunk_size=16, NN_key=None):
+    """
+    Applies a label mapping to the masks of data at the given times.
+    The masks are edited in the original space (the mapping commutes with the crop and the alignment).
+    :param data: DataSet
+    :param mapping: dict old label -> new label (0 to delete a neuron)
+    :param times: the times to edit (frames without mask or without any of the labels of mapping are skipped)
+    :param chunk_size: number of masks read and written at once
+    :param NN_key: None to edit the annotated masks, or the key of a NN to edit its predicted masks instead (the
+        annotated masks are then left untouched)
+    :return: the times whose mask was modified
+    """
+    times = affected_times(data, mapping, times, NN_key)
+    if not times:
+        return []
+    lut = label_lut(mapping, data.nb_neurons)
+    for times_chunk in batch(times, n=chunk_size):
+        if NN_key is None:
+            masks = data.get_masks(times_chunk, force_original=True, stack=False)
+            data.save_masks(times_chunk, [remap(mask, lut) for mask in masks])
+        else:   # the predicted masks are stored as they are (see DataSet.save_NN_mask)
+            for t in times_chunk:
+                data.save_NN_mask(t, NN_key, remap(data.get_NN_mask(t, NN_key), lut))
+    return times
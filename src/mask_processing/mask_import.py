@@ -0,0 +1,156 @@
+"""
+Bulk import of the masks of another dataset (e.g. the NN predictions on a cropped and rotated copy of the movie, see
+Controller.import_mask_from_external_file) into the current dataset.
+The import runs in three passes: the (cheap) crop and alignment parameters of every frame are gathered first, then
+the masks are read in chunks from the external file, put back into the original space by a pool of worker processes
+and written to the current dataset by the calling process, the next chunk being read while the workers process the
+previous one. Updating the neuron presence and the calcium activities is left to the caller, once for all frames.
+"""
+import multiprocessing
+import os
+import numpy as np
+
+from ..graphic_interface.image_standardizer import reverse_transform_mask
+from ..helpers.helpers import batch
+from ..parameters.GlobalParameters import GlobalParameters
+
+
+def place_mask(img, placement):
+    """
+    Puts a mask of the external dataset in a frame of the shape of the current dataset, as
+    Controller.import_mask_from_external_file always did.
+    :param img: mask of the external dataset
+    :param placement: None (the mask is kept as is), ("cuts", intervals, shape) to put the mask at the x,y,z intervals
+        of the original frame that the external frames come from (in a zero array of the given shape), or
+        ("pad_z", z_interval, D, crop) to put it at the z_interval of D z-planes (only when the numbers of z-planes
+        differ), crop meaning that the mask itself is cut to z_interval
+    """
+    if placement is None:
+        return img
+    if placement[0] == "cuts":
+        _, intervals, shape = placement
+        new_img = np.zeros(shape)
+        new_img[tuple(slice(int(a), int(b)) for a, b in intervals)] = img
+        return new_img
+    _, (z_0, z_1), D, crop = placement
+    if img.shape[2] == D:
+        return img
+    new_img = np.zeros(img.shape[:2] + (D,))
+    new_img[:, :, int(z_0):int(z_1)] = img[:, :, int(z_0):int(z_1)] if crop else img
+    return new_img
+
+
+def prepare_mask(img, placement, params):
+    """
+    The mask to store in the current dataset.
+    :param img: mask of the external dataset
+    :param placement: see place_mask
+    :param params: reverse transformations, see DataSet.reverse_transform_params (empty to keep the mask as placed)
+    """
+    mask = place_mask(img, placement)
+    if params:
+        mask = reverse_transform_mask(mask, **params)
+    return mask
+
+
+def _prepare_mask(args):
+    return prepare_mask(*args)
+
+
+def plan_import(data, ext, transformation_mode, transform_back, undo_cuts):
+    """
+    Matches the masks of ext to the frames of data and gathers, for each of them, how it is put back into the original
+    space (without reading any mask).
+    When transform_back, the ROI and the transformations of ext are copied into data while the parameters of each frame
+    are computed, and restored afterwards as Controller.import_mask_from_external_file always did.
+    :param data: the current DataSet
+    :param ext: the DataSet whose masks are imported
+    :param transformation_mode: 0 for transformation matrices, 1 for rotation angles and offsets
+    :param transform_back: whether the masks are in the cropped and aligned space of ext
+    :param undo_cuts: whether the masks are in a subregion of the original frames (see DataSet.original_intervals)
+    :return: list of (t in ext, t in data, placement, params), see prepare_mask
+    """
+    shape = data.get_frame(0, col="red").shape
+    centerRot = 1 if transformation_mode else 0
+    jobs = []
+    for t in ext.segmented_times():
+        # the frames of ext are assumed to come from the current dataset, frame t of ext corresponding to frame origIndex
+        origIndex = ext.get_frame_match(t)
+        if origIndex is False:
+            origIndex = t
+        origIndex = int(origIndex)
+        if origIndex >= data.frame_num:
+            continue
+        if undo_cuts:
+            placement = ("cuts", ext.original_intervals(), shape)
+        elif transform_back:
+            placement = ("pad_z", (0, 31), shape[2], True)
+        else:
+            z_interval = ext.original_intervals("z")
+            placement = ("pad_z", (0, 32) if z_interval is None else tuple(z_interval), shape[2], False)
+        if not transform_back:
+            params = data.reverse_transform_params(origIndex, centerRot) if undo_cuts else {}
+            jobs.append((t, origIndex, placement, params))
+            continue
+        # copy the cropping and transformation parameters of ext temporarily into the current dataset
+        if transformation_mode:
+            origTrans, _ = ext.get_transfoAngle(origIndex)
+        else:
+            origTrans = data.get_transformation(origIndex)
+        origROI = data.get_ROI_params()
+        restore = origROI is not None and origTrans is not None
+        data.save_ROI_params(*ext.get_ROI_params())
+        if transformation_mode:
+            mat = np.zeros(4)
+            mat[0], mat[1:] = ext.get_transfoAngle(t)
+            data.save_transformation_matrix(origIndex, mat, 1)
+        else:
+            data.save_transformation_matrix(origIndex, ext.get_transformation(t))
+        OrigCrop, OrigAlign = data.crop, data.align
+        data.crop = True
+        data.align = True
+        jobs.append((t, origIndex, placement, data.reverse_transform_params(origIndex, centerRot)))
+        if restore:
+            if not transformation_mode:
+                data.save_transformation_matrix(origIndex, origTrans)
+            data.save_ROI_params(*origROI)
+        data.crop, data.align = OrigCrop, OrigAlign
+    return jobs
+
+
+def import_masks(data, ext, jobs, green=False, progress=None, n_workers=None):
+    """
+    Reads, puts back into the original space and writes the masks of jobs (see plan_import).
+    :param data: the current DataSet, where the masks are written
+    :param ext: the DataSet whose masks are imported
+    :param green: if True, the masks are merged as green masks (see DataSet.save_green_mask)
+    :param progress: None or callable, progress(done, total) is called after each chunk is written
+    :param n_workers: number of processes (default: GlobalParameters.n_processes, or the number of cores)
+    :return: the times of data whose mask was written
+    """
+    n_workers = n_workers or GlobalParameters.n_processes or os.cpu_count()
+    written = []
+
+    def read(jobs_batch):
+        imgs = ext.get_masks([job[0] for job in jobs_batch], force_original=True, stack=False)
+        return [(img, placement, params) for img, (_, _, placement, params) in zip(imgs, jobs_batch)]
+
+    def write(jobs_batch, masks):
+        times = [job[1] for job in jobs_batch]
+        data.save_masks(times, masks, green=green)
+        written.extend(times)
+        if progress is not None:
+            progress(len(written), len(jobs))
+
+    # while the workers process a chunk, the previous one is written and the next one is read
+    # (the workers are spawned: forking the GUI process, whose other threads may hold locks, could deadlock them)
+    with multiprocessing.get_context("spawn").Pool(processes=n_workers) as pool:
+        pending = None
+        for jobs_batch in batch(jobs, n=4 * n_workers):
+            results = pool.map_async(_prepare_mask, read(jobs_batch))
+            if pending is not None:
+                write(pending[0], pending[1].get())
+            pending = (jobs_batch, results)
+        if pending is not None:
+            write(pending[0], pending[1].get())
+    return written
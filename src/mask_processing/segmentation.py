@@ -55,12 +55,11 @@ class Segmenter:
         self.logger.debug("Segmenting frames {} with parameters {}".format(frames_to_segment, self.parameters))
         params = {"dimensions": GlobalParameters.dimensions, **self.parameters}
         for frames in h.batch(frames_to_segment):
-            images = [self.data.get_frame(t, force_original=True) for t in frames]
+            images = list(self.data.get_frames(frames, force_original=True))
             segments = h.parallel_process(images, neuron_segmentation2, params)
             for t, segmented in zip(frames, segments):
                 self.data.save_mask(t, segmented, force_original=True)   # Todo: this will interfere with any pre-existing neurons
                 # save_mask; creates  datasets of seg amd mask for the frame ans saves the segmentation in both of them
-        # todo: if loading video is long, could also be parallelized?
 
 
 class NeuronSegmentationCache:
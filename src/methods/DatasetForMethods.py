@@ -1,6 +1,7 @@
 import h5py
 import numpy as np
 import os
+from src.neural_network_scripts import unpack_cache
 supported_suffixes=["h5"]
 
 class Dataset:
@@ -69,6 +70,11 @@ class Dataset:
                     ds=self.data.create_dataset(key,frame.shape,frame.dtype,compression=compression)
                     ds[...]=frame
 
+    def get_digest(self,keys):
+        assert self.data is not None, "file not open"
+        if self.suffix=="h5":
+            return unpack_cache.digest(*[self.data[key] for key in keys])
+
     def get_frame_z(self,time,z):
         assert self.data is not None, "file not open"
         if self.suffix=="h5":
@@ -6,17 +6,15 @@ from torch.utils.data import Dataset
 import os
 import glob
 import cc3d
+from src.neural_network_scripts import unpack_cache
 
 class TrainDataset(Dataset):
     def __init__(self,folpath,shape):
         super().__init__()
         self.folpath=folpath
         self.shape=shape
-        self.framefolpath=os.path.join(self.folpath,"frames")
-        self.maskfolpath=os.path.join(self.folpath,"masks")
-        self.filelist=glob.glob(os.path.join(self.maskfolpath,"*"))
-        self.indlist=[int(os.path.split(file)[1].split(".")[0]) for file in self.filelist]
-        self.indlist=np.array(self.indlist)
+        self.cache=unpack_cache.UnpackCache(self.folpath)
+        self.indlist=self.cache.times("masks")
         self.num_frames_tot=len(self.indlist)
 
         inf={}
@@ -109,8 +107,8 @@ class TrainDataset(Dataset):
     def __getitem__(self,i):
         assert 0<=i<self.num_frames_tot
         ii=self.indlist[i]
-        fr=(torch.load(os.path.join(self.framefolpath,str(ii)+".pt"))/255).to(torch.float32)
-        mask=torch.load(os.path.join(self.maskfolpath,str(ii)+".pt"))
+        fr=(torch.from_numpy(self.cache.get("frames",ii))/255).to(torch.float32)
+        mask=torch.from_numpy(self.cache.get("masks",ii))
         fr,mask=self.get_trf(fr,mask,self.augment)
         return [fr,mask]
 
@@ -132,20 +130,18 @@ class EvalDataset(Dataset):
         super().__init__()
         self.maxz=maxz
         self.folpath=folpath
-        self.framefolpath=os.path.join(self.folpath,"frames")
+        self.cache=unpack_cache.UnpackCache(self.folpath)
         self.mask=mask
-        if self.mask:
-            self.maskfolpath=os.path.join(self.folpath,"masks")
         self.num_frames_tot=T
 
 
     def __getitem__(self,i):
         assert 0<=i<self.num_frames_tot
-        fr=(torch.load(os.path.join(self.framefolpath,str(i)+".pt"))/255).to(torch.float32)
+        fr=(torch.from_numpy(self.cache.get("frames",i))/255).to(torch.float32)
         if self.mask:
-            maskfp=os.path.join(self.maskfolpath,str(i)+".pt")
-            if (not self.maxz) and os.path.exists(maskfp):
-                mask=torch.load(maskfp).to(torch.long)
+            mask=self.cache.get("masks",i)
+            if (not self.maxz) and mask is not None:
+                mask=torch.from_numpy(mask).to(torch.long)
             else:
                 mask=None
             if self.maxz:
@@ -6,6 +6,7 @@ from torch.utils.data import Dataset
 import os
 import glob
 import cc3d
+from src.neural_network_scripts import unpack_cache
 import scipy.stats as sstats
 
 def get_maskpts(labels,coords,gridpts,radius=4):
@@ -184,20 +185,18 @@ class EvalDataset(Dataset):
         super().__init__()
         self.maxz=maxz
         self.folpath=folpath
-        self.framefolpath=os.path.join(self.folpath,"frames")
+        self.cache=unpack_cache.UnpackCache(self.folpath)
         self.mask=mask
-        if self.mask:
-            self.maskfolpath=os.path.join(self.folpath,"masks")
         self.num_frames_tot=T
 
 
     def __getitem__(self,i):
         assert 0<=i<self.num_frames_tot
-        fr=(torch.load(os.path.join(self.framefolpath,str(i)+".pt"))/255).to(torch.float32)
+        fr=(torch.from_numpy(self.cache.get("frames",i))/255).to(torch.float32)
         if self.mask:
-            maskfp=os.path.join(self.maskfolpath,str(i)+".pt")
-            if (not self.maxz) and os.path.exists(maskfp):
-                mask=torch.load(maskfp).to(torch.long)
+            mask=self.cache.get("masks",i)
+            if (not self.maxz) and mask is not None:
+                mask=torch.from_numpy(mask).to(torch.long)
             else:
                 mask=None
             if self.maxz:
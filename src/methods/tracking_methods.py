@@ -60,22 +60,14 @@ class NNTA():
         from src.methods.neural_network_tools import Deformation
         import torch
         from src.methods.neural_network_tools import Networks
+        from src.neural_network_scripts import unpack_cache
         if self.params["Targeted"] and self.params["umap_dim"] is not None:
             import umap
         self.device= torch.device('cuda' if torch.cuda.is_available() else 'cpu')
         self.state=["Preparing",0]
         self.dataset=Dataset(file_path)
-        _,file=os.path.split(file_path)
-        folname=file.split(".")[0]
-        self.folpath=os.path.join("data","data_temp",folname)
-        if os.path.exists(self.folpath):
-            shutil.rmtree(self.folpath)
-            pass
-        os.makedirs(self.folpath)
         self.dataset.open()
         self.data_info=self.dataset.get_data_info()
-        os.makedirs(os.path.join(self.folpath,"frames"))
-        os.makedirs(os.path.join(self.folpath,"masks"))
 
         #make files
         if True:
@@ -92,7 +84,6 @@ class NNTA():
             gridpts=grid.reshape(3,-1).T
             grid_dimend=grid.transpose(1,2,3,0)
 
-            traininds=[]
             train_data=NNtools_points.TrainDataset((n_channels,W,H,D))
 
             #don't think about non existing points
@@ -102,27 +93,33 @@ class NNTA():
             N_labels=len(labels_to_inds)
             inds_to_labels=np.zeros(N_points+1)
             inds_to_labels[labels_to_inds]=np.arange(N_labels)
-            for t in range(T):
-                if self.cancel:
-                    self.quit()
-                    return
-                image=self.dataset.get_frame(t)[channels]
-                image=torch.tensor(image,dtype=torch.uint8)
-                torch.save(image,os.path.join(self.folpath,"frames",str(t)+".pt"))
-                #if (self.params["traininds"] is not None) and (t not in self.params["traininds"]):
-                #    continue
-                pts=points[t]
-                valid=~np.isnan(pts[:,0])
-                if valid.sum()>=min_points:
-                    inds=np.nonzero(valid)[0]
-                    maskpts=NNtools_points.get_maskpts(inds_to_labels[inds],pts[inds],gridpts,self.params["mask_radius"])
-                    mask=torch.tensor(maskpts.reshape(W,H,D),dtype=torch.uint8)
-                    torch.save(mask,os.path.join(self.folpath,"masks",str(t)+".pt"))
-                    train_data.add_data(image,mask,"gt")
-                    traininds.append(t)
-                self.state[1]=int(100*(t+1)/T)
+
+            def progress(done,total):
+                self.state[1]=int(100*done/total)
                 if self.params["verbose"]:
                     print("\r"+self.state[0]+" "+str(self.state[1]),end="")
+                return not self.cancel
+            #the unpacked frames are kept for the next runs on the same frames (see unpack_cache)
+            frames_key=unpack_cache.digest(self.dataset.get_digest([str(t)+"/frame" for t in range(T)]),[int(c) for c in channels])
+            cache=unpack_cache.open_cache(frames_key)
+            self.folpath=cache.dirname
+            if not cache.unpack("frames",frames_key,range(T),(n_channels,W,H,D),np.uint8,lambda t: self.dataset.get_frame(t)[channels],progress=progress):
+                self.quit()
+                return
+            #if (self.params["traininds"] is not None) and (t not in self.params["traininds"]):
+            #    continue
+            traininds=[t for t in range(T) if np.sum(~np.isnan(points[t][:,0]))>=min_points]
+            def get_mask(t):
+                pts=points[t]
+                inds=np.nonzero(~np.isnan(pts[:,0]))[0]
+                maskpts=NNtools_points.get_maskpts(inds_to_labels[inds],pts[inds],gridpts,self.params["mask_radius"])
+                return maskpts.reshape(W,H,D)
+            masks_key=unpack_cache.digest(traininds,points,self.params["mask_radius"])
+            if not cache.unpack("masks",masks_key,traininds,(W,H,D),np.uint8,get_mask,progress=progress):
+                self.quit()
+                return
+            for t in traininds:
+                train_data.add_data(torch.from_numpy(cache.get("frames",t)),torch.from_numpy(cache.get("masks",t)),"gt")
             traininds=np.array(traininds)
 
         #Make posture space if TA
@@ -19,6 +19,31 @@ from skimage.measure import find_contours
 import conv_autoenc1
 import torch.nn as nn
 import umap.umap_ as umap
+import unpack_cache
+import h5_compact
+
+def load_frame(dirname,cache,ii,n_channels,high):
+    """The first n_channels channels of frame ii divided by 255, from the unpack cache (see unpack_cache) or from the directory-of-npy layout. If high, it is kept in the "high" region only."""
+    if cache is not None:
+        fr=cache.get("frames",ii)[:n_channels]/255
+    else:
+        fr=np.load(dirname+"/frames/frame_"+str(ii)+".npy")[:n_channels]/255
+    if high:
+        if cache is not None:
+            region=cache.get("highs",ii)
+        else:
+            region=np.sum(np.load(dirname+"/highs/high_"+str(ii)+".npy")/255,axis=0)>0.5
+        fr=fr*region[None,:,:,None]
+    return fr
+
+def load_mask(dirname,cache,ii,maskdirname="masks"):
+    """The mask ii of modality (or directory) maskdirname, None if there is none."""
+    if cache is not None and maskdirname in cache:
+        return cache.get(maskdirname,ii)
+    try:
+        return np.load(os.path.join(dirname,maskdirname,"mask_"+str(ii)+".npy"))
+    except FileNotFoundError:
+        return None
 
 class TrainDataset(Dataset):
     def __init__(self,dirname,shape,meansub=False,high=False,maskdirname="masks"):
@@ -27,9 +52,13 @@ class TrainDataset(Dataset):
         self.dirname=dirname
         self.maskdirname=maskdirname
         self.shape=shape
-        self.filelist=glob.glob(os.path.join(self.dirname,self.maskdirname,"*"))
-        self.indlist=[int(name.strip().split("/")[-1].split("_")[-1].split(".")[0]) for name in self.filelist]   # Todo cleaner with path.??
-        self.indlist=np.array(self.indlist)
+        self.cache=unpack_cache.UnpackCache(dirname) if unpack_cache.UnpackCache.exists(dirname) else None
+        if self.cache is not None and self.maskdirname in self.cache:
+            self.indlist=self.cache.times(self.maskdirname)
+        else:
+            filelist=glob.glob(os.path.join(self.dirname,self.maskdirname,"*"))
+            self.indlist=[int(name.strip().split("/")[-1].split("_")[-1].split(".")[0]) for name in filelist]   # Todo cleaner with path.??
+            self.indlist=np.array(self.indlist)
         self.num_frames_tot=len(self.indlist)
         self.meansub=meansub
         inf={}
@@ -112,11 +141,8 @@ class TrainDataset(Dataset):
     def __getitem__(self,i):
         assert 0<=i<self.num_frames_tot
         ii=self.indlist[i]
-        fr=np.load(self.dirname+"/frames/frame_"+str(ii)+".npy")[:self.shape[0]]/255
-        mask=np.load(os.path.join(self.dirname,self.maskdirname,"mask_"+str(ii)+".npy"))
-        if self.high:
-            high=np.load(self.dirname+"/highs/high_"+str(ii)+".npy")/255
-            fr=fr*(np.sum(high,axis=0)>0.5)[None,:,:,None]
+        fr=load_frame(self.dirname,self.cache,ii,self.shape[0],self.high)
+        mask=load_mask(self.dirname,self.cache,ii,self.maskdirname)
         fr=fr.astype(np.float32)
         if self.meansub:
             fr=fr-np.mean(fr,axis=(1,2,3))[:,None,None,None]
@@ -146,33 +172,39 @@ class EvalDataset(Dataset):
         self.dirname=dirname
         self.meansub=meansub
         self.high=high
+        self.cache=unpack_cache.UnpackCache(dirname) if unpack_cache.UnpackCache.exists(dirname) else None
 
     def __getitem__(self,ii):
-        fr=np.load(self.dirname+"/frames/frame_"+str(ii)+".npy")[:self.shape[0]]/255
-        try:
-            mask=np.load(self.dirname+"/masks/mask_"+str(ii)+".npy")
+        fr=load_frame(self.dirname,self.cache,ii,self.shape[0],self.high)
+        mask=load_mask(self.dirname,self.cache,ii)
+        if mask is not None:
             mask=torch.Tensor(mask)
-        except FileNotFoundError:
-            mask=None
-        if self.high:
-            high=np.load(self.dirname+"/highs/high_"+str(ii)+".npy")/255
-            fr=fr*(np.sum(high,axis=0)>0.5)[None,:,:,None]
         fr=fr.astype(np.float32)
         if self.meansub:
             fr=fr-np.mean(fr,axis=(1,2,3))[:,None,None,None]
         return [torch.Tensor(fr),mask]
 
-def repack(h5fn):
-    h5=h5py.File(h5fn,"r")
-    h5new=h5py.File(h5fn+"_temp","w")
-    for key,val in h5.items():
-        h5.copy(key,h5new)
-    for key,val in h5.attrs.items():
-        h5new.attrs[key]=val
-    h5.close()
-    h5new.close()
-    os.remove(h5fn)
-    os.rename(h5fn+"_temp",h5fn)
+def repack(h5fn,threshold=0.):
+    """
+    Rewrites h5fn to reclaim the space of deleted datasets, if the reclaimable space is more than threshold times the
+    file size (see h5_compact.repack: the external links of a NN snapshot stay links).
+    """
+    h5_compact.repack(h5fn,threshold=threshold)
+
+def mask_labels(h5,i):
+    """
+    The labels in the mask of frame i (background 0 included, as with np.unique), read from the label index written by
+    the GUI ("label_index/mask/i", see h5utils.label_stats) when available, instead of decompressing the mask.
+    """
+    key="label_index/mask/"+str(i)
+    mkey=str(i)+"/mask"
+    if key not in h5:
+        return np.unique(h5[mkey])
+    stats=np.array(h5[key])
+    labels=stats[:,0]
+    if stats[:,1].sum()<np.prod(h5[mkey].shape):#some background voxels
+        labels=np.concatenate([[0],labels])
+    return labels
 
 def save_into_h5(h5,state_dict):
     for key,val in state_dict.items():
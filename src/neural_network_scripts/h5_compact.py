@@ -0,0 +1,78 @@
+"""
+Reclaiming the space of the datasets deleted from an h5 file, by rewriting the file when enough space can be reclaimed.
+External links (e.g. the groups "{t}" of a NN snapshot, which point to the frames file, see h5utils.nn_snapshot) are
+rewritten as links, not replaced by a copy of what they point to.
+This module only depends on h5py: it is imported by the NN scripts (import h5_compact, see NNtools.repack) as well as
+by src.h5utils.
+"""
+import os
+import h5py
+
+
+def metadata_bytes(h5):
+    """
+    The space taken in the open file h5 by its metadata: the object headers, the chunk indices of the datasets, the
+    heaps of the groups and the attributes (the superblock, a few hundred bytes, is neglected).
+    """
+    sizes = []
+
+    def add_metadata(name, obj):
+        info = h5py.h5o.get_info(obj.id)
+        sizes.append(info.hdr.space.total + info.meta_size.obj.index_size + info.meta_size.obj.heap_size
+                     + info.meta_size.attr.index_size + info.meta_size.attr.heap_size)
+
+    add_metadata("/", h5)
+    h5.visititems(add_metadata)   # does not follow the external links, which point to other files
+    return sum(sizes)
+
+
+def reclaimable_bytes(h5fn):
+    """
+    Estimates how much space repacking h5fn would reclaim: the size of the file minus the storage of its datasets and
+    its metadata (see metadata_bytes).
+    :return: reclaimable, file_size (in bytes)
+    """
+    used = []
+
+    def add_storage(name, obj):
+        if isinstance(obj, h5py.Dataset):
+            used.append(obj.id.get_storage_size())
+
+    with h5py.File(h5fn, "r") as h5:
+        h5.visititems(add_storage)
+        meta = metadata_bytes(h5)
+    file_size = os.path.getsize(h5fn)
+    return max(0, file_size - sum(used) - meta), file_size
+
+
+def copy_item(h5, key, dst):
+    """
+    Copies h5[key] into the group dst under the same name; an external link is copied as such (the objects inside
+    the groups keep their external links, since h5py copies them as links).
+    """
+    link = h5.get(key, getlink=True)
+    if isinstance(link, h5py.ExternalLink):
+        dst[key] = h5py.ExternalLink(link.filename, link.path)
+    else:
+        h5.copy(key, dst)
+
+
+def repack(h5fn, threshold=0.):
+    """
+    Rewrites h5fn to reclaim the space of deleted datasets, if the reclaimable space (see reclaimable_bytes) is more
+    than threshold times the file size.
+    The copy only replaces h5fn once complete, so that an interruption leaves h5fn intact.
+    :return: True if the file was rewritten
+    """
+    if os.path.exists(h5fn + "_temp"):   # leftover of an interrupted repack
+        os.remove(h5fn + "_temp")
+    reclaimable, file_size = reclaimable_bytes(h5fn)
+    if reclaimable <= threshold * file_size:
+        return False
+    with h5py.File(h5fn, "r") as h5, h5py.File(h5fn + "_temp", "w") as h5new:
+        for key in h5:
+            copy_item(h5, key, h5new)
+        for key, val in h5.attrs.items():
+            h5new.attrs[key] = val
+    os.replace(h5fn + "_temp", h5fn)
+    return True
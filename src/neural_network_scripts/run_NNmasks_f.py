@@ -6,6 +6,7 @@ import importlib
 import numpy as np
 import torch
 import NNtools
+import unpack_cache
 import shutil
 import time
 import scipy.spatial as spat
@@ -61,7 +62,8 @@ channel_num=2
 
 
 ##directory handling
-reusedirec="data/data_temp/zmdir"
+#the unpacked frames and masks are kept in unpack_cache.CACHE_ROOT, in a directory named after the content of the
+#frames, for the next runs on the same data (see unpack_cache)
 
 
 #neural network training parameters
@@ -116,7 +118,7 @@ write_log(logform.format(0.,0.,0.,0.))
 def repack():# MB: closes current h5 and opens a new one
     global h5
     h5.close()
-    NNtools.repack(dataset_path)
+    NNtools.repack(dataset_path,threshold=0.2)#only rewritten if at least 20% of the file can be reclaimed
     h5=h5py.File(dataset_path,"r+")
 def save_backup():#MB: closes, saves and opens the file in readable format again
     global h5
@@ -136,75 +138,53 @@ else:
     log=""
     h5[identifier].attrs["log"]=log
 
-if reusedirec is not None:#MB: use the dir of masks and frames for training if it already exists
-    datadir=reusedirec
-else:
-    datadir=os.path.join("data","data_temp",dataset_name)
+frames_key=unpack_cache.frames_key(h5,T)
+cache=unpack_cache.open_cache(frames_key)
+datadir=cache.dirname
+rundir=cache.run_dir()#what this run writes besides the cache (deformed frames...), see unpack_cache
 
 
-#### The computation loop is all in a try except to delete the data
+#### The computation loop
 if verbose:
     print("Preparing...")
 try:
     num_classes=h5.attrs["N_neurons"]+1
 
 
-    ####Unpack for fast, multiprocessed loading, unless already unpacked
-    #MB: if not already done, this part saves all the frames and all the masks (which are less than the number of frames.)
+    ####Unpack for fast, multiprocessed loading, unless already unpacked from the same data (see unpack_cache)
+    #MB: this part saves all the frames and all the masks (which are less than the number of frames.)
 
     DeforemeFrames = int(sys.argv[6])#whether or not add the deformed frames?
-    if reusedirec is None or not os.path.exists(reusedirec):   # TODO: is this correct?
-        os.mkdir(datadir)
-        os.mkdir(os.path.join(datadir,"frames"))
-        os.mkdir(os.path.join(datadir,"highs"))
-        os.mkdir(os.path.join(datadir,"masks"))
-        Ntot=0
-        Nans=0
-        print("unpacking frames")#MB check
-        for i in range(T):# I think this unpacks all the segmented/mask frames -MB
-            write_log(logform.format(min(i/T,0.8),0.,0.,0.))
-            fr=np.array(h5[str(i)+"/frame"]).astype(np.int16)   # TODO: access to dataset with methods?
-            np.save(os.path.join(datadir,"frames","frame_"+str(i)+".npy"),fr)
-            Ntot+=1
-
-            if str(i)+"/high" in h5.keys():
-                np.save(os.path.join(datadir,"highs","high_"+str(i)+".npy"),np.array(h5[str(i)+"/high"]).astype(np.int16))
+    print("unpacking frames")#MB check
+    unpack_cache.unpack_frames(cache,h5,T,key=frames_key,progress=lambda i,n: write_log(logform.format(min(i/n,0.8),0.,0.,0.)))
+    if GetTrain == 0:
+        mask_times=[i for i in range(T) if str(i)+"/mask" in h5.keys()]
+    if GetTrain == 1:
+        k = 0#index of the dataset you want to copy, usually 0 for the first datasset
+        NNname = list(h5['net'].keys())#the new network is NNname[0] so use NNname[1] to access previous networks training set
+        traininds = h5['net'][NNname[k]].attrs['traininds']#train indices are saved as an attribute of the first dataset(run w/O deformation)
+        mask_times=list(traininds)#placing the training frames and masks in the deformation folder
+        if DeforemeFrames == 1:
+            num_added_frames = int(sys.argv[7])
+            if num_added_frames==0:
+                mask_times+=list(range(origfrNum,T))#to add the deformed frames
             else:
-                np.save(os.path.join(datadir,"highs","high_"+str(i)+".npy"),np.full((1,W,H),255).astype(np.int16))
-
-            if GetTrain == 0:
-                if str(i)+"/mask" in h5.keys():
-                    np.save(os.path.join(datadir,"masks","mask_"+str(i)+".npy"),np.array(h5[str(i)+"/mask"]).astype(np.int16))
-                    Nans+=1
-        if GetTrain == 1:
-            k = 0#index of the dataset you want to copy, usually 0 for the first datasset
-            NNname = list(h5['net'].keys())#the new network is NNname[0] so use NNname[1] to access previous networks training set
-            traininds = h5['net'][NNname[k]].attrs['traininds']#train indices are saved as an attribute of the first dataset(run w/O deformation)
-            for j in traininds:#placing the training frames and masks in the deformation folder
-                np.save(os.path.join(datadir,"masks","mask_"+str(j)+".npy"),np.array(h5[str(j)+"/mask"]).astype(np.int16))
-                Nans+=1
-            if DeforemeFrames == 1:
-                num_added_frames = int(sys.argv[7])
-                if num_added_frames==0:
-                    for l in range(origfrNum,T):#to add the deformed frames
-                        np.save(os.path.join(datadir,"masks","mask_"+str(l)+".npy"),np.array(h5[str(l)+"/mask"]).astype(np.int16))
-                        Nans+=1
-                else:
-                    for l in range(origfrNum,origfrNum+num_added_frames):#to add the deformed frames
-                        np.save(os.path.join(datadir,"masks","mask_"+str(l)+".npy"),np.array(h5[str(l)+"/mask"]).astype(np.int16))
-                        Nans+=1
-
-            tnum="all"
-            vnum=0
+                mask_times+=list(range(origfrNum,origfrNum+num_added_frames))#to add the deformed frames
 
-        assert Nans>0, "At least one mask is needed"
+        tnum="all"
+        vnum=0
+    mask_times=sorted(set(int(i) for i in mask_times))
+    assert len(mask_times)>0, "At least one mask is needed"
+    mask_dsets=[h5[str(i)+"/mask"] for i in mask_times]
+    cache.unpack("masks",unpack_cache.digest(mask_times,*mask_dsets),mask_times,mask_dsets[0].shape,np.int16,
+                 lambda i: h5[str(i)+"/mask"][...])
 
     allset=NNtools.TrainDataset(datadir,shape)
 
     ''' MB added the following section to get the right total number of cells as categories'''
     U =set() #MB added
     for i in allset.indlist :
-        U=U.union(set(np.unique(h5[str(i)+"/mask"])))
+        U=U.union(set(NNtools.mask_labels(h5,i)))
     num_classes = len(U)#MB added
 
     #### Initialize the network ####
@@ -266,7 +246,7 @@ try:
 
     Ut =set() #MB added
     for i in traininds :
-        Ut=Ut.union(set(np.unique(h5[str(i)+"/mask"])))
+        Ut=Ut.union(set(NNtools.mask_labels(h5,i)))
     current_classes = len(Ut)#MB added
     print("existing classes in the training set are:")
     print(Ut)
@@ -493,27 +473,22 @@ try:
             if verbose:
                 print("Adding Deformed Frames")
             #copy the existing masks first
-            dir_deformations=os.path.join(datadir,"deformations")
+            dir_deformations=os.path.join(rundir,"deformations")
             if os.path.exists(dir_deformations):
-                shutil.rmtree(dir_deformations)#remove the deformed frames from the previous runs
+                shutil.rmtree(dir_deformations)#remove the deformed frames from a previous step of this run
             os.mkdir(dir_deformations)
-            os.mkdir(os.path.join(datadir,"deformations","frames"))
-            os.mkdir(os.path.join(datadir,"deformations","masks"))
-            for name in np.array(allset.filelist)[allset.real_ind_to_dset_ind(traininds)]:#placing the training frames and masks in the deformation folder
-                i=int(os.path.split(name)[-1].split(".")[0].split("_")[1])
-                shutil.copyfile(os.path.join(datadir,"frames","frame_"+str(i)+".npy"),os.path.join(datadir,"deformations","frames","frame_"+str(i)+".npy"))
-                shutil.copyfile(name,os.path.join(datadir,"deformations","masks","mask_"+str(i)+".npy"))
+            cache.export_npy(allset.indlist[allset.real_ind_to_dset_ind(traininds)],dir_deformations)#placing the training frames and masks in the deformation folder
 
             if defTrick == 3:
                 deformMethod =  int(sys.argv[9])
                 with torch.no_grad():
-                    plots_dir = os.path.join(datadir, 'targeted_augmentation_plots')
+                    plots_dir = os.path.join(rundir, 'targeted_augmentation_plots')
                     if not os.path.exists(plots_dir):
                         os.makedirs(plots_dir)
                     plot_results = True
                     targeted_augmentation_objects3.targeted_augmentation(h5, num_additional, datadir, allset, traininds,
                                                                         T, identifier, shape,num_classes, plot_results=plot_results,
-                                                                        plots_dir=plots_dir,method = deformMethod)
+                                                                        plots_dir=plots_dir,method = deformMethod,rundir=rundir)
             else:
                 distmat=np.array(h5["distmat"])
                 additional_inds=NNtools.select_additional(T,traininds,distmat,num_additional)[len(traininds):]#index of frames used for augmentation
@@ -779,8 +754,8 @@ try:
                                 checkMB = 1
                             if checkMB==1:
                                 h5.attrs["oldT"]=T
-                                np.save(os.path.join(datadir,"deformations","frames","frame_"+str(T+ExtframeCount)+".npy"),frC) #we add T to avoid collision, but don't want to define another class
-                                np.save(os.path.join(datadir,"deformations","masks","mask_"+str(T+ExtframeCount)+".npy"),mask)
+                                np.save(os.path.join(rundir,"deformations","frames","frame_"+str(T+ExtframeCount)+".npy"),frC) #we add T to avoid collision, but don't want to define another class
+                                np.save(os.path.join(rundir,"deformations","masks","mask_"+str(T+ExtframeCount)+".npy"),mask)
                                 dset=h5.create_dataset(str(T+ExtframeCount)+"/frame",fr.shape,  dtype="i2", compression="gzip")#to save the mask in data set
                                 dset[...] = frC
                                 dset=h5.create_dataset(str(T+ExtframeCount)+"/mask",mask.shape,  dtype="i2", compression="gzip")
@@ -794,7 +769,7 @@ try:
                 #now add the new masks
                 ContinueNNWDef = 0#int(input("Do you like to continue this NN training?(press 1 for yes) "))#13
                 if ContinueNNWDef == 1 :
-                    allset=NNtools.TrainDataset(os.path.join(datadir,"deformations"),shape,high=False)
+                    allset=NNtools.TrainDataset(os.path.join(rundir,"deformations"),shape,high=False)
                     traindataloader= torch.utils.data.DataLoader(allset, batch_size=batch_size,shuffle=True, num_workers=num_workers,pin_memory=True)
                     valdataloader=torch.utils.data.DataLoader(vset,batch_size=batch_size,shuffle=True,num_workers=num_workers,pin_memory=True)
                     optimizer=torch.optim.Adam(net.parameters(),lr=lr)
@@ -860,14 +835,9 @@ try:
         print("Repacking h5.")
     repack()
 
-    #remove directory
-    if reusedirec is None:
-        shutil.rmtree(datadir)
     write_log(logform.format(1.,1.,1.,1.))
 
     if verbose:
         print("DONE")
 except Exception as exception:
-    if reusedirec is None:
-        shutil.rmtree(datadir)
     raise exception
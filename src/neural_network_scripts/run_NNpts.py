@@ -7,6 +7,7 @@ import glob
 import numpy as np
 import torch
 import NNtools
+import unpack_cache
 import shutil
 import multiprocessing
 import scipy.spatial as spat
@@ -56,7 +57,8 @@ complete=False #Whether each annotated frame is completely annotated
 if from_points:
     min_num_for_mask=15
 ##directory handling
-reusedirec="data/data_temp/zmdir"
+#the unpacked frames and masks are kept in unpack_cache.CACHE_ROOT, in a directory named after the content of the
+#frames, for the next runs on the same data (see unpack_cache)
 #purely computational parameters
 if get_points:
     chunksize=30#for pointdat
@@ -191,10 +193,10 @@ else:
 
 
 ############setup the run directory############
-if reusedirec is not None:
-    datadir=reusedirec
-else:
-    datadir=os.path.join("data","data_temp",dataset_name)
+frames_key=unpack_cache.frames_key(h5,T)
+cache=unpack_cache.open_cache(frames_key)
+datadir=cache.dirname
+rundir=cache.run_dir()#what this run writes besides the cache (deformed frames, predicted masks...), see unpack_cache
 
 
 
@@ -217,32 +219,18 @@ try:
 
 
 
-############Unpack h5 if not already unpacked ############
-    if reusedirec is None or not os.path.exists(reusedirec):
-        os.mkdir(datadir)
-        os.mkdir(os.path.join(datadir,"frames"))
-        os.mkdir(os.path.join(datadir,"highs"))
-        os.mkdir(os.path.join(datadir,"masks"))
-        Ntot=0
-        Nans=0
-        for i in range(T):
-            write_log(logform.format(min(i/T,0.8),0.,0.,0.))
-            fr=np.array(h5[str(i)+"/frame"]).astype(np.int16)
-            np.save(os.path.join(datadir,"frames","frame_"+str(i)+".npy"),fr)
-            Ntot+=1
-            if str(i)+"/high" in h5.keys():
-                np.save(os.path.join(datadir,"highs","high_"+str(i)+".npy"),np.array(h5[str(i)+"/high"]).astype(np.int16))
-            else:
-                np.save(os.path.join(datadir,"highs","high_"+str(i)+".npy"),np.full((1,W,H),255).astype(np.int16))
-            if from_points:
-                if pts_exists[i]:
-                    mask=NNtools.get_mask(fr[0],pointdat[i],num_classes,grid,thres=thres,distthres=distthres).astype(np.int16)
-                    np.save(os.path.join(datadir,"masks","mask_"+str(i)+".npy"),mask)
-                    Nans+=1
-            elif str(i)+"/mask" in h5.keys():
-                np.save(os.path.join(datadir,"masks","mask_"+str(i)+".npy"),np.array(h5[str(i)+"/mask"]).astype(np.int16))
-                Nans+=1
-        assert Nans>0, "At least one mask is needed"
+############Unpack h5 if not already unpacked from the same data (see unpack_cache) ############
+    unpack_cache.unpack_frames(cache,h5,T,key=frames_key,progress=lambda i,n: write_log(logform.format(min(i/n,0.8),0.,0.,0.)))
+    if from_points:
+        mask_times=[i for i in range(T) if pts_exists[i]]
+        masks_key=unpack_cache.digest(mask_times,pointdat,num_classes,thres,distthres,cache.key("frames"))
+        get_mask=lambda i: NNtools.get_mask(cache.get("frames",i)[0],pointdat[i],num_classes,grid,thres=thres,distthres=distthres)
+    else:
+        mask_times=[i for i in range(T) if str(i)+"/mask" in h5.keys()]
+        masks_key=unpack_cache.digest(mask_times,*[h5[str(i)+"/mask"] for i in mask_times])
+        get_mask=lambda i: h5[str(i)+"/mask"][...]
+    assert len(mask_times)>0, "At least one mask is needed"
+    cache.unpack("masks",masks_key,mask_times,(W,H,D),np.int16,get_mask)
 
 
 
@@ -365,16 +353,11 @@ try:
                 print("Adding Deformed Frames")
 
             #copy the existing masks first
-            dir_deformations=os.path.join(datadir,"deformations")
+            dir_deformations=os.path.join(rundir,"deformations")
             if os.path.exists(dir_deformations):
                 shutil.rmtree(dir_deformations)
             os.mkdir(dir_deformations)
-            os.mkdir(os.path.join(datadir,"deformations","frames"))
-            os.mkdir(os.path.join(datadir,"deformations","masks"))
-            for name in np.array(allset.filelist)[allset.real_ind_to_dset_ind(traininds)]:
-                i=int(os.path.split(name)[-1].split(".")[0].split("_")[1])
-                shutil.copyfile(os.path.join(datadir,"frames","frame_"+str(i)+".npy"),os.path.join(datadir,"deformations","frames","frame_"+str(i)+".npy"))
-                shutil.copyfile(name,os.path.join(datadir,"deformations","masks","mask_"+str(i)+".npy"))
+            cache.export_npy(allset.indlist[allset.real_ind_to_dset_ind(traininds)],dir_deformations)
 
 
 
@@ -435,11 +418,11 @@ try:
                 plt.show()
                 """
 
-                np.save(os.path.join(datadir,"deformations","frames","frame_"+str(T+i)+".npy"),fr) #we add T to avoid collision, but don't want to define another class
-                np.save(os.path.join(datadir,"deformations","masks","mask_"+str(T+i)+".npy"),mask)
+                np.save(os.path.join(rundir,"deformations","frames","frame_"+str(T+i)+".npy"),fr) #we add T to avoid collision, but don't want to define another class
+                np.save(os.path.join(rundir,"deformations","masks","mask_"+str(T+i)+".npy"),mask)
 
             #now add the new masks
-            allset=NNtools.TrainDataset(os.path.join(datadir,"deformations"),shape,high=False)
+            allset=NNtools.TrainDataset(os.path.join(rundir,"deformations"),shape,high=False)
             traindataloader= torch.utils.data.DataLoader(allset, batch_size=batch_size,shuffle=True, num_workers=num_workers,pin_memory=True)
 
             optimizer=torch.optim.Adam(net.parameters(),lr=lr)
@@ -462,12 +445,12 @@ try:
             repack()
             save_backup()#make h5 backup
 
-            dir_predmasks=os.path.join(datadir,"predmasks")
+            dir_predmasks=os.path.join(rundir,"predmasks")
             if os.path.exists(dir_predmasks):
                 shutil.rmtree(dir_predmasks)
             os.mkdir(dir_predmasks)
-            for name in np.array(allset.filelist)[allset.real_ind_to_dset_ind(traininds)]:
-                shutil.copyfile(name,os.path.join(datadir,"predmasks",os.path.split(name)[-1]))
+            for i in allset.indlist[allset.real_ind_to_dset_ind(traininds)]:
+                np.save(os.path.join(dir_predmasks,"mask_"+str(i)+".npy"),cache.get("masks",i))
 
             evalset=NNtools.EvalDataset(datadir,shape)#we need the evalutation set for aligned indices for all frames
             lineup=list(lineup)[len(traininds):]#traininds should be at the begining
@@ -502,12 +485,12 @@ try:
                     #This re-masks the data
                     ptschild=get_pts(ichild)
                     updatemask(ichild,ptschild)
-                    np.save(os.path.join(datadir,"predmasks","mask_"+str(ichild)+".npy"),np.array(h5[identifier+"/"+str(ichild)+"/predmask"]).astype(np.int16))
+                    np.save(os.path.join(dir_predmasks,"mask_"+str(ichild)+".npy"),np.array(h5[identifier+"/"+str(ichild)+"/predmask"]).astype(np.int16))
 
                 # regen optimizers
                 optimizer=torch.optim.Adam(net.parameters(),lr=lr_adia,amsgrad=True)
                 #update dataset
-                allset=NNtools.TrainDataset(datadir,shape,maskdirname="predmasks")
+                allset=NNtools.TrainDataset(datadir,shape,maskdirname=os.path.relpath(dir_predmasks,datadir))
                 # break if we are done: case if np.cumsum(k) exactly ends at lT
                 if len(allset)==T:
                     break
@@ -632,14 +615,9 @@ try:
         print("Repacking h5.")
     #repack()
 
-    #remove used directory
-    if reusedirec is None:
-        shutil.rmtree(datadir)
     write_log(logform.format(1.,1.,1.,1.))
 
     if verbose:
         print("DONE")
 except Exception as exception:
-    if reusedirec is None:
-        shutil.rmtree(datadir)
     raise exception
@@ -42,14 +42,8 @@ def copy_files(datadir, allset, traininds):
     if os.path.exists(dir_deformations):
         shutil.rmtree(dir_deformations)  # remove the deformed frames from the previous runs
     os.mkdir(dir_deformations)
-    os.mkdir(os.path.join(datadir, "deformations", "frames"))
-    os.mkdir(os.path.join(datadir, "deformations", "masks"))
-    for name in np.array(allset.filelist)[
-        allset.real_ind_to_dset_ind(traininds)]:  # placing the training frames and masks in the deformation folder
-        i = int(os.path.split(name)[-1].split(".")[0].split("_")[1])
-        shutil.copyfile(os.path.join(datadir, "frames", "frame_" + str(i) + ".npy"),
-                        os.path.join(datadir, "deformations", "frames", "frame_" + str(i) + ".npy"))
-        shutil.copyfile(name, os.path.join(datadir, "deformations", "masks", "mask_" + str(i) + ".npy"))
+    # placing the training frames and masks in the deformation folder
+    allset.cache.export_npy(allset.indlist[allset.real_ind_to_dset_ind(traininds)], dir_deformations)
 
 
 def load_target_frame(h5, evalset, i, NNname):
@@ -48,14 +48,8 @@ def copy_files(datadir, allset, traininds):
     if os.path.exists(dir_deformations):
         shutil.rmtree(dir_deformations)  # remove the deformed frames from the previous runs
     os.mkdir(dir_deformations)
-    os.mkdir(os.path.join(datadir, "deformations", "frames"))
-    os.mkdir(os.path.join(datadir, "deformations", "masks"))
-    for name in np.array(allset.filelist)[
-        allset.real_ind_to_dset_ind(traininds)]:  # placing the training frames and masks in the deformation folder
-        i = int(os.path.split(name)[-1].split(".")[0].split("_")[1])
-        shutil.copyfile(os.path.join(datadir, "frames", "frame_" + str(i) + ".npy"),
-                        os.path.join(datadir, "deformations", "frames", "frame_" + str(i) + ".npy"))
-        shutil.copyfile(name, os.path.join(datadir, "deformations", "masks", "mask_" + str(i) + ".npy"))
+    # placing the training frames and masks in the deformation folder
+    allset.cache.export_npy(allset.indlist[allset.real_ind_to_dset_ind(traininds)], dir_deformations)
 
 
 def load_target_frame(h5, evalset, i, NNname):
@@ -359,8 +353,9 @@ def update_files(data_dir, ptfrom, ptto, ctrl_pts):
 
 
 def targeted_augmentation(h5, num_additional, datadir, allset, traininds, T, identifier, shape, num_classes,
-                          scale=(0.1625, 0.1625, 1.5), plot_results=True, plots_dir=None, method = 1):
-    copy_files(datadir, allset, traininds)
+                          scale=(0.1625, 0.1625, 1.5), plot_results=True, plots_dir=None, method = 1, rundir=None):
+    # the deformed frames go to the directory of the run (see unpack_cache.UnpackCache.run_dir), if given
+    copy_files(datadir if rundir is None else rundir, allset, traininds)
     if plots_dir and not os.path.exists(plots_dir):
         os.makedirs(plots_dir)
 
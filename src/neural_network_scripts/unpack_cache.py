@@ -0,0 +1,307 @@
+"""
+Unpacked copy of the frames, "high" regions and masks of a dataset, from which the neural networks are trained and
+evaluated (see NNtools.TrainDataset and EvalDataset).
+Each modality is a single uncompressed .npy file with one row per frame (frames.npy: (T,C,W,H,D), highs.npy: (T,W,H),
+masks.npy: one row per annotated frame...) that the datasets memory-map, and index.json records, for each modality,
+the time of each row and a content hash of the data it was unpacked from. A modality is only unpacked again when that
+hash changes.
+The caches are kept from one run to the next in CACHE_ROOT, each in a directory named after the content of the frames
+and the parameters they were unpacked with (see open_cache), so that runs on the same data (with other hyperparameters,
+or from another copy of the file) skip the unpacking. The least recently used caches are deleted when the caches take
+more than a disk budget (UNPACK_CACHE_BUDGET_GB environment variable, set by the GUI from unpack_cache_budget_gb in
+the settings); caches in use by a running process are never deleted.
+The deformed frames are still written in the directory-of-npy layout (frames/frame_<t>.npy, masks/mask_<t>.npy),
+which the datasets also read, in the directory of the run in the cache (see UnpackCache.run_dir): several runs can use
+the same cache at once.
+This module only depends on numpy and h5py: it is imported by the NN scripts (import unpack_cache) as well as by
+src.methods.
+"""
+import atexit
+import glob
+import hashlib
+import itertools
+import json
+import os
+import shutil
+import h5py
+import numpy as np
+
+INDEX = "index.json"
+CACHE_ROOT = os.path.join("data", "data_temp", "unpack_cache")
+BUDGET_ENV = "UNPACK_CACHE_BUDGET_GB"
+DEFAULT_BUDGET_GB = 20
+
+
+def _update(hasher, part):
+    if isinstance(part, h5py.Dataset):
+        hasher.update(repr((part.shape, part.dtype.str)).encode())
+        if part.chunks is None:
+            hasher.update(np.ascontiguousarray(part[()]).tobytes())
+            return
+        # the chunks as stored in the file, without decompressing them
+        for offset in itertools.product(*(range(0, s, c) for s, c in zip(part.shape, part.chunks))):
+            try:
+                hasher.update(part.id.read_direct_chunk(offset)[1])
+            except (KeyError, RuntimeError):   # chunk never written
+                hasher.update(b"unallocated")
+    elif isinstance(part, np.ndarray):
+        hasher.update(repr((part.shape, part.dtype.str)).encode())
+        hasher.update(np.ascontiguousarray(part).tobytes())
+    else:
+        hasher.update(repr(part).encode())
+
+
+def digest(*parts):
+    """
+    Content hash of parts.
+    :param parts: h5py datasets (hashed from their stored chunks, which are not decompressed), arrays, or values with a
+        stable repr (parameters, lists of times, None for a missing dataset...)
+    :return: hexadecimal string
+    """
+    hasher = hashlib.blake2b(digest_size=16)
+    for part in parts:
+        hasher.update(b"|")
+        _update(hasher, part)
+    return hasher.hexdigest()
+
+
+class UnpackCache:
+    """
+    The unpacked modalities of a dataset in directory dirname (see module docstring).
+    Rows are read from memory maps, opened in each process on first access (so that the cache can be given to the
+    worker processes of a DataLoader).
+    """
+    def __init__(self, dirname):
+        self.dirname = dirname
+        self.index = {}
+        if os.path.exists(os.path.join(dirname, INDEX)):
+            with open(os.path.join(dirname, INDEX)) as f:
+                self.index = json.load(f)
+        self._arrays = {}
+        self._rows = {}
+        self.budget_gb = None   # see open_cache
+        self._run_dir = None
+
+    @staticmethod
+    def exists(dirname):
+        """Whether dirname holds an unpack cache (rather than the directory-of-npy layout)."""
+        return os.path.exists(os.path.join(dirname, INDEX))
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        state["_arrays"] = {}
+        return state
+
+    def __contains__(self, name):
+        return name in self.index
+
+    def _filename(self, name):
+        return os.path.join(self.dirname, name + ".npy")
+
+    def _write_index(self):
+        tmp = os.path.join(self.dirname, INDEX + ".part." + str(os.getpid()))
+        with open(tmp, "w") as f:
+            json.dump(self.index, f)
+        os.replace(tmp, os.path.join(self.dirname, INDEX))
+
+    def key(self, name):
+        """The hash of the source of modality name, None if it is not unpacked."""
+        return self.index[name]["key"] if name in self.index else None
+
+    def valid(self, name, key):
+        """Whether modality name is unpacked from the source of hash key."""
+        return self.key(name) == key and os.path.exists(self._filename(name))
+
+    def unpack(self, name, key, times, shape, dtype, get, progress=None):
+        """
+        Unpacks modality name, unless it is already unpacked from the same source.
+        :param key: hash of the source (see digest), including anything that changes the rows
+        :param times: the times of the rows
+        :param shape, dtype: the shape and type of a row
+        :param get: get(t) returns the row of time t
+        :param progress: None or callable, progress(done, total) is called after each row; if it returns False, the
+            unpacking is abandoned
+        :return: True if the modality is available, False if the unpacking was abandoned
+        """
+        if self.valid(name, key):
+            return True
+        os.makedirs(self.dirname, exist_ok=True)
+        self._arrays.pop(name, None)
+        self._rows.pop(name, None)
+        if self.index.pop(name, None) is not None:
+            self._write_index()
+        times = [int(t) for t in times]
+        tmp = self._filename(name) + ".part." + str(os.getpid())   # other runs may be unpacking it too
+        shape = (len(times),) + tuple(int(s) for s in shape)
+        out = np.lib.format.open_memmap(tmp, mode="w+", dtype=dtype, shape=shape)
+        done = False
+        try:
+            for i, t in enumerate(times):
+                out[i] = get(t)
+                if progress is not None and progress(i + 1, len(times)) is False:
+                    return False
+            out.flush()
+            done = True
+        finally:
+            del out
+            if not done:
+                os.remove(tmp)
+        os.replace(tmp, self._filename(name))
+        self.index[name] = {"key": key, "times": times}
+        self._write_index()
+        if self.budget_gb is not None:
+            evict(os.path.dirname(self.dirname), self.budget_gb)
+        return True
+
+    def run_dir(self):
+        """
+        The directory of this process in the cache, for what a run writes besides the unpacked modalities (deformed
+        frames, predicted masks, plots...), so that the runs using the cache at the same time do not delete or overwrite
+        each other's files. It is removed when the process exits (or by the next open_cache if the process was killed).
+        """
+        if self._run_dir is None:
+            self._run_dir = os.path.join(self.dirname, "run." + str(os.getpid()))
+            os.makedirs(self._run_dir, exist_ok=True)
+            atexit.register(shutil.rmtree, self._run_dir, True)
+        return self._run_dir
+
+    def times(self, name):
+        """The times of the rows of modality name."""
+        return np.array(self.index[name]["times"], dtype=int)
+
+    def array(self, name):
+        """Read-only memory map of modality name, one row per time (see times)."""
+        if name not in self._arrays:
+            self._arrays[name] = np.load(self._filename(name), mmap_mode="r")
+        return self._arrays[name]
+
+    def get(self, name, t):
+        """A copy of the row of time t of modality name, None if there is none."""
+        if name not in self._rows:
+            self._rows[name] = {t: i for i, t in enumerate(self.index[name]["times"])}
+        i = self._rows[name].get(int(t))
+        if i is None:
+            return None
+        return np.array(self.array(name)[i])
+
+    def nbytes(self):
+        """The disk footprint of the cache, in bytes."""
+        files = [self._filename(name) for name in self.index] + [os.path.join(self.dirname, INDEX)]
+        return sum(os.stat(fn).st_blocks * 512 for fn in files if os.path.exists(fn))
+
+    def export_npy(self, times, dirname, names=("frames", "masks")):
+        """
+        Writes the rows of given times of the given modalities in the directory-of-npy layout
+        (dirname/frames/frame_<t>.npy...), e.g. to start the directory of the deformed frames.
+        """
+        for name in names:
+            os.makedirs(os.path.join(dirname, name), exist_ok=True)
+            for t in times:
+                np.save(os.path.join(dirname, name, name[:-1] + "_" + str(int(t)) + ".npy"), self.get(name, t))
+
+
+def high_region(high, shape):
+    """
+    Where the frames are kept by the datasets when high=True: the pixels where the "high" images sum to more than 255.
+    :param high: the h5py dataset of the "high" images of a frame, or None if it has none (all pixels are kept)
+    :param shape: (W,H)
+    """
+    if high is None:
+        return np.ones(shape, dtype=bool)
+    return np.sum(np.array(high).astype(np.int16) / 255, axis=0) > 0.5
+
+
+def _size(dirname):
+    return sum(os.stat(fn).st_blocks * 512 for fn in glob.glob(os.path.join(dirname, "**"), recursive=True)
+               if os.path.isfile(fn))
+
+
+def _in_use(dirname):
+    """
+    Whether a running process uses the cache in dirname (the locks, run directories and partial files of processes
+    that are gone are removed).
+    """
+    in_use = False
+    for fn in glob.glob(os.path.join(dirname, "lock.*")):
+        try:
+            os.kill(int(fn.rsplit(".", 1)[1]), 0)
+            in_use = True
+        except PermissionError:   # process of another user
+            in_use = True
+        except (ProcessLookupError, ValueError):
+            os.remove(fn)
+    alive = {fn.rsplit(".", 1)[1] for fn in glob.glob(os.path.join(dirname, "lock.*"))}
+    for fn in glob.glob(os.path.join(dirname, "run.*")) + glob.glob(os.path.join(dirname, "*.part.*")):
+        if fn.rsplit(".", 1)[1] not in alive:
+            if os.path.isdir(fn):
+                shutil.rmtree(fn, ignore_errors=True)
+            else:
+                os.remove(fn)
+    return in_use
+
+
+def _release(lock):
+    if os.path.exists(lock):
+        os.remove(lock)
+
+
+def evict(root=CACHE_ROOT, budget_gb=None):
+    """
+    Deletes the least recently used caches of root until they take at most budget_gb GB, skipping the caches in use.
+    :param budget_gb: default: the UNPACK_CACHE_BUDGET_GB environment variable, or DEFAULT_BUDGET_GB
+    """
+    if budget_gb is None:
+        budget_gb = float(os.environ.get(BUDGET_ENV, DEFAULT_BUDGET_GB))
+    dirnames = [fn for fn in glob.glob(os.path.join(root, "*")) if os.path.isdir(fn)]
+    sizes = {dirname: _size(dirname) for dirname in dirnames}
+    total = sum(sizes.values())
+    for dirname in sorted(dirnames, key=os.path.getmtime):
+        if total <= budget_gb * 1e9:
+            break
+        if not _in_use(dirname):
+            shutil.rmtree(dirname, ignore_errors=True)
+            total -= sizes[dirname]
+
+
+def open_cache(key, root=CACHE_ROOT, budget_gb=None):
+    """
+    The cache of key in root (created if needed), marked as used by this process until it exits and as the most
+    recently used one. The least recently used caches are evicted (see evict) now and after each unpacking.
+    :param key: content hash of what the cache is unpacked from, see frames_key
+    :param budget_gb: see evict
+    """
+    dirname = os.path.join(root, key)
+    os.makedirs(dirname, exist_ok=True)
+    lock = os.path.join(dirname, "lock." + str(os.getpid()))
+    if not os.path.exists(lock):
+        open(lock, "w").close()
+        atexit.register(_release, lock)
+    os.utime(dirname)
+    _in_use(dirname)   # removes what the runs that were killed left behind
+    cache = UnpackCache(dirname)
+    cache.budget_gb = float(os.environ.get(BUDGET_ENV, DEFAULT_BUDGET_GB)) if budget_gb is None else budget_gb
+    evict(root, cache.budget_gb)
+    return cache
+
+
+def frames_key(h5, T, *params):
+    """
+    Content hash of the first T frames of h5 (per-frame layout) and of params (cropping, subsampling or channels the
+    frames are unpacked with...): the key of their cache, see open_cache.
+    """
+    return digest(*[h5[str(t) + "/frame"] for t in range(T)], *params)
+
+
+def unpack_frames(cache, h5, T, key=None, progress=None):
+    """
+    Unpacks the frames and the "high" regions (see high_region) of the first T frames of h5 (per-frame layout).
+    :param key: frames_key(h5, T), if already computed
+    :param progress: see UnpackCache.unpack, called for the frames only
+    """
+    frames = [h5[str(t) + "/frame"] for t in range(T)]
+    if key is None:
+        key = frames_key(h5, T)
+    cache.unpack("frames", key, range(T), frames[0].shape, np.int16, lambda t: frames[t][...], progress=progress)
+    W, H = int(h5.attrs["W"]), int(h5.attrs["H"])
+    highs = [h5.get(str(t) + "/high") for t in range(T)]
+    cache.unpack("highs", digest(W, H, *highs), range(T), (W, H), bool, lambda t: high_region(highs[t], (W, H)))
@@ -0,0 +1,292 @@
+"""
+Export of a reduced copy of a dataset (selected frames, cropped in x,y,z, optionally blurred, background-subtracted,
+resized, aligned...) into a new h5 file, e.g. to train a NN on a smaller movie.
+This is what Controller.Preprocess_and_save runs; it can also run without the GUI:
+    python3 -m src.preprocess_export file.h5 --frames 0 100 --z 0 32 --blur 40 6 --resize 256 160
+(see python3 -m src.preprocess_export -h)
+The frames are processed by a pool of worker processes while the calling process reads the next frames and writes the
+processed ones.
+"""
+import multiprocessing
+import os
+import time
+import numpy as np
+
+from .datasets_code.DataSet import DataSet
+from .helpers.helpers import batch
+from .mask_processing.image_processing import blur, blacken_background, resize_frame
+from .parameters.GlobalParameters import GlobalParameters
+
+# the options of Controller.options that the export depends on
+EXPORT_OPTIONS = ["save_crop_rotate", "save_blurred", "save_subtracted_bg", "save_1st_channel", "save_green_channel",
+                  "save_resized", "AutoDelete"]
+
+
+def crop_bounds(fr_shape, X_interval, Y_interval, Z_interval):
+    """
+    Converts the x,y,z intervals chosen by the user into crop bounds and padding.
+    An upper bound of 0 keeps the whole extent, a negative lower bound or an upper bound beyond the frame pads it.
+    :return: bounds ((x_0, x_1), (y_0, y_1), (z_0, z_1)) and pads ((padXL, padXR), (padYtop, padYbottom),
+        (padZlow, padZhigh)), as passed to np.pad
+    """
+    bounds, pads = [], []
+    for interval, size in zip((X_interval, Y_interval, Z_interval), fr_shape):
+        low, high = int(interval[0]), int(interval[1])
+        if low < 0:
+            start, pad_low = 0, -low
+        else:
+            start, pad_low = low, 0
+        if high == 0:
+            stop, pad_high = size, 0
+        elif high > size:
+            stop, pad_high = size, high - size
+        else:
+            stop, pad_high = high, 0
+        bounds.append((start, stop))
+        pads.append((pad_low, pad_high))
+    # the y padding is applied as (top, bottom) in np.pad
+    pads[1] = pads[1][::-1]
+    return bounds, pads
+
+
+def shift_points(pointdat, bounds, fr_shape=None, width=None, height=None):
+    """
+    Moves the points of the whole (T,N+1,3) pointdat array at once into the coordinates of the cropped frames, and
+    rescales x and y if the frames are resized (to width, height from fr_shape). NaN points stay NaN.
+    """
+    points = pointdat - np.array([start for start, _ in bounds], dtype=pointdat.dtype)
+    if width is not None:
+        points[..., 0] *= width / fr_shape[0]
+        points[..., 1] *= height / fr_shape[1]
+    return points
+
+
+def process_frame(red, green, mask, coarse, settings):
+    """
+    Applies the export processing to the images of one time frame (runs in the worker processes).
+    :param green: green frame or 0 if not exported; mask, coarse: masks or False/None if absent
+    :param settings: dict with "bounds", "pads", "blur" (bg_blur, sd_blur), "subtract_bg" (threshold), "size"
+        (width, height) and the export options
+    :return: red, green, mask, coarse, nb_neurons (the number of neurons seen in the mask, 0 if no mask)
+    """
+    (x_0, x_1), (y_0, y_1), (z_0, z_1) = settings["bounds"]
+    pads = settings["pads"]
+    resize = settings["save_resized"]
+
+    def crop(img):
+        return img[x_0:x_1, y_0:y_1, z_0:z_1]
+
+    def crop_and_pad_frame(frame):
+        frame = crop(frame)
+        frmean = int(np.mean(frame, axis=(0, 1, 2)))
+        frame = np.pad(frame, pads, 'constant', constant_values=((frmean, frmean), (frmean, frmean), (frmean, frmean)))
+        if resize:
+            frame = resize_frame(frame, *settings["size"])
+        return frame
+
+    if np.any(green):
+        green = crop_and_pad_frame(green)
+    if settings["save_blurred"]:
+        red = blur(red, *settings["blur"], settings["save_subtracted_bg"], settings["subtract_bg"])
+    elif settings["save_subtracted_bg"]:
+        red = blacken_background(red, settings["subtract_bg"])
+    red = crop_and_pad_frame(red)
+    nb_neurons = 0
+    if mask is not False:
+        mask = np.pad(crop(mask), pads, 'constant', constant_values=((0, 0), (0, 0), (0, 0)))
+        nb_neurons = max(len(np.unique(mask)), np.max(mask))
+        if resize:
+            mask = resize_frame(mask, *settings["size"], mask=True)
+    if coarse is not None:
+        coarse = np.pad(crop(coarse), pads, 'constant', constant_values=((0, 0), (0, 0), (0, 0)))
+    return red, green, mask, coarse, nb_neurons
+
+
+def _process_frame(args):
+    return process_frame(*args)
+
+
+def exported_times(data, times, deleted, auto_delete=False):
+    """
+    The times that are exported: times, except the deleted ones and, with auto_delete, those whose coarse mask has
+    fewer than 2 segments.
+    """
+    data.flush()   # the coarse masks are read from the file directly
+    kept = []
+    for t in times:
+        if t in deleted:
+            continue
+        if auto_delete:
+            kcoarse = str(t) + "/coarse_mask"
+            if kcoarse in data.dataset.keys() and len(np.unique(data.dataset[kcoarse])) < 3:
+                continue
+        kept.append(t)
+    return kept
+
+
+def preprocess_and_save(data, newpath, times, X_interval, Y_interval, Z_interval, bg_blur, sd_blur, bg_subt, width,
+                        height, options, progress=None, n_workers=None):
+    """
+    Writes the frames of data at given times (with their masks, coarse masks, transformations...) into a new file,
+    cropped to the given intervals and processed according to options. The points are shifted accordingly.
+    :param data: the DataSet to export from
+    :param newpath: path of the new h5 file
+    :param times: the times to export (see exported_times)
+    :param options: dict with the keys of EXPORT_OPTIONS (see Controller.options)
+    :param progress: None or function called as progress(n_done, n_total, eta) after each batch, eta in seconds
+    :param n_workers: number of processes (default: GlobalParameters.n_processes, or the number of cores)
+    """
+    data.flush()   # the masks, coarse masks and points are also read from the file directly
+    frameCheck = data.get_frame(0, col="red")
+    fr_shape = np.shape(frameCheck)
+    bounds, pads = crop_bounds(fr_shape, X_interval, Y_interval, Z_interval)
+
+    hNew = DataSet.create_dataset(newpath)
+    hNew.copy_properties(data, except_frame_num=True)
+    OrigCrop = data.crop
+    OrigAlign = data.align
+    if options["save_crop_rotate"]:
+        data.crop = True
+        data.align = True
+
+    key = "distmat"
+    if key in data.dataset.keys():
+        distmat = data.dataset[key]   # TODO
+        ds = hNew.dataset.create_dataset(key, shape=np.shape(distmat), dtype="f4")
+        ds[...] = distmat
+        print("distmat saved")
+    # change the point annotation in accordance with resized dimensions.
+    if 'pointdat' in data.dataset.keys() or 'pointdat_old' in data.dataset.keys():
+        pointkey0 = 'pointdat' if 'pointdat' in data.dataset.keys() else 'pointdat_old'
+        if options["save_resized"]:
+            S_f = shift_points(np.array(data.dataset[pointkey0]), bounds, fr_shape, width, height)
+        else:
+            S_f = shift_points(np.array(data.dataset[pointkey0]), bounds)
+        print("point coordinate aligned")
+        hNew.dataset.create_dataset(pointkey0, data=S_f)
+
+    red_col = "green" if options["save_green_channel"] and not options["save_1st_channel"] else "red"
+    with_green = hNew.nb_channels == 2 and not (options["save_1st_channel"] ^ options["save_green_channel"])
+    with_coarse = not options["save_crop_rotate"]   # TODO : check for compatibility with rotation and cropping modes
+    settings = {"bounds": bounds, "pads": pads, "blur": (bg_blur, sd_blur), "subtract_bg": bg_subt,
+                "size": (width, height), **{key: options[key] for key in EXPORT_OPTIONS}}
+
+    def read(times_batch):
+        reds = data.get_frames(times_batch, col=red_col)
+        greens = data.get_frames(times_batch, col="green") if with_green else [0] * len(times_batch)
+        masks = data.get_masks(times_batch, stack=False)
+        args = []
+        for t, red, green, mask in zip(times_batch, reds, greens, masks):
+            kcoarse = str(t) + "/coarse_mask"
+            coarse = np.array(data.dataset[kcoarse]) if with_coarse and kcoarse in data.dataset.keys() else None
+            args.append((red, green, mask, coarse, settings))
+        return args
+
+    def write(times_batch, first_l, results):
+        for l, (t, (red, green, mask, coarse, nb_neurons)) in enumerate(zip(times_batch, results), start=first_l):
+            if mask is not False:
+                hNew.nb_neurons = max(hNew.nb_neurons, nb_neurons)
+                hNew.save_frame(l, red, green, mask=mask, force_original=True)
+            else:
+                hNew.save_frame(l, red, green, force_original=True)
+            if coarse is not None:
+                for key in (str(l) + "/coarse_mask", str(l) + "/coarse_seg"):
+                    hNew.dataset.create_dataset(key, data=coarse.astype(np.int16), dtype="i2",
+                                                **hNew._codec_kwargs())
+            # save the transformation functions for later retrieval
+            matrix = data.get_transformation(t)
+            if options["save_crop_rotate"] or (matrix is not None):
+                hNew.save_transformation_matrix(l, matrix)
+            hNew.save_frame_match(t, l)
+            real_time = data.get_real_time(t)
+            if real_time is not None:
+                hNew.save_real_time(l, real_time)
+
+    n_workers = n_workers or GlobalParameters.n_processes or os.cpu_count()
+    st = time.perf_counter()
+    done = 0
+    try:
+        # while the workers process a batch, the previous one is written and the next one is read; the workers are
+        # spawned rather than forked, as the GUI calling this has other threads running (frame loader, write-behind...)
+        with multiprocessing.get_context("spawn").Pool(processes=n_workers) as pool:
+            pending = None
+            for times_batch in batch(times, n=2 * n_workers):
+                results = pool.map_async(_process_frame, read(times_batch))
+                if pending is not None:
+                    write(*pending[:2], pending[2].get())
+                    done += len(pending[0])
+                    if progress is not None:
+                        elapsed = time.perf_counter() - st
+                        progress(done, len(times), elapsed / done * (len(times) - done))
+                pending = (times_batch, done, results)
+            if pending is not None:
+                write(*pending[:2], pending[2].get())
+                done += len(pending[0])
+                if progress is not None:
+                    progress(done, len(times), 0.)
+        if options["save_resized"]:
+            hNew.save_original_size(fr_shape)
+
+        X_interval0 = data.original_intervals("x")
+        Y_interval0 = data.original_intervals("y")
+        Z_interval0 = data.original_intervals("z")
+        if X_interval is not None:
+            if Y_interval[1] == 0:
+                Y_interval[1] = Y_interval0[1]
+            if Y_interval[0] == 0 and not Y_interval0[0] == 0:
+                Y_interval[0] = Y_interval0[0]
+            if X_interval[1] == 0:
+                X_interval[1] = X_interval0[1]
+            if X_interval[0] == 0 and not X_interval0[0] == 0:
+                X_interval[0] = X_interval0[0]
+        hNew.save_original_intervals(X_interval, Y_interval, Z_interval)
+
+        assert hNew.frame_num == len(times)
+    finally:
+        data.align = OrigAlign
+        data.crop = OrigCrop
+        hNew.close()
+    print("{} frames exported to {} in {:.1f} s".format(len(times), newpath, time.perf_counter() - st))
+
+
+def _print_progress(done, total, eta):
+    print("{}/{} frames exported, {:.0f} s left".format(done, total, eta))
+
+
+if __name__ == "__main__":
+    import argparse
+    parser = argparse.ArgumentParser(description="Exports a cropped/processed copy of a dataset (same as the "
+                                                 "'Save in a separate file' button of the GUI).")
+    parser.add_argument("dataset", help="the h5 file to export from")
+    parser.add_argument("output", nargs="?", help="the new h5 file (default: <name>_CroppedandRotated.h5 next to the "
+                                                  "dataset)")
+    parser.add_argument("--frames", nargs=2, type=int, metavar=("FROM", "TO"), help="frames FROM to TO-1 (default: all)")
+    parser.add_argument("--delete", nargs="*", type=int, default=[], help="frames not to export")
+    for axis in "xyz":
+        parser.add_argument("--" + axis, nargs=2, type=int, default=[0, 0], metavar=("FROM", "TO"),
+                            help="{} interval (TO=0 for the whole extent, may pad the frames)".format(axis))
+    parser.add_argument("--blur", nargs=2, type=int, metavar=("BG", "SD"), help="blur with these parameters")
+    parser.add_argument("--subtract-bg", type=int, metavar="THRESHOLD", help="zero the pixels below THRESHOLD")
+    parser.add_argument("--resize", nargs=2, type=int, metavar=("WIDTH", "HEIGHT"), help="resize the frames in x,y")
+    parser.add_argument("--crop-rotate", action="store_true", help="apply the alignment and cropping of the dataset")
+    parser.add_argument("--first-channel", action="store_true", help="only export the red channel")
+    parser.add_argument("--green", action="store_true", help="only export the green channel")
+    parser.add_argument("--auto-delete", action="store_true",
+                        help="skip the frames whose coarse mask has fewer than 2 segments")
+    parser.add_argument("--workers", type=int, help="number of processes (default: number of cores)")
+    args = parser.parse_args()
+
+    data = DataSet.load_dataset(args.dataset)
+    output = args.output or os.path.join(os.path.dirname(args.dataset), data.name + "_CroppedandRotated.h5")
+    options = {"save_crop_rotate": args.crop_rotate, "save_blurred": args.blur is not None,
+               "save_subtracted_bg": args.subtract_bg is not None, "save_1st_channel": args.first_channel,
+               "save_green_channel": args.green, "save_resized": args.resize is not None,
+               "AutoDelete": args.auto_delete}
+    times = range(*args.frames) if args.frames else range(data.frame_num)
+    times = exported_times(data, times, set(args.delete), options["AutoDelete"])
+    bg_blur, sd_blur = args.blur or (40, 6)
+    width, height = args.resize or (None, None)
+    preprocess_and_save(data, output, times, np.array(args.x, dtype=float), np.array(args.y, dtype=float),
+                        np.array(args.z, dtype=float), bg_blur, sd_blur, args.subtract_bg or 0, width, height, options,
+                        progress=_print_progress, n_workers=args.workers)
+    data.close()
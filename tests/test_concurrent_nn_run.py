@@ -0,0 +1,57 @@
+"""
+The GUI and a NN run working on the same data set at the same time: the GUI keeps the file open and edits it through
+its write-behind queue (see h5Data) while the NN process reads and writes the snapshot of the file (see
+h5utils.nn_snapshot).
+Run from the targettrack folder: python3 -m pytest tests
+"""
+import multiprocessing
+import h5py
+import numpy as np
+
+from benchmarks.synthetic import synthetic_frame, synthetic_mask, write_movie
+from src import h5utils
+from src.datasets_code.h5Data import h5Data
+
+W, H, D, T = 64, 48, 8, 20
+
+
+def nn_run(snapshot_fn, run):
+    """What the NN scripts do with the snapshot: read the frames and masks, write predictions."""
+    with h5py.File(snapshot_fn, "r+") as h5:
+        for t in range(T):
+            assert np.array_equal(h5[str(t) + "/frame"], synthetic_frame(2, W, H, D, seed=t))
+            mask = np.array(h5[str(t) + "/mask"])
+            h5.create_dataset("net/{}/{}/predmask".format(run, t), data=mask, dtype="i2", compression="gzip")
+            h5.flush()
+
+
+def test_gui_edits_while_nn_runs(tmp_path):
+    fn = write_movie(str(tmp_path / "movie.h5"), W=W, H=H, D=D, T=T)
+    snapshot_fn = str(tmp_path / "movie_snapshot.h5")
+    data = h5Data(fn)
+    data.flush()
+    h5utils.nn_snapshot(data.dataset, snapshot_fn, run="Net_run")
+
+    # a separate process, as the NN scripts are started by the GUI
+    worker = multiprocessing.get_context("spawn").Process(target=nn_run, args=(snapshot_fn, "Net_run"))
+    worker.start()
+    new_masks = {t: synthetic_mask(W, H, D, seed=100 + t) for t in range(T)}
+    for t in range(T):
+        data.save_mask(t, new_masks[t])
+        assert np.array_equal(data.get_mask(t), new_masks[t])   # served from the queue before it is written
+        data.get_frame(t)
+    worker.join(timeout=120)
+    assert worker.exitcode == 0
+
+    data.flush()
+    assert data.pending_writes() == 0
+    for t in range(T):
+        assert np.array_equal(data.get_mask(t), new_masks[t])
+    data.close()
+
+    with h5py.File(fn, "r") as h5:   # the queued writes are in the file
+        for t in range(T):
+            assert np.array_equal(h5[str(t) + "/mask"], new_masks[t])
+    with h5py.File(snapshot_fn, "r") as h5:   # the run saw the masks of the snapshot, not the edits of the GUI
+        for t in range(T):
+            assert np.array_equal(h5["net/Net_run/{}/predmask".format(t)], synthetic_mask(W, H, D, seed=t))
@@ -0,0 +1,62 @@
+"""
+Bulk edition of the labels of the masks (see mask_processing.mask_edit), of the annotated masks and of the masks
+predicted by a NN.
+Run from the targettrack folder: python3 -m pytest tests
+"""
+import numpy as np
+
+from benchmarks.synthetic import synthetic_mask, write_movie
+from src.datasets_code.h5Data import h5Data
+from src.mask_processing import mask_edit
+
+W, H, D, T = 64, 48, 8, 12
+NN_KEY = "Net_run"
+
+
+def open_data(tmp_path):
+    """A synthetic movie with annotated masks, and NN predictions in which neuron 3 is only in the even frames."""
+    data = h5Data(write_movie(str(tmp_path / "movie.h5"), W=W, H=H, D=D, T=T, N_neurons=10))
+    for t in range(T):
+        mask = synthetic_mask(W, H, D, n_neurons=10, seed=50 + t)
+        if t % 2:
+            mask[mask == 3] = 0
+        data.save_NN_mask(t, NN_KEY, mask)
+    data.flush()
+    return data
+
+
+def test_clear_NN_masks_leaves_ground_truth(tmp_path):
+    data = open_data(tmp_path)
+    gt = [data.get_mask(t, force_original=True) for t in range(T)]
+    nn = [data.get_NN_mask(t, NN_KEY) for t in range(T)]
+    saved = []
+    save_NN_mask = data.save_NN_mask
+    data.save_NN_mask = lambda t, NN_key, mask: (saved.append(t), save_NN_mask(t, NN_key, mask))
+
+    edited = mask_edit.edit_masks(data, {3: 0}, range(2, 9), NN_key=NN_KEY)
+    data.flush()
+
+    assert edited == saved == [2, 4, 6, 8]   # the frames without neuron 3 are skipped
+    for t in range(T):
+        assert np.array_equal(data.get_mask(t, force_original=True), gt[t])
+        expected = nn[t].copy()
+        if 2 <= t < 9:
+            expected[expected == 3] = 0
+        assert np.array_equal(data.get_NN_mask(t, NN_KEY), expected)
+        assert 3 not in data.mask_labels(t, NN_KEY) or not 2 <= t < 9
+    data.close()
+
+
+def test_edit_ground_truth_masks(tmp_path):
+    data = open_data(tmp_path)
+    gt = [data.get_mask(t, force_original=True) for t in range(T)]
+    nn = [data.get_NN_mask(t, NN_KEY) for t in range(T)]
+
+    mask_edit.edit_masks(data, {3: 7, 7: 3}, range(T))
+    data.flush()
+
+    for t in range(T):
+        expected = mask_edit.remap(gt[t], mask_edit.label_lut({3: 7, 7: 3}, 10))
+        assert np.array_equal(data.get_mask(t, force_original=True), expected)
+        assert np.array_equal(data.get_NN_mask(t, NN_KEY), nn[t])
+    data.close()
@@ -0,0 +1,59 @@
+"""
+Repacking the NN snapshot of a data set (see h5utils.nn_snapshot and h5_compact.repack), as the NN scripts do at the
+end of a run.
+Run from the targettrack folder: python3 -m pytest tests
+"""
+import os
+import h5py
+import numpy as np
+
+from benchmarks.synthetic import synthetic_mask, write_movie
+from src import h5utils
+from src.neural_network_scripts import h5_compact
+
+RUN = "Net_run"
+
+
+def make_snapshot(tmp_path, T=30):
+    """A snapshot of a synthetic movie, with the predicted masks of a run written into it as the NN scripts do."""
+    fn = write_movie(str(tmp_path / "movie.h5"), W=64, H=48, D=8, T=T)
+    dst_fn = str(tmp_path / "movie_snapshot.h5")
+    with h5py.File(fn, "r") as h5:
+        h5utils.nn_snapshot(h5, dst_fn, run=RUN)
+    with h5py.File(dst_fn, "r+") as h5:
+        for t in range(T):
+            h5.create_dataset("net/{}/{}/predmask".format(RUN, t), data=synthetic_mask(64, 48, 8, seed=t),
+                              compression="gzip")
+    return dst_fn
+
+
+def test_results_only_snapshot_is_not_repacked(tmp_path):
+    dst_fn = make_snapshot(tmp_path)
+    reclaimable, file_size = h5_compact.reclaimable_bytes(dst_fn)
+    assert reclaimable < 0.05 * file_size   # the metadata are not counted as reclaimable
+    assert not h5_compact.repack(dst_fn, threshold=0.2)
+
+
+def test_repack_keeps_external_links(tmp_path):
+    T = 30
+    dst_fn = make_snapshot(tmp_path, T=T)
+    with h5py.File(dst_fn, "r+") as h5:
+        for t in range(T // 2):   # rewritten predictions leave unused space
+            del h5["net/{}/{}/predmask".format(RUN, t)]
+    size = os.path.getsize(dst_fn)
+    assert h5_compact.repack(dst_fn, threshold=0.2)
+    assert os.path.getsize(dst_fn) < size
+    with h5py.File(dst_fn, "r") as h5:
+        for t in range(T):
+            assert isinstance(h5.get(str(t), getlink=True), h5py.ExternalLink)
+        assert h5["0/frame"].shape == (2, 64, 48, 8)   # still read through the link
+        assert np.array_equal(h5["net/{}/{}/predmask".format(RUN, T - 1)], synthetic_mask(64, 48, 8, seed=T - 1))
+
+
+def test_gui_repack_keeps_external_links(tmp_path):
+    dst_fn = make_snapshot(tmp_path)
+    for codec in (None, "lzf"):
+        h5utils.repack(dst_fn, codec=codec)
+        with h5py.File(dst_fn, "r") as h5:
+            assert isinstance(h5.get("0", getlink=True), h5py.ExternalLink)
+            assert "frame" in h5["0"]